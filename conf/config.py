@@ -6,9 +6,105 @@ import os
 class BaseConfiguration:
     dry_run = os.environ.get('MTS_DRY_RUN', False)
     mbs_api_url = 'https://mbs.fedoraproject.org/module-build-service/1/'
+    # Timeout in seconds to connect to MBS. requests_timeout is used as the
+    # timeout to read response.
+    mbs_connect_timeout = 10
+    # Max number of connections to MBS kept alive for reuse.
+    mbs_pool_size = 10
+    # Max number of retries when MBS cannot be connected or responds with a
+    # server error. Retry waits for mbs_retry_backoff_factor * 2 ** (retries - 1)
+    # seconds plus a random jitter up to mbs_retry_backoff_jitter seconds.
+    mbs_retries = 3
+    mbs_retry_backoff_factor = 0.5
+    mbs_retry_backoff_jitter = 0.5
+    # Stop requesting MBS after this many consecutive requests fail because
+    # MBS is unavailable, and pause handling messages until it could be
+    # requested again. Set to 0 to always request MBS.
+    mbs_breaker_failure_threshold = 5
+    # Seconds to wait before trying to request MBS again. Only one request is
+    # sent to try, and others are rejected until it succeeds.
+    mbs_breaker_reset_timeout = 30
+
+    # Parsed modulemd of module builds is cached to handle subsequent messages
+    # of the same module build. Max number of cached modulemd. Set to 0 to
+    # disable the cache.
+    modulemd_cache_size = 500
+    # Max total size in bytes of modulemd YAML content of cached modulemd.
+    modulemd_cache_max_bytes = 64 * 1024 * 1024
+    # Seconds for a cached modulemd to expire.
+    modulemd_cache_ttl = 3600
+
+    # Path to a SQLite database file to store modulemd content retrieved from
+    # MBS, which is kept across service restarts. Recently used modulemd in the
+    # store are loaded into cache on startup. Set to None to disable the store.
+    # Example: '/var/lib/mts/modulemd.db'
+    modulemd_store_path = None
+    # Max total size in bytes of stored modulemd content. Least recently used
+    # ones are removed periodically to keep the store within this size.
+    modulemd_store_max_bytes = 512 * 1024 * 1024
+    # Interval in seconds to remove modulemd exceeding the size limit.
+    modulemd_store_compact_interval = 3600
+
+    # Path to a SQLite database file to record tags requested to apply to
+    # builds. A build is not requested again to be tagged with a tag recorded
+    # within the retention period, e.g. when both ready and done states of a
+    # module build match rules, unless the recorded task failed or was
+    # canceled in Koji. Set to None to disable the ledger.
+    # Example: '/var/lib/mts/tag_ledger.db'
+    tag_ledger_path = None
+    # Seconds to keep a record in the ledger.
+    tag_ledger_retention = 7 * 24 * 3600
+    # Interval in seconds to remove records older than the retention period.
+    tag_ledger_purge_interval = 3600
 
     koji_profile = 'koji'
 
+    # Koji sessions are logged in once and kept in a pool to be reused for
+    # handling messages. This is the max number of sessions in the pool.
+    koji_max_sessions = 4
+
+    # Send all tagBuild requests for a matched module build to Koji in a single
+    # multicall instead of one request per build and tag.
+    koji_multicall = False
+    # Number of threads to send tagBuild requests at the same time, each with a
+    # session from the pool, if koji_multicall is disabled. Set to 1 to send
+    # requests one by one.
+    koji_tag_workers = 1
+
+    # Interval in seconds to check requested tagBuild tasks in Koji. Tasks are
+    # checked in a single getTaskInfo multicall, and message build.tagged or
+    # build.tag.failed is sent when each of them finishes. Set to 0 to not
+    # track tasks.
+    koji_task_poll_interval = 0
+    # Max number of tasks to check in one multicall.
+    koji_task_poll_batch_size = 100
+    # Seconds to stop tracking a task not finished yet after it is requested.
+    koji_task_track_timeout = 24 * 3600
+
+    # Same as mbs_breaker_failure_threshold and mbs_breaker_reset_timeout, but
+    # for Koji hub.
+    koji_breaker_failure_threshold = 5
+    koji_breaker_reset_timeout = 30
+
+    # Limit calls to Koji hub from tagging builds and logging in, in order not
+    # to overload the hub, e.g. during a mass rebuild. A multicall counts as
+    # one call. Max number of calls per second, 0 means no limit.
+    koji_rate_limit = 0
+    # Max number of calls which could be made at once after being idle.
+    koji_rate_burst = 10
+    # Max number of calls waiting for response from hub at the same time. 0
+    # means no limit.
+    koji_max_concurrent_calls = 0
+
+    # Ask Koji which tags builds have already before requesting tagBuild, so
+    # that tags applied already, e.g. by other tools, are not requested again.
+    # Tags of builds are queried in a single listTags multicall.
+    koji_check_build_tags = False
+    # Max number of builds whose tags are cached.
+    build_tags_cache_size = 1000
+    # Seconds to cache tags of a build.
+    build_tags_cache_ttl = 300
+
     # User for ssl authtype to log into Koji.
     # In Koji configuration, kerberos is the default authtype. If this is set,
     # ssl authtype will be used instead.
@@ -29,6 +125,13 @@ class BaseConfiguration:
 
     # Please note that, no specific config for fedora-messaging is defined here.
     # Instead, refer to mts.toml for the complete configuration.
+    # Except this one, which is the same as rhmsg_consumer_workers, but for
+    # messages received from fedora-messaging. Messages prefetched from broker
+    # is limited by qos.prefetch_count in mts.toml. fedora-messaging acks a
+    # message when it is handed over to a thread, so up to this many messages
+    # being handled are not delivered again if the service crashes.
+    fedora_messaging_consumer_workers = 1
+
     # Set this to rhmsg for interacting with UMB.
     messaging_backend = 'fedora-messaging'
 
@@ -50,6 +153,69 @@ class BaseConfiguration:
     # The name used to identify unique subscriptions. Set this to a unique value
     # to enable durable messages.
     rhmsg_subscription_name = None
+    # Number of threads to handle messages received from UMB. Messages of the
+    # same module build are always handled in order by the same thread, and a
+    # message waiting to be handled is skipped if the same state change of the
+    # same module build is received again. Set to 1 to handle messages one by
+    # one in the receiving thread.
+    # Either way, a message is acknowledged to broker only after it is handled,
+    # so messages are delivered again if the service stops before.
+    rhmsg_consumer_workers = 1
+    # Max number of received messages not handled yet is rhmsg_consumer_workers
+    # times this. Broker stops delivering messages when it is reached.
+    rhmsg_consumer_max_pending = 10
+
+    # Brokers could deliver a message again, and MBS could send the same state
+    # change of a module build more than once. A message is dropped if a
+    # message with the same ID, or of the same module build and state, was
+    # handled within this many seconds. A message failed to be handled is not
+    # remembered. Set to 0 to handle every message.
+    consumer_dedup_window = 300
+    # Max number of message IDs and module build states remembered.
+    consumer_dedup_max_entries = 10000
+
+    # Put messages into a queue and send them from a background thread, so
+    # that handling module builds is not blocked by sending messages.
+    messaging_async_publish = False
+    # Max number of messages in the queue. Publishing waits when the queue is full.
+    publish_queue_size = 1000
+    # Max number of queued messages to be sent in a batch. For rhmsg, messages of
+    # the same topic in a batch are sent over the connection together.
+    publish_batch_size = 50
+
+    # Path to a SQLite database file used as an outbox. Messages failed to be
+    # sent are saved in the outbox and sent again periodically once broker is
+    # available. Messages left in the outbox are sent when the service starts.
+    # Set to None to disable the outbox, then such messages are lost.
+    # Example: '/var/lib/mts/outbox.db'
+    outbox_path = None
+    # Interval in seconds to send messages saved in outbox again.
+    outbox_replay_interval = 60
+    # Max number of saved messages to read from outbox at a time to send again.
+    outbox_replay_batch_size = 100
+
+    # Path to a SQLite database file to store messages failed to be handled,
+    # which are handled again later in a background thread. Messages failed
+    # too many times are moved to dead letters, which could be listed and
+    # handled again by: python3 -m message_tagging_service.dead_letters
+    # Set to None to disable retries, then such messages are dropped.
+    # Example: '/var/lib/mts/retries.db'
+    retry_store_path = None
+    # How many times and how long to wait before retrying a message by the
+    # class name of error raised from handling it, or of the error causing it.
+    # Wait time is doubled after each retry. A message is moved to dead
+    # letters immediately on an error whose max_attempts is 0.
+    retry_policies = {
+        'default': {'max_attempts': 5, 'delay': 60},
+        # MBS or Koji is not available
+        'CircuitOpenError': {'max_attempts': 10, 'delay': 300},
+        'ConnectionError': {'max_attempts': 10, 'delay': 60},
+        'Timeout': {'max_attempts': 10, 'delay': 60},
+        # Invalid message
+        'KeyError': {'max_attempts': 0, 'delay': 0},
+    }
+    # Max seconds to wait before retrying a message.
+    retry_max_delay = 3600
 
     # Default is INFO. Refer to Python logging module to know valid values.
     log_level = 'INFO'
@@ -58,6 +224,16 @@ class BaseConfiguration:
     # Example: https://example.com/rules/mts-rules.yaml
     rules_file_url = ''
 
+    # Rules file content is cached. After it is cached for this number of
+    # seconds, it is revalidated with a conditional GET request. Any time the
+    # rules file cannot be read, the last read content is used.
+    rules_cache_ttl = 300
+
+    # Interval in seconds to refresh the cached rules file content in a
+    # background thread, which keeps reading rules file out of handling
+    # messages. Set to 0 to disable the background refresh.
+    rules_refresh_interval = 60
+
     # Default build state. Module builds which are in this state will be
     # tagged if no build state is specified in rule explicitly.
     build_state = 'ready'
@@ -80,4 +256,4 @@ class DevConfiguration(BaseConfiguration):
 
 
 class TestConfiguration(DevConfiguration):
-    pass
+    rules_refresh_interval = 0
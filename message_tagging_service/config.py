@@ -42,7 +42,59 @@ class Config:
     """
     _defaults = {
         'build_state_msg_filter': ['ready', 'done'],
-        'requests_timeout': 60
+        'requests_timeout': 60,
+        'mbs_connect_timeout': 10,
+        'mbs_pool_size': 10,
+        'mbs_retries': 3,
+        'mbs_retry_backoff_factor': 0.5,
+        'mbs_retry_backoff_jitter': 0.5,
+        'mbs_breaker_failure_threshold': 5,
+        'mbs_breaker_reset_timeout': 30,
+        'modulemd_cache_size': 500,
+        'modulemd_cache_max_bytes': 64 * 1024 * 1024,
+        'modulemd_cache_ttl': 3600,
+        'modulemd_store_path': None,
+        'modulemd_store_max_bytes': 512 * 1024 * 1024,
+        'modulemd_store_compact_interval': 3600,
+        'tag_ledger_path': None,
+        'tag_ledger_retention': 7 * 24 * 3600,
+        'tag_ledger_purge_interval': 3600,
+        'rules_cache_ttl': 300,
+        'rules_refresh_interval': 60,
+        'koji_max_sessions': 4,
+        'koji_multicall': False,
+        'koji_task_poll_interval': 0,
+        'koji_task_poll_batch_size': 100,
+        'koji_task_track_timeout': 24 * 3600,
+        'koji_breaker_failure_threshold': 5,
+        'koji_breaker_reset_timeout': 30,
+        'koji_rate_limit': 0,
+        'koji_rate_burst': 10,
+        'koji_max_concurrent_calls': 0,
+        'koji_tag_workers': 1,
+        'koji_check_build_tags': False,
+        'build_tags_cache_size': 1000,
+        'build_tags_cache_ttl': 300,
+        'fedora_messaging_consumer_workers': 1,
+        'rhmsg_consumer_workers': 1,
+        'rhmsg_consumer_max_pending': 10,
+        'consumer_dedup_window': 300,
+        'consumer_dedup_max_entries': 10000,
+        'messaging_async_publish': False,
+        'publish_queue_size': 1000,
+        'publish_batch_size': 50,
+        'outbox_path': None,
+        'outbox_replay_interval': 60,
+        'outbox_replay_batch_size': 100,
+        'retry_store_path': None,
+        'retry_policies': {
+            'default': {'max_attempts': 5, 'delay': 60},
+            'CircuitOpenError': {'max_attempts': 10, 'delay': 300},
+            'ConnectionError': {'max_attempts': 10, 'delay': 60},
+            'Timeout': {'max_attempts': 10, 'delay': 60},
+            'KeyError': {'max_attempts': 0, 'delay': 0},
+        },
+        'retry_max_delay': 3600,
     }
 
     def __init__(self, profile=None, config_file=None, config_class=None):
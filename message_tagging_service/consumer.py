@@ -19,27 +19,69 @@
 #
 # Authors: Chenxiong Qi <cqi@redhat.com>
 
+import atexit
+import heapq
 import json
 import logging
+import queue
+import re
 import requests
+import sys
+import threading
+import time
+import yaml
+
+from concurrent.futures import Future
 
 from message_tagging_service import conf
+from message_tagging_service import messaging
+from message_tagging_service import monitor
 from message_tagging_service import tagging_service
-from message_tagging_service.utils import read_rule_defs
+from message_tagging_service.retry_store import RetryStore
+from message_tagging_service.utils import CircuitOpenError
+from message_tagging_service.utils import ExpiringSet
+from message_tagging_service.utils import LazySingleton
+from message_tagging_service.utils import mbs_breaker
+from message_tagging_service.utils import rules_cache
 
 logger = logging.getLogger(__name__)
 
 
+def _create_dedup_set():
+    return ExpiringSet(conf.consumer_dedup_window, conf.consumer_dedup_max_entries)
+
+
+# IDs of received messages, and pairs of module build ID and state of handled
+# messages, in order to drop duplicate messages.
+received_messages = LazySingleton(_create_dedup_set)
+received_build_states = LazySingleton(_create_dedup_set)
+
+
 class UMBMessage(object):
     """Representing a message received from rhmsg message bus
 
+    Message body is decoded only when it is accessed for the first time. Top
+    level fields with a scalar value, e.g. ``state_name``, could be got by
+    :meth:`peek` without decoding the whole body, which is enough to filter
+    out most of messages.
+
     :param msg: the message object received from underlying rhmsg message bus.
     :type msg: ``proton.Message``
     """
 
+    __slots__ = ('_orig_msg', '_raw_body', '_body')
+
+    # A JSON value which is not an object or array.
+    _scalar_regex = r'("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null)'
+    _field_patterns = {}
+    # Strings and brackets, which are scanned to find the nesting level of a
+    # field. Brackets inside strings are skipped with the strings.
+    _token_regex = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
     def __init__(self, msg):
         self._orig_msg = msg
-        self._body = json.loads(msg.body)
+        self._raw_body = None
+        self._body = None
 
     @property
     def id(self):
@@ -51,14 +93,360 @@ class UMBMessage(object):
 
     @property
     def body(self):
+        """Decoded message body
+
+        :raises json.JSONDecodeError: if message body is not valid JSON.
+        """
+        if self._body is None:
+            self._body = json.loads(self._orig_msg.body)
+            self._raw_body = None
         return self._body
 
+    def _get_raw_body(self):
+        if self._raw_body is None:
+            raw_body = self._orig_msg.body
+            if isinstance(raw_body, bytes):
+                raw_body = raw_body.decode('utf-8')
+            self._raw_body = raw_body
+        return self._raw_body
+
+    def peek(self, name):
+        """Get a top level field of message body
+
+        The field is searched in the message body without decoding it, if it
+        appears only once in the body and has a scalar value. Otherwise, the
+        whole body is decoded to get the field.
+
+        :param str name: the field name.
+        :return: the field value, or None if message body has no such field.
+        :raises json.JSONDecodeError: if message body has to be decoded and it
+            is not valid JSON.
+        """
+        if self._body is None:
+            raw_body = self._get_raw_body()
+            key = f'"{name}"'
+            if raw_body.count(key) == 1:
+                pattern = self._field_patterns.get(name)
+                if pattern is None:
+                    pattern = re.compile(re.escape(key) + r'\s*:\s*' + self._scalar_regex)
+                    self._field_patterns[name] = pattern
+                m = pattern.search(raw_body)
+                if m and self._is_top_level_key(raw_body, m.start()):
+                    try:
+                        return json.loads(m.group(1))
+                    except ValueError:
+                        pass
+        body = self.body
+        return body.get(name) if isinstance(body, dict) else None
+
+    @classmethod
+    def _is_top_level_key(cls, raw_body, pos):
+        """Check if the string at pos is a key of the top level object
+
+        The key must be found as a whole string token, i.e. it is not part of
+        another string, and must not be inside a nested object or array.
+        """
+        level = 0
+        for token in cls._token_regex.finditer(raw_body):
+            if token.start() >= pos:
+                return token.start() == pos and level == 1
+            c = token.group()
+            if c in '{[':
+                level += 1
+            elif c in '}]':
+                level -= 1
+        return False
+
     def __repr__(self):
+        body = self._orig_msg.body if self._body is None else self._body
         return "{}(id={}, topic={}, body={})".format(
-            self.__class__.__name__, repr(self.id), repr(self.topic), repr(self.body)
+            self.__class__.__name__, repr(self.id), repr(self.topic), repr(body)
         )
 
 
+def _peek(msg, name):
+    """Get a top level field of message body avoiding decoding it if possible"""
+    if isinstance(msg, UMBMessage):
+        return msg.peek(name)
+    return (msg.body or {}).get(name)
+
+
+class OrderedWorkerPool(object):
+    """Run tasks in worker threads keeping the order of tasks with same key
+
+    Each worker thread has its own queue, and a task is always put into the
+    queue of the same worker by its key. Hence, tasks with the same key are run
+    one by one in the order they are submitted, and tasks with different keys
+    could be run in parallel.
+
+    A task could be submitted with a coalesce key. If another task with the
+    same coalesce key is submitted before it runs, the former task is
+    cancelled, so that only the latest one is run.
+
+    :param int workers: the number of worker threads.
+    :param int max_pending: max number of tasks waiting in the queue of each
+        worker. Submitting a task waits when the queue is full. 0 means no
+        limit.
+    """
+
+    _stop = object()
+
+    def __init__(self, workers, max_pending):
+        self._queues = [queue.Queue(max_pending) for _ in range(workers)]
+        self._lock = threading.Lock()
+        # Map coalesce key to the future of the latest task submitted with it
+        self._latest = {}
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,),
+                             name=f'mts-consumer-worker-{i}', daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is self._stop:
+                return
+            future, func, args, coalesce_key = item
+            if coalesce_key is not None:
+                with self._lock:
+                    superseded = self._latest.get(coalesce_key) is not future
+                    if not superseded:
+                        del self._latest[coalesce_key]
+                if superseded:
+                    logger.info('Skip task %r superseded by a later one.', coalesce_key)
+                    monitor.consumer_dropped_messages_counter.labels('superseded').inc()
+                    future.cancel()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                logger.exception('Failed to run task %r', func)
+                future.set_exception(e)
+
+    def submit(self, key, func, *args, coalesce_key=None):
+        """Submit a task to run in the worker assigned to the key
+
+        :param key: a hashable key. Tasks with the same key are run in order.
+        :param callable func: the task function.
+        :param args: arguments passed to the task function.
+        :param coalesce_key: a hashable key. A task waiting in the queue is
+            cancelled if a task with the same coalesce key is submitted. Tasks
+            with the same coalesce key must be submitted with the same key.
+        :return: a future set with the return value of the task function.
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        if coalesce_key is not None:
+            with self._lock:
+                self._latest[coalesce_key] = future
+        self._queues[hash(key) % len(self._queues)].put((future, func, args, coalesce_key))
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop worker threads after all submitted tasks are run
+
+        :param bool wait: wait for the submitted tasks to finish.
+        """
+        for q in self._queues:
+            q.put(self._stop)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+def get_retry_policy(error):
+    """Find out the retry policy of an error from ``conf.retry_policies``
+
+    Policy is looked up by the class name of the error and its base classes,
+    then of the error causing it, and so on. The default policy is returned
+    if none is found.
+
+    :param Exception error: the error raised from handling a message.
+    :return: a mapping containing max_attempts and delay.
+    :rtype: dict
+    """
+    policies = conf.retry_policies
+    while error is not None:
+        for cls in type(error).__mro__:
+            if cls.__name__ in policies:
+                return policies[cls.__name__]
+        error = error.__cause__
+    return policies.get('default', {'max_attempts': 0, 'delay': 0})
+
+
+class RetryScheduler(object):
+    """Handle messages again later after they failed to be handled
+
+    Messages are kept in a :class:`RetryStore` and scheduled in a heap ordered
+    by the time to handle them again. They are handled one by one in a
+    background thread, so retrying does not block handling new messages. Wait
+    time before each retry and the max number of retries depend on the error
+    raised last time, refer to :func:`get_retry_policy`. A message failing too
+    many times is moved to dead letters.
+
+    Messages stored before, e.g. in last run of the service, are scheduled
+    when the scheduler is created.
+
+    :param store: the store of messages to retry.
+    :type store: :class:`RetryStore`
+    :param callable handle: function to handle a message, which raises error
+        if the message fails to be handled.
+    """
+
+    def __init__(self, store, handle):
+        self.store = store
+        self.handle = handle
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._heap = store.pending()
+        heapq.heapify(self._heap)
+        self._thread = threading.Thread(target=self._run, name='mts-retry-scheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def schedule(self, msg, error, attempts=0, retry_id=None):
+        """Schedule a message failed to be handled
+
+        :param dict msg: the message.
+        :param Exception error: the error raised from handling the message.
+        :param int attempts: the number of times the message has been retried.
+        :param int retry_id: the ID of the message in store, if it is stored.
+        """
+        policy = get_retry_policy(error)
+        if attempts >= policy['max_attempts']:
+            logger.error('Give up handling message %r after %d retries. Moved to '
+                         'dead letters.', msg, attempts)
+            self.store.bury(msg, attempts, str(error), retry_id=retry_id)
+            monitor.dead_letters_counter.inc()
+            return
+
+        delay = min(policy['delay'] * 2 ** attempts, conf.retry_max_delay)
+        due_at = time.time() + delay
+        if retry_id is None:
+            retry_id = self.store.add(msg, attempts, due_at, str(error))
+        else:
+            self.store.update(retry_id, attempts, due_at, str(error))
+        logger.info('Message %r will be handled again in %d seconds.', msg, delay)
+        with self._cond:
+            heapq.heappush(self._heap, (due_at, retry_id))
+            self._cond.notify()
+
+    def _next(self):
+        """Wait for and return the ID of next message to retry"""
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                return heapq.heappop(self._heap)[1]
+        return None
+
+    def _run(self):
+        while True:
+            retry_id = self._next()
+            if retry_id is None:
+                return
+            try:
+                self._retry(retry_id)
+            except Exception:
+                logger.exception('Failed to retry message %s.', retry_id)
+
+    def _retry(self, retry_id):
+        stored = self.store.get(retry_id)
+        if stored is None:
+            return
+        msg, attempts = stored
+        attempts += 1
+        logger.info('Handle message %r again, retry %d.', msg, attempts)
+        try:
+            self.handle(msg)
+        except Exception as e:
+            logger.warning('Failed to handle message %r again: %s', msg, e)
+            monitor.message_retries_counter.labels('failed').inc()
+            self.schedule(msg, e, attempts=attempts, retry_id=retry_id)
+        else:
+            self.store.remove(retry_id)
+            monitor.message_retries_counter.labels('succeeded').inc()
+
+    def stop(self, timeout=None):
+        """Stop retrying. Messages not retried yet are kept in store"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def close(self):
+        """Stop retrying and close the store"""
+        self.stop()
+        self.store.close()
+
+
+def handle_again(mbs_msg):
+    """Handle a MBS message which failed to be handled before
+
+    :param dict mbs_msg: the MBS message.
+    :raises: any error raised from handling the message.
+    """
+    rule_set = tagging_service.load_rule_set()
+    _wait_for_services()
+    tagging_service.handle(rule_set, mbs_msg)
+
+
+def _open_retry_scheduler():
+    if conf.retry_store_path:
+        return RetryScheduler(RetryStore(conf.retry_store_path), handle_again)
+
+
+# Scheduler to handle failed messages again, whose messages are kept in the
+# store opened from conf.retry_store_path.
+_retry_scheduler = LazySingleton(_open_retry_scheduler)
+get_retry_scheduler = _retry_scheduler.get
+close_retry_scheduler = _retry_scheduler.close
+
+
+def _get_coalesce_key(msg):
+    """Return the module build ID and state of a message to coalesce it
+
+    Only a message of the same module build and state supersedes a message
+    waiting to be handled. Messages of different states are all handled, as
+    rules could match a module build in one state but not in another.
+    """
+    build_id = _peek(msg, 'id')
+    if build_id is None:
+        return None
+    return build_id, _peek(msg, 'state_name')
+
+
+def _wait_for_services():
+    """Pause while any service required to handle messages is unavailable
+
+    Blocking here blocks receiving next messages from broker as well, which
+    are left in the broker until the service recovers.
+    """
+    for breaker in (mbs_breaker, tagging_service.koji_breaker):
+        if not breaker.available:
+            logger.warning('%s is unavailable. Pause handling messages.', breaker.name)
+            waited = breaker.wait_until_available()
+            logger.info('Resume handling messages after %.1f seconds.', waited)
+
+
+def _log_decode_error(msg, error):
+    logger.error(f'Cannot decode message body: {msg!r}')
+    logger.error(f'Reason: {str(error)}')
+
+
 def consume(msg):
     """Do the work to tag build if it matches a rule
 
@@ -67,41 +455,110 @@ def consume(msg):
         at least.
     """
 
-    mbs_msg = msg.body
-    if not mbs_msg:
-        logger.error('Cannot find out the embedded MBS message from received '
-                     'message %r.', msg)
+    if msg.id is not None and not received_messages.get().add(msg.id):
+        logger.info('Ignore message %s which is received already.', msg.id)
+        monitor.consumer_dropped_messages_counter.labels('duplicate_message').inc()
+        return
+
+    # Routing fields are checked before the whole message body is decoded, so
+    # that messages which are not handled are dropped as cheap as possible.
+    try:
+        build_id = _peek(msg, 'id')
+        scratch = _peek(msg, 'scratch')
+        build_state = _peek(msg, 'state_name')
+        name = _peek(msg, 'name')
+    except json.JSONDecodeError as e:
+        _log_decode_error(msg, e)
         return
 
-    if mbs_msg.get('scratch'):
-        logger.warning('Ignore scratch build %s', mbs_msg)
+    if scratch:
+        logger.warning('Ignore scratch build %r', msg)
         return
 
-    build_state = mbs_msg.get('state_name')
     if build_state not in conf.build_state_msg_filter:
         logger.warning('The message with build_state: %s is ignored.', build_state)
         return
 
+    if build_id is not None and \
+            not received_build_states.get().add((build_id, build_state)):
+        logger.info('Ignore module build %s in state %s which is handled already.',
+                    build_id, build_state)
+        monitor.consumer_dropped_messages_counter.labels('duplicate_build_state').inc()
+        return
+
+    handled = False
+    try:
+        handled = _consume_build_state(msg, build_state, name)
+    finally:
+        if not handled:
+            # Forget the failed message, so that it is handled if it is
+            # received again.
+            if msg.id is not None:
+                received_messages.get().discard(msg.id)
+            if build_id is not None:
+                received_build_states.get().discard((build_id, build_state))
+
+
+def _consume_build_state(msg, build_state, name):
+    """Handle a message of module build state change
+
+    :return: False if the message failed to be handled, otherwise True,
+        including the message is ignored as no rule could match it.
+    :rtype: bool
+    """
     try:
-        rule_defs = read_rule_defs()
+        rule_set = tagging_service.load_rule_set()
     except requests.exceptions.HTTPError:
         logger.exception('Failed to retrieve rules content.')
-        return
+        return False
+    except (yaml.YAMLError, ValueError):
+        logger.exception('Failed to load rule definitions from rules content.')
+        return False
+
+    if rule_set and not rule_set.admits(build_state, name):
+        logger.info('Ignore module build %s in state %s as no rule could match it.',
+                    name, build_state)
+        return True
+
+    try:
+        mbs_msg = msg.body
+    except json.JSONDecodeError as e:
+        _log_decode_error(msg, e)
+        return False
+    if not mbs_msg:
+        logger.error('Cannot find out the embedded MBS message from received '
+                     'message %r.', msg)
+        return False
 
     nsvc = '{name}:{stream}:{version}:{context}'.format(**mbs_msg)
 
-    # For an empty yaml file, YAML returns None. So, if the remote rule
-    # file is empty, catch this case and skip to handle the tag.
-    if rule_defs is None:
+    # For an empty yaml file, YAML returns None and the rule set has no rule.
+    # So, if the remote rule file is empty, catch this case and skip to handle
+    # the tag.
+    if not rule_set:
         logger.warning(
             'Ignore module build %s as no rule is defined in rule file.', nsvc)
-    else:
+        return True
+
+    while True:
+        _wait_for_services()
         try:
             logger.info('Start to handle build: %s', nsvc)
-            tagging_service.handle(rule_defs, mbs_msg)
+            tagging_service.handle(rule_set, mbs_msg)
+        except CircuitOpenError as e:
+            # A service became unavailable, or another thread is probing it.
+            # Handle the message again after the service is available, rather
+            # than dropping it.
+            logger.warning('Failed to handle build %s: %s. Try again later.', nsvc, e)
+            continue
         except:  # noqa
             logger.exception(f'Failed to handle message {mbs_msg}')
+            retry_scheduler = get_retry_scheduler()
+            if retry_scheduler is not None:
+                retry_scheduler.schedule(mbs_msg, sys.exc_info()[1])
             logger.info('Continue to handle next MBS message ...')
+            return False
+        return True
 
 
 def fedora_messaging_backend():
@@ -110,14 +567,47 @@ def fedora_messaging_backend():
     Fedora infra RabbitMQ message bus
 
     Refer to config file mts.toml for details of how the consumer is configured
-    to receive messages from fedora-messaging.
+    to receive messages from fedora-messaging, including the ``qos`` section
+    to limit the number of messages prefetched from broker.
+
+    If ``conf.fedora_messaging_consumer_workers`` is greater than 1, messages
+    are handled in a pool of workers in the same way as rhmsg backend.
     """
     from fedora_messaging import api
-    api.consume(consume)
+
+    workers = conf.fedora_messaging_consumer_workers
+    if workers <= 1:
+        api.consume(consume)
+        return
+
+    # fedora-messaging runs the callback for one message at a time, and acks
+    # the message and gets next one from broker after the callback returns.
+    # Messages are handed over to workers, so that next message could be
+    # received while previous ones are being handled. The callback waits for
+    # a free worker before returning, so that at most as many messages as
+    # workers are acked but not handled yet.
+    pool = OrderedWorkerPool(workers, 0)
+    slots = threading.BoundedSemaphore(workers)
+
+    def _consumer_wrapper(msg):
+        slots.acquire()
+        future = pool.submit(_peek(msg, 'id'), consume, msg,
+                             coalesce_key=_get_coalesce_key(msg))
+        future.add_done_callback(lambda f: slots.release())
+
+    try:
+        api.consume(_consumer_wrapper)
+    finally:
+        # Finish handling messages which are received already.
+        pool.shutdown(wait=True)
 
 
 def rhmsg_backend():
     """Launch consumer backend based on rhmsg to consume message from UMB"""
+    if conf.rhmsg_consumer_workers > 1:
+        _run_umb_receiver()
+        return
+
     from rhmsg.activemq.consumer import AMQConsumer
 
     def _consumer_wrapper(msg, data=None):
@@ -132,11 +622,11 @@ def rhmsg_backend():
         :param data: any data passed from caller calling ``consumer.consume``.
         """
         logger.debug('Received message: %r', msg)
+        umb_msg = UMBMessage(msg)
         try:
-            consume(UMBMessage(msg))
+            consume(umb_msg)
         except json.JSONDecodeError as e:
-            logger.error(f'Cannot decode message body: {msg.body}')
-            logger.error(f'Reason: {str(e)}')
+            _log_decode_error(umb_msg, e)
 
     consumer = AMQConsumer(
         urls=conf.rhmsg_brokers,
@@ -150,11 +640,71 @@ def rhmsg_backend():
         subscription_name=conf.rhmsg_subscription_name)
 
 
+def _run_umb_receiver():
+    """Receive messages from UMB and handle them in a pool of workers
+
+    Message is handed over to the worker assigned to the module build, so that
+    messages of the same build are handled in order and other builds are
+    handled in parallel. Each message is acknowledged to broker only after it
+    is handled, refer to :class:`UMBReceiver`.
+    """
+    from proton.reactor import Container
+    from message_tagging_service.umb_receiver import UMBReceiver
+
+    # Number of messages waiting in the pool is limited by the credit granted
+    # to broker instead.
+    pool = OrderedWorkerPool(conf.rhmsg_consumer_workers, 0)
+
+    def submit(msg):
+        logger.debug('Received message: %r', msg)
+        umb_msg = UMBMessage(msg)
+        try:
+            key = umb_msg.peek('id')
+            coalesce_key = _get_coalesce_key(umb_msg)
+        except json.JSONDecodeError:
+            # consume logs and drops the message.
+            key = coalesce_key = None
+        return pool.submit(key, consume, umb_msg, coalesce_key=coalesce_key)
+
+    receiver = UMBReceiver(
+        submit, window=conf.rhmsg_consumer_workers * conf.rhmsg_consumer_max_pending)
+    try:
+        Container(receiver).run()
+    finally:
+        # Finish handling messages which are received already.
+        pool.shutdown(wait=True)
+
+
+def _warm_modulemd_cache():
+    try:
+        properties = tagging_service.load_rule_set().properties
+    except Exception:
+        logger.exception('Failed to load rule definitions. Modulemd is loaded '
+                         'into cache without projection.')
+        properties = None
+    tagging_service.warm_modulemd_cache(properties)
+
+
 def run():
     """The entrypoint of MTS to run specific consumer backend
 
     Config file has config to indicate which consumer backend to run.
     """
+    if conf.rules_refresh_interval:
+        rules_cache.start_refresher(conf.rules_refresh_interval)
+    atexit.register(tagging_service.koji_session_pool.close)
+    atexit.register(tagging_service.close_tag_executor)
+    atexit.register(tagging_service.close_task_tracker)
+    # Start to send messages left in outbox in last run
+    if messaging.get_outbox() is not None:
+        atexit.register(messaging.close_outbox)
+    # Start to handle messages failed in last run
+    if get_retry_scheduler() is not None:
+        atexit.register(close_retry_scheduler)
+    if conf.modulemd_store_path:
+        threading.Thread(target=_warm_modulemd_cache,
+                         name='mts-modulemd-cache-warmer', daemon=True).start()
+
     if conf.messaging_backend == 'rhmsg':
         rhmsg_backend()
     elif conf.messaging_backend == 'fedora-messaging':
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""List or handle again messages in dead letters
+
+Messages which keep failing to be handled are moved to dead letters in the
+retry store configured by ``retry_store_path``. Run this module to inspect
+them, and to handle them again after the cause of failure is fixed::
+
+    python3 -m message_tagging_service.dead_letters list
+    python3 -m message_tagging_service.dead_letters replay [ID ...]
+"""
+
+import argparse
+import datetime
+import sys
+
+from message_tagging_service import conf
+from message_tagging_service.consumer import handle_again
+from message_tagging_service.retry_store import RetryStore
+
+
+def list_dead_letters(store):
+    for id_, msg, attempts, error, failed_at in store.dead_letters():
+        failed_at = datetime.datetime.fromtimestamp(failed_at).isoformat(' ', 'seconds')
+        nsvc = '{name}:{stream}:{version}:{context}'.format_map(
+            {key: msg.get(key, '?') for key in ('name', 'stream', 'version', 'context')})
+        print(f'{id_}\t{failed_at}\t{msg.get("state_name")}\t{nsvc}\t'
+              f'retried {attempts} time(s)\t{error}')
+
+
+def replay_dead_letters(store, ids=None):
+    total = len(store.dead_letters()) if not ids else len(ids)
+    handled = store.replay_dead_letters(handle_again, ids=ids)
+    print(f'{handled} of {total} message(s) are handled.')
+    return handled == total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='List or handle again messages in dead letters.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('list', help='List messages in dead letters.')
+    replay_parser = subparsers.add_parser(
+        'replay', help='Handle messages in dead letters again.')
+    replay_parser.add_argument(
+        'ids', metavar='ID', type=int, nargs='*',
+        help='ID of message to handle. All messages are handled if omitted.')
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.error('A command is required.')
+    if not conf.retry_store_path:
+        parser.error('Config retry_store_path is not set.')
+
+    store = RetryStore(conf.retry_store_path)
+    try:
+        if args.command == 'list':
+            list_dead_letters(store)
+            return 0
+        return 0 if replay_dead_letters(store, args.ids or None) else 1
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
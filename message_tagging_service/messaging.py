@@ -19,10 +19,18 @@
 #
 # Authors: Chenxiong Qi <cqi@redhat.com>
 
+import atexit
 import logging
 import json
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
 
 from message_tagging_service import conf, monitor
+from message_tagging_service.outbox import Outbox
+from message_tagging_service.utils import LazySingleton
 
 logger = logging.getLogger(__name__)
 
@@ -31,20 +39,209 @@ def publish(topic, msg):
     """
     Publish a single message to a given backend, and return
 
+    If ``conf.messaging_async_publish`` is enabled, message is put into the
+    publish queue and sent from a background thread, and a future is returned
+    instead.
+
     :param str topic: the topic of the message (e.g. module.state.change)
     :param dict msg: the message contents of the message (typically JSON)
-    :return: the value returned from underlying backend "send" method.
+    :return: the value returned from underlying backend "send" method, or a
+        ``concurrent.futures.Future`` which is set with that value after the
+        message is sent in background, or with the error if the message fails
+        to be sent.
     """
+    handler = _get_publish_handler()
+    if conf.messaging_async_publish:
+        return publish_queue.put(topic, msg)
+    return _publish(handler, topic, msg)
+
+
+def _get_publish_handler():
     backend = conf.messaging_backend
     try:
-        handler = _messaging_backends[backend]['publish']
+        return _messaging_backends[backend]['publish']
     except KeyError:
         raise KeyError(f'No messaging backend found for {backend}')
+
+
+def _publish(handler, topic, msg):
     try:
         return handler(topic, msg)
     except Exception:
-        monitor.messaging_tx_failed_counter.inc()
-        logger.exception('Failed to send message to topic %s: %s', topic, msg)
+        _save_failed_message(topic, msg)
+
+
+def _publish_batch(topic, items):
+    """Send queued messages of the same topic
+
+    Messages are sent together if the backend supports it, otherwise one by
+    one. Each future is set with the result of sending its message.
+
+    :param str topic: the topic of the messages.
+    :param items: list of pairs of message contents and the future.
+    :type items: list[tuple[dict, concurrent.futures.Future]]
+    """
+    backend = _messaging_backends[conf.messaging_backend]
+    publish_batch = backend.get('publish_batch')
+    if publish_batch is None:
+        for msg, future in items:
+            try:
+                future.set_result(backend['publish'](topic, msg))
+            except Exception as e:
+                _save_failed_message(topic, msg)
+                future.set_exception(e)
+        return
+    try:
+        publish_batch(topic, [msg for msg, _ in items])
+    except Exception as e:
+        for msg, future in items:
+            _save_failed_message(topic, msg)
+            future.set_exception(e)
+    else:
+        for _, future in items:
+            future.set_result(None)
+
+
+def _save_failed_message(topic, msg):
+    """Save a message failed to be sent in outbox, if it is configured
+
+    This must be called while handling the error raised from sending message.
+    """
+    monitor.messaging_tx_failed_counter.inc()
+    logger.exception('Failed to send message to topic %s: %s', topic, msg)
+    outbox = get_outbox()
+    if outbox is not None:
+        outbox.put(topic, msg)
+        monitor.outbox_saved_messages_counter.inc()
+        logger.info('Message is saved in outbox to be sent later.')
+
+
+def _open_outbox():
+    if conf.outbox_path:
+        return Outbox(conf.outbox_path)
+
+
+def _replay_outbox(outbox):
+    def send(topic, msg):
+        return _get_publish_handler()(topic, msg)
+
+    sent = outbox.replay(send, batch_size=conf.outbox_replay_batch_size)
+    if sent:
+        monitor.outbox_replayed_messages_counter.inc(sent)
+        logger.info('%d message(s) are sent from outbox.', sent)
+    return sent
+
+
+# Outbox opened from conf.outbox_path to store messages failed to be published.
+# Stored messages are replayed periodically, starting with the messages stored
+# before, e.g. in last run of the service.
+_outbox = LazySingleton(_open_outbox,
+                        task_name='mts-outbox-replayer',
+                        task=_replay_outbox,
+                        interval='outbox_replay_interval',
+                        immediate=True)
+get_outbox = _outbox.get
+close_outbox = _outbox.close
+
+
+def replay_outbox():
+    """Send messages stored in outbox again
+
+    :return: the number of sent messages.
+    :rtype: int
+    """
+    outbox = get_outbox()
+    if outbox is None:
+        return 0
+    return _replay_outbox(outbox)
+
+
+class PublishQueue(object):
+    """Bounded queue of messages which are published from a background thread
+
+    The thread is started when the first message is put into queue. It takes
+    up to ``conf.publish_batch_size`` queued messages at a time, and sends
+    messages of the same topic in a batch if the backend supports it. When
+    queue is full, caller waits until there is room for the message.
+
+    Queued messages are sent before the process exits.
+    """
+
+    _stop = object()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+
+    def _start(self):
+        with self._lock:
+            if self._worker is None:
+                self._queue = queue.Queue(conf.publish_queue_size)
+                self._worker = threading.Thread(
+                    target=self._run, name='mts-publisher', daemon=True)
+                self._worker.start()
+                atexit.register(self.stop)
+            return self._queue
+
+    def put(self, topic, msg):
+        """Put a message into queue to be published
+
+        :param str topic: the topic of the message.
+        :param dict msg: the message contents.
+        :return: a future which is set with the value returned from backend
+            after the message is sent, or with the error if it fails to be
+            sent.
+        :rtype: concurrent.futures.Future
+        """
+        q = self._start()
+        future = Future()
+        q.put((topic, msg, future))
+        monitor.publish_queue_depth.set(q.qsize())
+        return future
+
+    def _run(self):
+        q = self._queue
+        stopped = False
+        while not stopped:
+            batch = [q.get()]
+            while len(batch) < conf.publish_batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            monitor.publish_queue_depth.set(q.qsize())
+            if self._stop in batch:
+                batch.remove(self._stop)
+                stopped = True
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        start = time.monotonic()
+        # Messages are kept in order within each topic.
+        by_topic = {}
+        for topic, msg, future in batch:
+            if future.set_running_or_notify_cancel():
+                by_topic.setdefault(topic, []).append((msg, future))
+        for topic, items in by_topic.items():
+            _publish_batch(topic, items)
+        monitor.publish_flush_latency.observe(time.monotonic() - start)
+
+    def stop(self, timeout=None):
+        """Send all queued messages and stop the background thread
+
+        :param float timeout: seconds to wait for queued messages to be sent.
+        """
+        with self._lock:
+            worker, self._worker = self._worker, None
+            if worker is None:
+                return
+            self._queue.put(self._stop)
+        worker.join(timeout)
+
+
+publish_queue = PublishQueue()
 
 
 def _fedora_messaging_publish(topic, msg):
@@ -60,6 +257,111 @@ def _fedora_messaging_publish(topic, msg):
         api.publish(fm_msg)
 
 
+class RhmsgProducer(object):
+    """Long-lived producer to send messages to Unified Message Bus
+
+    Connection to broker is established when the first message is sent, and
+    then it is shared to send all subsequent messages. Brokers in
+    ``conf.rhmsg_brokers`` are tried in order to connect. If a message cannot
+    be sent, producer connects to broker again and retries once.
+
+    Messages passed to :meth:`send` together are sent in a row and
+    acknowledged by broker together. Sending is serialized, so the producer
+    could be used by multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self._senders = {}
+        self._close_at_exit = False
+
+    def _connect(self):
+        from proton import SSLDomain
+        from proton.utils import BlockingConnection
+
+        ssl_domain = SSLDomain(SSLDomain.MODE_CLIENT)
+        ssl_domain.set_credentials(
+            conf.rhmsg_certificate, conf.rhmsg_private_key, None)
+        ssl_domain.set_trusted_ca_db(conf.rhmsg_ca_cert)
+        ssl_domain.set_peer_authentication(SSLDomain.VERIFY_PEER)
+
+        if not conf.rhmsg_brokers:
+            raise ValueError('No broker is configured in rhmsg_brokers.')
+
+        error = None
+        for url in conf.rhmsg_brokers:
+            try:
+                connection = BlockingConnection(
+                    url, ssl_domain=ssl_domain, timeout=conf.requests_timeout)
+            except Exception as e:
+                logger.warning('Failed to connect to broker %s: %s', url, e)
+                error = e
+            else:
+                logger.info('Connected to broker %s to send messages.', url)
+                if not self._close_at_exit:
+                    atexit.register(self.close)
+                    self._close_at_exit = True
+                return connection
+        raise error
+
+    def _send(self, address, messages):
+        from proton import Delivery, Link
+        from proton.utils import SendException
+
+        if self._connection is None:
+            self._connection = self._connect()
+        sender = self._senders.get(address)
+        if sender is None:
+            sender = self._connection.create_sender(address)
+            self._senders[address] = sender
+        # Do not wait for each message to be settled before sending next one,
+        # so that all messages are acknowledged in one round-trip.
+        deliveries = [sender.link.send(msg) for msg in messages]
+        self._connection.wait(
+            lambda: all(dlv.settled or dlv.link.snd_settle_mode == Link.SND_SETTLED
+                        for dlv in deliveries),
+            msg=f'Sending {len(deliveries)} message(s) to {address}',
+            timeout=conf.requests_timeout)
+        for dlv in deliveries:
+            if dlv.remote_state in (Delivery.REJECTED, Delivery.RELEASED):
+                raise SendException(dlv.remote_state)
+
+    def _close(self):
+        connection, self._connection = self._connection, None
+        self._senders = {}
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                logger.warning('Failed to close connection to broker.', exc_info=True)
+
+    def send(self, address, *messages):
+        """Send messages to an address
+
+        :param str address: the address to send messages to, e.g.
+            ``topic://VirtualTopic.eng.mts.build.tag.requested``.
+        :param messages: messages to send.
+        :type messages: proton.Message
+        """
+        with self._lock:
+            try:
+                self._send(address, messages)
+            except Exception:
+                logger.warning('Failed to send message to %s. Connect to broker '
+                               'again and retry.', address, exc_info=True)
+                self._close()
+                self._send(address, messages)
+
+    def close(self):
+        """Close connection to broker"""
+        with self._lock:
+            self._close()
+
+
+rhmsg_producer = RhmsgProducer()
+
+
 def _rhmsg_publish(topic, msg):
     """Send message to Unified Message Bus
 
@@ -67,27 +369,32 @@ def _rhmsg_publish(topic, msg):
         ``build.tagged``.
     :param dict msg: the message that will be sent.
     """
+    _rhmsg_publish_batch(topic, [msg])
+
+
+def _rhmsg_publish_batch(topic, msgs):
+    """Send messages of the same topic to Unified Message Bus together
+
+    :param str topic: the topic where messages will be sent to.
+    :param msgs: the messages that will be sent.
+    :type msgs: list[dict]
+    """
     import proton
-    from rhmsg.activemq.producer import AMQProducer
 
-    producer_config = {
-        'urls': conf.rhmsg_brokers,
-        'certificate': conf.rhmsg_certificate,
-        'private_key': conf.rhmsg_private_key,
-        'trusted_certificates': conf.rhmsg_ca_cert,
-    }
-    with AMQProducer(**producer_config) as producer:
-        topic = f'{conf.rhmsg_topic_prefix.rstrip(".")}.{topic}'
-        producer.through_topic(topic)
+    topic = f'{conf.rhmsg_topic_prefix.rstrip(".")}.{topic}'
 
+    outgoing_msgs = []
+    for msg in msgs:
         outgoing_msg = proton.Message()
         outgoing_msg.body = json.dumps(msg)
-        if conf.dry_run:
-            logger.info('DRY-RUN: AMQProducer.send(%s) through topic %s',
-                        outgoing_msg, topic)
-        else:
+        outgoing_msgs.append(outgoing_msg)
+    if conf.dry_run:
+        for outgoing_msg in outgoing_msgs:
+            logger.info('DRY-RUN: send %s through topic %s', outgoing_msg, topic)
+    else:
+        for outgoing_msg in outgoing_msgs:
             logger.debug('Send message: %s', outgoing_msg)
-            producer.send(outgoing_msg)
+        rhmsg_producer.send(f'topic://{topic}', *outgoing_msgs)
 
 
 _messaging_backends = {
@@ -95,6 +402,7 @@ _messaging_backends = {
         'publish': _fedora_messaging_publish
     },
     'rhmsg': {
-        'publish': _rhmsg_publish
+        'publish': _rhmsg_publish,
+        'publish_batch': _rhmsg_publish_batch,
     }
 }
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import time
+
+from message_tagging_service.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class ModulemdStore(SqliteStore):
+    """Persistent local store of modulemd content of module builds
+
+    Modulemd content is stored in a SQLite database file, which is kept across
+    service restarts, so that modulemd retrieved from MBS before is available
+    without requesting MBS again. Total size of stored content is kept within
+    a limit by :meth:`compact`, which removes least recently used content.
+
+    :param str path: the database file path.
+    :param int max_size: max total size in bytes of stored content.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS modulemd ('
+        'build_id INTEGER PRIMARY KEY, '
+        'content TEXT NOT NULL, '
+        'size INTEGER NOT NULL, '
+        'accessed_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS modulemd_accessed_at ON modulemd (accessed_at)',
+    )
+    count_query = 'SELECT COUNT(*) FROM modulemd'
+
+    def __init__(self, path, max_size):
+        super().__init__(path)
+        self.max_size = max_size
+
+    @property
+    def size(self):
+        """Total size in bytes of stored content"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM modulemd').fetchone()[0]
+
+    def get(self, build_id):
+        """Get modulemd content of a module build
+
+        :param int build_id: the module build ID.
+        :return: the modulemd content, or None if it is not stored.
+        :rtype: str
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT content FROM modulemd WHERE build_id = ?', (build_id,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                'UPDATE modulemd SET accessed_at = ? WHERE build_id = ?',
+                (time.time(), build_id))
+            return row[0]
+
+    def put(self, build_id, content):
+        """Store modulemd content of a module build
+
+        :param int build_id: the module build ID.
+        :param str content: the modulemd content.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO modulemd (build_id, content, size, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (build_id, content, len(content.encode('utf-8')), time.time()))
+
+    def recent(self, limit):
+        """Return recently used content
+
+        :param int limit: max number of entries to return.
+        :return: list of pairs of module build ID and modulemd content, from
+            the most recently used one.
+        :rtype: list[tuple[int, str]]
+        """
+        with self._lock:
+            return self._conn.execute(
+                'SELECT build_id, content FROM modulemd '
+                'ORDER BY accessed_at DESC LIMIT ?', (limit,)).fetchall()
+
+    def compact(self):
+        """Remove least recently used content exceeding the size limit
+
+        :return: the number of removed entries.
+        :rtype: int
+        """
+        with self._lock:
+            with self._conn:
+                removed = 0
+                total = self._conn.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM modulemd').fetchone()[0]
+                if total > self.max_size:
+                    rows = self._conn.execute(
+                        'SELECT build_id, size FROM modulemd ORDER BY accessed_at').fetchall()
+                    build_ids = []
+                    for build_id, size in rows:
+                        if total <= self.max_size:
+                            break
+                        build_ids.append((build_id,))
+                        total -= size
+                    self._conn.executemany('DELETE FROM modulemd WHERE build_id = ?', build_ids)
+                    removed = len(build_ids)
+            if removed:
+                # Return the free space to file system.
+                self._conn.execute('VACUUM')
+        if removed:
+            logger.info('%d modulemd(s) are removed from store.', removed)
+        return removed
@@ -30,6 +30,8 @@ from prometheus_client import CollectorRegistry
 from prometheus_client import ProcessCollector
 from prometheus_client import multiprocess
 from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
 from prometheus_client import generate_latest
 
 if not os.environ.get('prometheus_multiproc_dir'):
@@ -46,6 +48,12 @@ failed_tag_build_requests_counter = Counter(
     registry=registry
 )
 
+koji_logins_counter = Counter(
+    'koji_logins',
+    'The number of times Koji session is logged in.',
+    registry=registry
+)
+
 matched_module_builds_counter = Counter(
     'matched_module_builds',
     'The number of module builds which are matched rule(s) to be tagged.',
@@ -58,6 +66,115 @@ messaging_tx_failed_counter = Counter(
     registry=registry
 )
 
+outbox_saved_messages_counter = Counter(
+    'outbox_saved_messages',
+    'The number of messages saved in outbox after failed to be sent to bus.',
+    registry=registry
+)
+
+outbox_replayed_messages_counter = Counter(
+    'outbox_replayed_messages',
+    'The number of messages sent to bus from outbox.',
+    registry=registry
+)
+
+consumer_dropped_messages_counter = Counter(
+    'consumer_dropped_messages',
+    'The number of received messages dropped as duplicate or superseded.',
+    ['reason'],
+    registry=registry
+)
+
+message_retries_counter = Counter(
+    'message_retries',
+    'The number of messages handled again after failure, by the result.',
+    ['result'],
+    registry=registry
+)
+
+dead_letters_counter = Counter(
+    'dead_letters',
+    'The number of messages moved to dead letters after failed to be handled.',
+    registry=registry
+)
+
+cache_hits_counter = Counter(
+    'cache_hits',
+    'The number of lookups found in cache.',
+    ['cache'],
+    registry=registry
+)
+
+cache_misses_counter = Counter(
+    'cache_misses',
+    'The number of lookups not found in cache.',
+    ['cache'],
+    registry=registry
+)
+
+cache_evictions_counter = Counter(
+    'cache_evictions',
+    'The number of entries removed from cache due to size limit or expiration.',
+    ['cache'],
+    registry=registry
+)
+
+coalesced_requests_counter = Counter(
+    'coalesced_requests',
+    'The number of requests served by another concurrent request of the same key.',
+    ['call'],
+    registry=registry
+)
+
+koji_tracked_tasks = Gauge(
+    'koji_tracked_tasks',
+    'The number of requested tagBuild tasks not finished yet.',
+    registry=registry,
+    multiprocess_mode='livesum'
+)
+
+koji_task_latency = Histogram(
+    'koji_task_latency_seconds',
+    'Time from requesting a tagBuild task to finding out it is finished, by task state.',
+    ['state'],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf')),
+    registry=registry
+)
+
+mbs_request_latency = Histogram(
+    'mbs_request_latency_seconds',
+    'Time spent to retrieve a module build from MBS, including retries.',
+    registry=registry
+)
+
+throttle_wait_time = Histogram(
+    'throttle_wait_seconds',
+    'Time spent to wait for rate limit and concurrency limit before calling a service.',
+    ['throttle'],
+    registry=registry
+)
+
+circuit_breaker_open = Gauge(
+    'circuit_breaker_open',
+    'Whether the circuit breaker of a service is open (1) or not (0).',
+    ['service'],
+    registry=registry,
+    multiprocess_mode='livesum'
+)
+
+publish_queue_depth = Gauge(
+    'publish_queue_depth',
+    'The number of messages waiting in queue to be sent to bus.',
+    registry=registry,
+    multiprocess_mode='livesum'
+)
+
+publish_flush_latency = Histogram(
+    'publish_flush_latency_seconds',
+    'Time spent to send a batch of queued messages to bus.',
+    registry=registry
+)
+
 
 def generate_metrics_report():
     return generate_latest(registry)
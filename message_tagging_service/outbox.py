@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import json
+import logging
+import time
+
+from message_tagging_service.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(SqliteStore):
+    """Durable local store of messages which are failed to be published
+
+    Messages are stored in a SQLite database file, so that they are not lost
+    when broker is not available or the service crashes before they are sent.
+    Stored messages are sent again in the order they are stored by
+    :meth:`replay`.
+
+    :param str path: the database file path.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS outbox ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'topic TEXT NOT NULL, '
+        'body TEXT NOT NULL, '
+        'created_at REAL NOT NULL, '
+        'attempts INTEGER NOT NULL DEFAULT 0)',
+    )
+    count_query = 'SELECT COUNT(*) FROM outbox'
+    durable = True
+
+    def put(self, topic, msg):
+        """Store a message
+
+        :param str topic: the topic of the message.
+        :param dict msg: the message contents.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO outbox (topic, body, created_at) VALUES (?, ?, ?)',
+                (topic, json.dumps(msg), time.time()))
+
+    def replay(self, send, batch_size=100):
+        """Send stored messages again
+
+        Messages are sent in the order they are stored. Successfully sent
+        message is removed from outbox. Replay stops at the first message
+        which fails to be sent, because the broker is probably not recovered
+        yet, and that message is tried first in next replay.
+
+        :param callable send: function to send a message, which accepts the
+            topic and the message contents and raises error if the message
+            cannot be sent.
+        :param int batch_size: max number of messages to send in one query of
+            the stored messages.
+        :return: the number of sent messages.
+        :rtype: int
+        """
+        sent = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT id, topic, body FROM outbox ORDER BY id LIMIT ?',
+                    (batch_size,)).fetchall()
+            if not rows:
+                return sent
+            for msg_id, topic, body in rows:
+                try:
+                    send(topic, json.loads(body))
+                except Exception:
+                    logger.warning('Failed to send message %s to topic %s from outbox.',
+                                   msg_id, topic, exc_info=True)
+                    with self._lock, self._conn:
+                        self._conn.execute(
+                            'UPDATE outbox SET attempts = attempts + 1 WHERE id = ?',
+                            (msg_id,))
+                    return sent
+                with self._lock, self._conn:
+                    self._conn.execute('DELETE FROM outbox WHERE id = ?', (msg_id,))
+                sent += 1
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import json
+import logging
+import time
+
+from message_tagging_service.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class RetryStore(SqliteStore):
+    """Durable local store of messages to be handled again
+
+    Messages failed to be handled are stored in a SQLite database file with
+    the time to handle them again, so that they are not lost when the service
+    is restarted. Messages which keep failing are moved to dead letters, which
+    could be inspected by :meth:`dead_letters` and handled again by
+    :meth:`replay_dead_letters`.
+
+    :param str path: the database file path.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS retries ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'body TEXT NOT NULL, '
+        'attempts INTEGER NOT NULL, '
+        'due_at REAL NOT NULL, '
+        'error TEXT)',
+        'CREATE TABLE IF NOT EXISTS dead_letters ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'body TEXT NOT NULL, '
+        'attempts INTEGER NOT NULL, '
+        'error TEXT, '
+        'failed_at REAL NOT NULL)',
+    )
+    count_query = 'SELECT COUNT(*) FROM retries'
+    durable = True
+
+    def add(self, msg, attempts, due_at, error=None):
+        """Store a message to be handled again
+
+        :param dict msg: the message.
+        :param int attempts: the number of times the message has been retried.
+        :param float due_at: the time to handle the message again.
+        :param str error: the reason of last failure.
+        :return: the ID of stored message.
+        :rtype: int
+        """
+        with self._lock, self._conn:
+            return self._conn.execute(
+                'INSERT INTO retries (body, attempts, due_at, error) VALUES (?, ?, ?, ?)',
+                (json.dumps(msg), attempts, due_at, error)).lastrowid
+
+    def update(self, retry_id, attempts, due_at, error=None):
+        """Update the retry schedule of a stored message"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE retries SET attempts = ?, due_at = ?, error = ? WHERE id = ?',
+                (attempts, due_at, error, retry_id))
+
+    def get(self, retry_id):
+        """Get a stored message
+
+        :param int retry_id: the ID of stored message.
+        :return: the message and the number of times it has been retried, or
+            None if it is not stored.
+        :rtype: tuple[dict, int]
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT body, attempts FROM retries WHERE id = ?', (retry_id,)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def remove(self, retry_id):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM retries WHERE id = ?', (retry_id,))
+
+    def pending(self):
+        """Return the schedule of all stored messages
+
+        :return: list of pairs of the time to handle a message again and the
+            ID of stored message.
+        :rtype: list[tuple[float, int]]
+        """
+        with self._lock:
+            return self._conn.execute('SELECT due_at, id FROM retries').fetchall()
+
+    def bury(self, msg, attempts, error=None, retry_id=None):
+        """Move a message to dead letters
+
+        :param dict msg: the message.
+        :param int attempts: the number of times the message has been retried.
+        :param str error: the reason of last failure.
+        :param int retry_id: the ID of stored message to be removed, if the
+            message is stored.
+        """
+        with self._lock, self._conn:
+            if retry_id is not None:
+                self._conn.execute('DELETE FROM retries WHERE id = ?', (retry_id,))
+            self._conn.execute(
+                'INSERT INTO dead_letters (body, attempts, error, failed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (json.dumps(msg), attempts, error, time.time()))
+
+    def dead_letters(self):
+        """Return all dead letters
+
+        :return: list of tuples of ID, message, number of retries, reason of
+            last failure and the time when it is moved to dead letters.
+        :rtype: list[tuple]
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, body, attempts, error, failed_at FROM dead_letters '
+                'ORDER BY id').fetchall()
+        return [(id_, json.loads(body), attempts, error, failed_at)
+                for id_, body, attempts, error, failed_at in rows]
+
+    def replay_dead_letters(self, handle, ids=None):
+        """Handle dead letters again
+
+        Successfully handled message is removed from dead letters. A message
+        failed again is kept with the new reason of failure.
+
+        :param callable handle: function to handle a message, which raises
+            error if the message fails to be handled.
+        :param ids: IDs of dead letters to handle. If omitted, all dead
+            letters are handled.
+        :type ids: list[int] or None
+        :return: the number of successfully handled messages.
+        :rtype: int
+        """
+        handled = 0
+        for id_, msg, _, _, _ in self.dead_letters():
+            if ids is not None and id_ not in ids:
+                continue
+            try:
+                handle(msg)
+            except Exception as e:
+                logger.warning('Failed to handle dead letter %s again.', id_, exc_info=True)
+                with self._lock, self._conn:
+                    self._conn.execute(
+                        'UPDATE dead_letters SET error = ?, failed_at = ? WHERE id = ?',
+                        (str(e), time.time(), id_))
+                continue
+            with self._lock, self._conn:
+                self._conn.execute('DELETE FROM dead_letters WHERE id = ?', (id_,))
+            handled += 1
+        return handled
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sqlite3
+import threading
+
+
+class SqliteStore(object):
+    """Base class of local stores kept in a SQLite database file
+
+    Database is opened in WAL mode, and the connection is shared by threads
+    with a lock. Subclasses define the tables in ``schema``, and access the
+    database by ``self._conn`` while holding ``self._lock``.
+
+    :param str path: the database file path.
+    """
+
+    # SQL statements to create tables and indexes
+    schema = ()
+    # SQL statement to count records returned by len()
+    count_query = None
+    # Sync each transaction to disk, so that nothing is lost even if the host
+    # crashes.
+    durable = False
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            if self.durable:
+                self._conn.execute('PRAGMA synchronous=FULL')
+            for statement in self.schema:
+                self._conn.execute(statement)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(self.count_query).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
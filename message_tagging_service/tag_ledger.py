@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+import time
+
+from message_tagging_service.sqlite_store import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+
+class TagLedger(SqliteStore):
+    """Persistent local record of requested tagBuild tasks
+
+    Each pair of build NVR and tag, which is requested to tag successfully, is
+    recorded with the task ID returned from Koji in a SQLite database file. A
+    pair recorded within the retention period does not have to be requested
+    again, unless its task failed. Records older than that are removed by
+    :meth:`purge`.
+
+    :param str path: the database file path.
+    :param float retention: seconds to keep a record.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS tag_requests ('
+        'nvr TEXT NOT NULL, '
+        'tag TEXT NOT NULL, '
+        'task_id INTEGER NOT NULL, '
+        'requested_at REAL NOT NULL, '
+        'PRIMARY KEY (nvr, tag))',
+        'CREATE INDEX IF NOT EXISTS tag_requests_requested_at ON tag_requests (requested_at)',
+    )
+    count_query = 'SELECT COUNT(*) FROM tag_requests'
+
+    def __init__(self, path, retention):
+        super().__init__(path)
+        self.retention = retention
+
+    def get(self, nvr, tag):
+        """Get the task ID of a recorded tag request
+
+        :param str nvr: the build NVR.
+        :param str tag: the tag name.
+        :return: the task ID, or None if the pair is not recorded within the
+            retention period.
+        :rtype: int
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT task_id FROM tag_requests '
+                'WHERE nvr = ? AND tag = ? AND requested_at > ?',
+                (nvr, tag, time.time() - self.retention)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, nvr, tag, task_id):
+        """Record a tag request
+
+        :param str nvr: the build NVR.
+        :param str tag: the tag name.
+        :param int task_id: the tagBuild task ID returned from Koji.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO tag_requests (nvr, tag, task_id, requested_at) '
+                'VALUES (?, ?, ?, ?)',
+                (nvr, tag, task_id, time.time()))
+
+    def remove(self, nvr, tag, task_id=None):
+        """Remove the record of a tag request, e.g. when its task failed
+
+        :param str nvr: the build NVR.
+        :param str tag: the tag name.
+        :param int task_id: if set, the record is removed only if it is of
+            this task, rather than of a task requested again later.
+        """
+        with self._lock, self._conn:
+            if task_id is None:
+                self._conn.execute(
+                    'DELETE FROM tag_requests WHERE nvr = ? AND tag = ?', (nvr, tag))
+            else:
+                self._conn.execute(
+                    'DELETE FROM tag_requests WHERE nvr = ? AND tag = ? AND task_id = ?',
+                    (nvr, tag, task_id))
+
+    def purge(self):
+        """Remove records older than the retention period
+
+        :return: the number of removed records.
+        :rtype: int
+        """
+        with self._lock, self._conn:
+            removed = self._conn.execute(
+                'DELETE FROM tag_requests WHERE requested_at <= ?',
+                (time.time() - self.retention,)).rowcount
+        if removed:
+            logger.info('%d tag request(s) are removed from ledger.', removed)
+        return removed
@@ -26,20 +26,45 @@ import koji_cli.lib
 import logging
 import re
 import requests
+import threading
+import time
 import yaml
 
 from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 from message_tagging_service import conf
 from message_tagging_service import messaging
 from message_tagging_service import monitor
+from message_tagging_service.utils import CircuitBreaker
+from message_tagging_service.utils import CircuitOpenError
+from message_tagging_service.utils import LRUCache
+from message_tagging_service.utils import LazySingleton
+from message_tagging_service.utils import Throttle
+from message_tagging_service.utils import get_modulemd_store
+from message_tagging_service.utils import get_tag_ledger
 from message_tagging_service.utils import is_file_readable
+from message_tagging_service.utils import load_modulemd
 from message_tagging_service.utils import retrieve_modulemd_content
+from message_tagging_service.utils import rules_cache
 
 logger = logging.getLogger(__name__)
 
-TagBuildResult = namedtuple('TagBuildResult', ['tag_name', 'task_id', 'error'])
+TagBuildResult = namedtuple('TagBuildResult', ['tag_name', 'task_id', 'error', 'skipped'])
+# A tag is not skipped unless it is requested already.
+TagBuildResult.__new__.__defaults__ = (False,)
+
+# Koji task states which mean a tagBuild task did not tag the build
+FAILED_TASK_STATES = ('FAILED', 'CANCELED')
+
+# A regular expression matching only a literal module name, e.g. ^ant$ or
+# ^python\-ant$. Only punctuation characters could be escaped.
+LITERAL_NAME_REGEX = re.compile(r'\^((?:[\w-]|\\[^\w\s])+)\$')
+
+# Module properties which could be included in MBS message as well.
+EVENT_PROPERTIES = ('name', 'stream', 'version', 'context', 'development')
 
 
 class RuleMatch(object):
@@ -70,6 +95,10 @@ class RuleDef(object):
     """Represent a rule definition
 
     Refer to https://pagure.io/modularity/blob/master/f/drafts/module-tagging-service/format.md
+
+    Regular expressions used in the rule are compiled when the definition is
+    created, and matching a module does not change the definition, so a single
+    object could be shared and reused to match any number of modules.
     """
 
     def __init__(self, data):
@@ -77,10 +106,70 @@ class RuleDef(object):
             if name not in data:
                 raise ValueError(f'Rule definition does not have property {name}.')
 
-        self.data = data
-
-        self._property_matches = []
-        self._regex_group_dicts = []
+        # YAML allows to read a empty section like:
+        # - name: xxx
+        #   rule:
+        #   destination: xxx
+        # In this case, parsed YAML dict has key/value: {'rule': None}
+        rule = data.get('rule') or {}
+        if not isinstance(rule, dict):
+            raise ValueError(f'Rule definition {data["id"]} has an invalid rule: {rule!r}')
+        if not isinstance(data['destinations'], str):
+            raise ValueError(
+                f'Rule definition {data["id"]} has invalid destinations: '
+                f'{data["destinations"]!r}')
+
+        # Build state is not a modulemd property. Rule definitions are grouped
+        # by build state instead, so it is not kept in the match criteria.
+        rule = dict(rule)
+        self.build_state = rule.pop('build_state', None)
+
+        self.data = dict(data, rule=rule)
+
+        self._patterns = {}
+        self._compile_patterns(rule)
+
+        # Modulemd properties checked by this rule. Property scratch is
+        # ignored by match.
+        self.properties = frozenset(name for name in rule if name != 'scratch')
+        # Whether every property is checked by regular expressions, whose
+        # match does not depend on the type of property value.
+        self._regex_only = all(
+            isinstance(value, str) or
+            (isinstance(value, list) and all(isinstance(v, str) for v in value))
+            for name, value in rule.items() if name not in ('scratch', 'development'))
+        # Module names which could be matched by this rule, if the name is
+        # matched by anchored literals only. None means any name.
+        self.literal_names = self._get_literal_names(rule.get('name'))
+
+    @staticmethod
+    def _get_literal_names(criteria):
+        if isinstance(criteria, str):
+            criteria = [criteria]
+        if not isinstance(criteria, list):
+            return None
+        names = set()
+        for regex in criteria:
+            m = isinstance(regex, str) and LITERAL_NAME_REGEX.fullmatch(regex)
+            if not m:
+                return None
+            names.add(re.sub(r'\\(.)', r'\1', m.group(1)))
+        return frozenset(names)
+
+    def _compile_patterns(self, criteria):
+        if isinstance(criteria, dict):
+            for value in criteria.values():
+                self._compile_patterns(value)
+        elif isinstance(criteria, list):
+            for value in criteria:
+                self._compile_patterns(value)
+        elif isinstance(criteria, str) and criteria not in self._patterns:
+            try:
+                self._patterns[criteria] = re.compile(criteria)
+            except re.error as e:
+                raise ValueError(
+                    f'Rule definition {self.id} has invalid regular expression '
+                    f'{criteria!r}: {str(e)}')
 
     @property
     def id(self):
@@ -99,20 +188,26 @@ class RuleDef(object):
         """Return property rule of definition
 
         Note that, a rule definition may or may not have match criteria in rule
-        property. If no rule is defined, None will be returned.
+        property. If no rule is defined, an empty dict is returned.
         """
-        # YAML allows to read a empty section like:
-        # - name: xxx
-        #   rule:
-        #   destination: xxx
-        # In this case, parsed YAML dict has key/value: {'rule': None}
-        return self.data.get('rule', {})
+        return self.data['rule']
 
     @property
     def destinations(self):
         return self.data['destinations']
 
-    def find_diff_value(self, regex, mmd_property_value):
+    def can_match_with(self, properties):
+        """Check if this rule could be matched with only the given properties
+
+        :param properties: names of available modulemd properties.
+        :type properties: set[str]
+        :return: True if all properties checked by this rule are available,
+            and values of them could be checked regardless of their type.
+        :rtype: bool
+        """
+        return self._regex_only and self.properties <= properties
+
+    def find_diff_value(self, regex, mmd_property_value, group_dicts=None):
         """Match a property value with expected regular expression
 
         :param str regex: the regular expression to try to match property value.
@@ -120,6 +215,8 @@ class RuleDef(object):
             value, or a list of values for example the dependencies like
             ``{'dependencies': {'buildrequires': {'platform': ['f28']}}}``.
         :type mmd_property_value: list or str
+        :param list group_dicts: if specified, named groups captured by the
+            regular expression are appended to it.
         :return: True if given regular expression matches the single value, or
             match one of the list of values. If not match anything, False is
             returned.
@@ -137,16 +234,17 @@ class RuleDef(object):
                 if regex == value:
                     return True
                 continue
-            match = re.search(regex, str(value))
+            pattern = self._patterns.get(regex) or re.compile(regex)
+            match = pattern.search(str(value))
             if match:
                 matches_found = True
                 group_dict = match.groupdict()
-                if group_dict:
-                    self._regex_group_dicts.append(group_dict)
+                if group_dict and group_dicts is not None:
+                    group_dicts.append(group_dict)
 
         return matches_found
 
-    def find_diff_list(self, match_candidates, mmd_property_value):
+    def find_diff_list(self, match_candidates, mmd_property_value, group_dicts=None):
         """Find out if module property value matches one of values defined in rule
 
         :param match_candidates: list of regular expressions in rule definition
@@ -154,18 +252,19 @@ class RuleDef(object):
             value in modulemd.
         :type match_candidates: list[str]
         :param str mmd_property_value: modulemd's property value to check.
+        :param list group_dicts: collect captured named groups if specified.
         :return: True if match, otherwise False.
         :rtype: bool
         """
         logger.debug('Checking %s against regular expressions %r',
                      mmd_property_value, match_candidates)
         for regex in match_candidates:
-            if self.find_diff_value(regex, mmd_property_value):
+            if self.find_diff_value(regex, mmd_property_value, group_dicts):
                 return True
         return False
 
-    def find_diff_dict(self, rule_dict, check_dict):
-        """Check if rule matches modulemd values recursively for dict type
+    def find_diff_dict(self, rule_dict, check_dict, group_dicts=None):
+        r"""Check if rule matches modulemd values recursively for dict type
 
         Modulemd dependencies is a dict, which could be::
 
@@ -185,6 +284,7 @@ class RuleDef(object):
 
         :param dict rule_dict:
         :param dict check_dict:
+        :param list group_dicts: collect captured named groups if specified.
         :return: True if match, otherwise False.
         :rtype: bool
         """  # noqa
@@ -195,11 +295,11 @@ class RuleDef(object):
                 logger.debug("'%s' is not found in module", key)
                 return False
             if isinstance(value, dict):
-                match = self.find_diff_dict(value, new_check_dict)
+                match = self.find_diff_dict(value, new_check_dict, group_dicts)
             elif isinstance(value, list):
-                match = self.find_diff_list(value, new_check_dict)
+                match = self.find_diff_list(value, new_check_dict, group_dicts)
             else:
-                match = self.find_diff_value(value, new_check_dict)
+                match = self.find_diff_value(value, new_check_dict, group_dicts)
             if not match:
                 # As long as one of rule criteria does not match module
                 # property, the whole dict rule match fails.
@@ -216,9 +316,11 @@ class RuleDef(object):
         :return: a RuleMatch object to indicate whether modulemd matches the rule.
         :rtype: :class:`RuleMatch`
         """
-        rule = self.rule
+        # Values of named groups are collected per call rather than on the
+        # object, so that concurrent matches do not interfere with each other.
+        regex_group_dicts = []
 
-        for property, expected in rule.items():
+        for property, expected in self.rule.items():
             # Both scratch and development have default value to compare with
             # expected in rule definition.
 
@@ -232,58 +334,51 @@ class RuleDef(object):
                 mmd_value = modulemd["data"].get(property, False)
                 if expected == mmd_value:
                     logger.debug('Rule/Value: %s: %s. Matched.', property, expected)
-                    self._property_matches.append(True)
                 else:
                     logger.debug('Rule/Value: %s: %s. Not Matched. Real value: %s',
                                  property, expected, mmd_value)
-                    self._property_matches.append(False)
+                    return RuleMatch(False)
 
             else:
                 # Now check rules that have regex
                 value_to_check = modulemd["data"].get(property)
                 if value_to_check is None:
                     logger.debug('%s is not match. Modulemd does not have %s', property, property)
-                    self._property_matches.append(False)
+                    return RuleMatch(False)
 
                 elif isinstance(expected, dict):
                     if isinstance(value_to_check, list):
                         v = value_to_check[0]
                     else:
                         v = value_to_check
-                    if self.find_diff_dict(expected, v):
+                    if self.find_diff_dict(expected, v, regex_group_dicts):
                         logger.debug('Rule/Value: %s: %r. Matched.', property, expected)
-                        self._property_matches.append(True)
                     else:
                         logger.debug('Rule/Value: %s: %r. Not Matched. Real value: %r',
                                      property, expected, v)
-                        self._property_matches.append(False)
+                        return RuleMatch(False)
 
                 elif isinstance(expected, list):
-                    if self.find_diff_list(expected, value_to_check):
+                    if self.find_diff_list(expected, value_to_check, regex_group_dicts):
                         logger.debug('Rule/Value: %s: %r. Matched.', property, expected)
-                        self._property_matches.append(True)
                     else:
                         logger.debug('Rule/Value: %s: %r. Not Matched. Real value: %s',
                                      property, expected, value_to_check)
-                        self._property_matches.append(False)
+                        return RuleMatch(False)
 
                 else:
-                    if self.find_diff_value(expected, str(value_to_check)):
+                    if self.find_diff_value(expected, str(value_to_check), regex_group_dicts):
                         logger.debug('Rule/Value: %s: %r. Matched.', property, expected)
-                        self._property_matches.append(True)
                     else:
                         logger.debug('Rule/Value: %s: %r. Not Matched.', property, expected)
-                        self._property_matches.append(False)
+                        return RuleMatch(False)
 
-        if all(self._property_matches):
-            if self._regex_group_dicts:
-                return RuleMatch(True, self._generate_destination_tags())
-            else:
-                return RuleMatch(True, [self.destinations])
+        if regex_group_dicts:
+            return RuleMatch(True, self._generate_destination_tags(regex_group_dicts))
         else:
-            return RuleMatch(False)
+            return RuleMatch(True, [self.destinations])
 
-    def _generate_destination_tags(self):
+    def _generate_destination_tags(self, regex_group_dicts):
         # In some cases, the destination tag template uses multiple regex groups, and
         # the value for these regex groups are extracted from different attributes of
         # the modulemd info. As such a simple, re.sub of every match will throw an
@@ -294,7 +389,7 @@ class RuleDef(object):
 
         # Aggregate the different values for each regex group.
         replacements = {}
-        for group_dict in self._regex_group_dicts:
+        for group_dict in regex_group_dicts:
             for group, value in group_dict.items():
                 replacements.setdefault(group, []).append(value)
 
@@ -316,6 +411,190 @@ class RuleDef(object):
         return destinations
 
 
+class RuleSet(object):
+    """Compiled rule definitions read from a revision of the rules file
+
+    Rule definitions are validated, their regular expressions are compiled and
+    they are grouped by build state once when the rule set is created. A rule
+    set is not changed after creation, so it is safe to be shared by threads
+    and reused to handle any number of messages until the rules file changes.
+
+    :param rule_defs: list of rule definitions parsed from the rules file. None
+        is accepted for an empty rules file.
+    :type rule_defs: list[dict] or None
+    :param str revision: an identifier of the rules file revision from which
+        the rule set is created.
+    :raises ValueError: if any of the rule definitions is invalid.
+    """
+
+    def __init__(self, rule_defs, revision=None):
+        if rule_defs is None:
+            rule_defs = []
+        if not isinstance(rule_defs, list):
+            raise ValueError(
+                f'Rules file should contain a list of rule definitions, '
+                f'got {type(rule_defs).__name__}.')
+
+        self.revision = revision
+
+        # Rule definitions are grouped by build state:
+        # ready: [(1, RuleDef), (2, RuleDef)]
+        # done: [(3, RuleDef)]
+        # The original index number is kept so that it could be shown in logs.
+        rules_by_state = {}
+        for i, data in enumerate(rule_defs, 1):
+            rule_def = RuleDef(data)
+            build_state = rule_def.build_state or conf.build_state
+            rules_by_state.setdefault(build_state, []).append((i, rule_def))
+
+        self._rules_by_state = {
+            build_state: tuple(rules) for build_state, rules in rules_by_state.items()
+        }
+        # Module names admitted per build state. None means any name, which is
+        # set if any rule of the state does not match the name literally.
+        self._admitted_names = {}
+        for build_state, rules in self._rules_by_state.items():
+            names = set()
+            for _, rule_def in rules:
+                if rule_def.literal_names is None:
+                    names = None
+                    break
+                names.update(rule_def.literal_names)
+            self._admitted_names[build_state] = None if names is None else frozenset(names)
+
+        # Modulemd properties checked by any rule, which are the only ones to
+        # be parsed from modulemd.
+        self.properties = frozenset(itertools.chain.from_iterable(
+            rule_def.properties
+            for rules in self._rules_by_state.values()
+            for _, rule_def in rules
+        ))
+
+    def __len__(self):
+        return sum(len(rules) for rules in self._rules_by_state.values())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(revision={self.revision!r}, rules={len(self)})'
+
+    @property
+    def build_states(self):
+        """Build states which have at least one rule definition"""
+        return frozenset(self._rules_by_state)
+
+    def admits(self, build_state, name=None):
+        """Check if a module build could match any rule by its state and name
+
+        This is cheap enough to drop messages which could not match any rule
+        before doing anything else with them.
+
+        :param str build_state: the module build state name.
+        :param str name: the module name. If omitted, only the build state is
+            checked.
+        :return: False if no rule could match the module build, otherwise True.
+        :rtype: bool
+        """
+        if build_state not in self._admitted_names:
+            return False
+        names = self._admitted_names[build_state]
+        return name is None or names is None or name in names
+
+    def rules_for(self, build_state):
+        """Return rule definitions for a build state in the order of presence
+
+        :param str build_state: the module build state name.
+        :return: tuple of pairs of the rule index number and the rule definition.
+        :rtype: tuple[tuple[int, RuleDef]]
+        """
+        return self._rules_by_state.get(build_state, ())
+
+    def match(self, modulemd, build_state, event_msg=None):
+        """Find out the first rule definition matching the module
+
+        If the MBS message is given, rules which check only module properties
+        included in the message are matched with the message instead, so that
+        modulemd is not needed if the module build matches one of those rules
+        before any rule requiring other properties.
+
+        :param modulemd: a mapping parsed from modulemd YAML file, or a callable
+            returning it, which is called only if a rule requires modulemd.
+        :type modulemd: dict or callable
+        :param str build_state: the module build state name. Only rules defined
+            for this state are checked.
+        :param dict event_msg: the MBS message of the module build.
+        :return: a RuleMatch object of the first matched rule definition. If no
+            rule is matched, the returned RuleMatch evaluates to false.
+        :rtype: :class:`RuleMatch`
+        """
+        event_modulemd = None
+        if event_msg is not None:
+            event_modulemd = {'data': {
+                name: event_msg[name] for name in EVENT_PROPERTIES
+                if event_msg.get(name) is not None
+            }}
+
+        for i, rule_def in self.rules_for(build_state):
+            logger.info('[%s] Checking rule definition: %s', i, rule_def.id)
+            if event_modulemd is not None and \
+                    rule_def.can_match_with(event_modulemd['data'].keys()):
+                match = rule_def.match(event_modulemd)
+            else:
+                if callable(modulemd):
+                    modulemd = modulemd()
+                match = rule_def.match(modulemd)
+            if match:
+                logger.info('[%d] Rule definition: Matched. Remaining rules ignored.', i)
+                return match
+            logger.info('[%d] Rule definition: Not Matched.', i)
+        return RuleMatch(False)
+
+
+_rule_set_lock = threading.Lock()
+_rule_set = None
+
+
+def load_rule_set():
+    """Return the rule set compiled from current content of the rules file
+
+    The rule set is compiled only when the rules file revision changes, any
+    other time the rule set compiled previously is returned.
+
+    :return: the compiled rule set.
+    :rtype: :class:`RuleSet`
+    :raises requests.exceptions.HTTPError: if the rules file cannot be read.
+    :raises ValueError: if the rules file content has invalid rule definition.
+    """
+    global _rule_set
+
+    rules = rules_cache.get()
+    with _rule_set_lock:
+        if _rule_set is None or _rule_set.revision != rules.revision:
+            _rule_set = RuleSet(yaml.safe_load(rules.content), revision=rules.revision)
+            logger.info('Rules file revision %s is loaded. %d rule(s) are defined.',
+                        rules.revision, len(_rule_set))
+        return _rule_set
+
+
+def _is_koji_failure(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (koji.ServerOffline,
+                              requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout))
+
+
+# Stop calling Koji hub while it is unavailable
+koji_breaker = CircuitBreaker('koji',
+                              failure_threshold=conf.koji_breaker_failure_threshold,
+                              reset_timeout=conf.koji_breaker_reset_timeout,
+                              is_failure=_is_koji_failure)
+
+# Limit calls to Koji hub
+koji_throttle = Throttle('koji',
+                         rate=conf.koji_rate_limit,
+                         burst=conf.koji_rate_burst,
+                         max_concurrency=conf.koji_max_concurrent_calls)
+
+
 def login_koji(session, config):
     """Log into Koji
 
@@ -348,57 +627,729 @@ def login_koji(session, config):
             cfg['keytab'] = conf.keytab
             cfg['principal'] = conf.principal
 
-    return koji_cli.lib.activate_session(session, cfg)
+    with koji_breaker, koji_throttle:
+        return koji_cli.lib.activate_session(session, cfg)
 
 
-@contextmanager
-def make_koji_session():
-    koji_config = koji.read_config(conf.koji_profile)
-    session_opts = koji.grab_session_options(koji_config)
-    koji_session = koji.ClientSession(koji_config['server'], opts=session_opts)
-    login_koji(koji_session, koji_config)
+class KojiSessionPool(object):
+    """Pool of authenticated Koji sessions
+
+    Sessions are logged in once and kept alive to be reused for handling
+    subsequent messages, instead of logging in and out for every matched
+    build. At most ``conf.koji_max_sessions`` sessions exist at the same time.
+
+    Koji configuration is read from profile ``conf.koji_profile`` once when
+    the first session is created.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._slots = None
+        # Map sessions in use to the slots they are acquired from
+        self._in_use = {}
+        self._koji_config = None
+
+    @property
+    def koji_config(self):
+        with self._lock:
+            if self._koji_config is None:
+                self._koji_config = koji.read_config(conf.koji_profile)
+            return self._koji_config
+
+    def _get_slots(self):
+        with self._lock:
+            if self._slots is None:
+                self._slots = threading.BoundedSemaphore(conf.koji_max_sessions)
+            return self._slots
+
+    def _new_session(self):
+        koji_config = self.koji_config
+        session_opts = koji.grab_session_options(koji_config)
+        koji_session = koji.ClientSession(koji_config['server'], opts=session_opts)
+        login_koji(koji_session, koji_config)
+        monitor.koji_logins_counter.inc()
+        return koji_session
+
+    def relogin(self, koji_session):
+        """Log the session into Koji again
+
+        This is useful when hub does not accept the session anymore.
+
+        :param koji_session: the session to log in again.
+        :type koji_session: koji.ClientSession
+        """
+        koji_session.setSession(None)
+        login_koji(koji_session, self.koji_config)
+        monitor.koji_logins_counter.inc()
+
+    def acquire(self, timeout=None):
+        """Get a logged in session from pool
+
+        A new session is created if there is no idle session in pool. If max
+        number of sessions are in use already, wait for one to be released.
+
+        :param float timeout: seconds to wait for a session. None means to
+            wait forever.
+        :return: a logged in Koji session. It must be passed to
+            :meth:`release` after use.
+        :rtype: koji.ClientSession
+        :raises RuntimeError: if no session is available within timeout.
+        """
+        slots = self._get_slots()
+        if not slots.acquire(timeout=timeout):
+            raise RuntimeError(f'No Koji session is available in {timeout} seconds.')
+        try:
+            with self._lock:
+                koji_session = self._idle.pop() if self._idle else None
+            if koji_session is None:
+                koji_session = self._new_session()
+            elif not koji_session.logged_in:
+                self.relogin(koji_session)
+        except Exception:
+            slots.release()
+            raise
+        with self._lock:
+            self._in_use[koji_session] = slots
+        return koji_session
+
+    def release(self, koji_session, discard=False):
+        """Return session to pool
+
+        A session acquired before the pool is closed is logged out, as it
+        does not belong to the pool anymore.
+
+        :param koji_session: the session got from :meth:`acquire`.
+        :type koji_session: koji.ClientSession
+        :param bool discard: log out the session instead of keeping it for
+            reuse, e.g. the session is not valid anymore.
+        """
+        with self._lock:
+            slots = self._in_use.pop(koji_session, None)
+            if slots is None:
+                discard = True
+            elif not discard:
+                self._idle.append(koji_session)
+        try:
+            if discard:
+                _logout_koji_session(koji_session)
+        finally:
+            if slots is not None:
+                slots.release()
+
+    @contextmanager
+    def session(self):
+        """Context manager to use a session from pool"""
+        koji_session = self.acquire()
+        discard = False
+        try:
+            yield koji_session
+        except koji.AuthError:
+            discard = True
+            raise
+        finally:
+            self.release(koji_session, discard=discard)
+
+    def close(self):
+        """Log out all idle sessions and reset the pool
+
+        Sessions in use are logged out when they are released.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._slots = None
+            self._in_use = {}
+            self._koji_config = None
+        for koji_session in idle:
+            _logout_koji_session(koji_session)
+
+
+def _logout_koji_session(koji_session):
     try:
-        yield koji_session
-    finally:
         koji_session.logout()
+    except Exception:
+        logger.warning('Failed to log out Koji session.', exc_info=True)
+
+
+koji_session_pool = KojiSessionPool()
+
+
+def make_koji_session():
+    """Context manager to use a logged in Koji session from the session pool"""
+    return koji_session_pool.session()
+
+
+def _tag_build(koji_session, tag, nvr):
+    try:
+        with koji_breaker, koji_throttle:
+            return koji_session.tagBuild(tag, nvr)
+    except koji.AuthError:
+        logger.warning('Koji session is not accepted by hub. Log in again.')
+        koji_session_pool.relogin(koji_session)
+        with koji_breaker, koji_throttle:
+            return koji_session.tagBuild(tag, nvr)
+
+
+build_tags_cache = LRUCache('build_tags',
+                            max_entries=conf.build_tags_cache_size,
+                            ttl=conf.build_tags_cache_ttl)
+
+
+def _multicall_list_tags(koji_session, nvrs):
+    with koji_breaker, koji_throttle, koji_session.multicall(strict=False) as m:
+        calls = [m.listTags(build=nvr) for nvr in nvrs]
+    return calls
+
+
+def get_build_tags(nvrs, koji_session):
+    """Get names of tags which builds are tagged with already
+
+    Tags of builds not cached are queried in a single Koji multicall, and
+    cached for ``conf.build_tags_cache_ttl`` seconds.
+
+    :param nvrs: build NVRs.
+    :type nvrs: list[str]
+    :return: a mapping from build NVR to tag names. A build is not included if
+        its tags cannot be got from Koji, e.g. the build does not exist.
+    :rtype: dict[str, frozenset[str]]
+    """
+    build_tags = {}
+    for nvr in nvrs:
+        tags = build_tags_cache.get(nvr)
+        if tags is not None:
+            build_tags[nvr] = tags
+    nvrs = [nvr for nvr in nvrs if nvr not in build_tags]
+    if not nvrs:
+        return build_tags
+
+    try:
+        calls = _multicall_list_tags(koji_session, nvrs)
+    except Exception:
+        logger.exception('Failed to call listTags in multicall.')
+        return build_tags
+
+    for nvr, call in zip(nvrs, calls):
+        try:
+            tags = frozenset(tag['name'] for tag in call.result)
+        except Exception as e:
+            logger.warning('Failed to get tags of build %s: %s', nvr, e)
+        else:
+            build_tags_cache.put(nvr, tags)
+            build_tags[nvr] = tags
+    return build_tags
+
+
+def _multicall_get_task_info(koji_session, task_ids):
+    with koji_breaker, koji_throttle, koji_session.multicall(strict=False) as m:
+        calls = [m.getTaskInfo(task_id) for task_id in task_ids]
+    return calls
+
+
+def _find_failed_tasks(task_ids, koji_session):
+    """Find out tasks which failed, were canceled or do not exist in Koji
+
+    Tasks are checked in a single Koji multicall. A task whose info cannot be
+    got from Koji is not taken as failed.
+
+    :param task_ids: task IDs.
+    :type task_ids: list[int]
+    :return: IDs of failed tasks.
+    :rtype: set[int]
+    """
+    try:
+        calls = _multicall_get_task_info(koji_session, task_ids)
+    except Exception:
+        logger.exception('Failed to call getTaskInfo in multicall.')
+        return set()
+
+    failed = set()
+    for task_id, call in zip(task_ids, calls):
+        try:
+            info = call.result
+        except Exception as e:
+            logger.warning('Failed to get info of task %s: %s', task_id, e)
+            continue
+        if info is None or koji.TASK_STATES.get(info['state']) in FAILED_TASK_STATES:
+            failed.add(task_id)
+    return failed
+
+
+def _find_requested_tags(tag_requests, koji_session):
+    """Find out tags requested or applied already
+
+    Tags requested already are looked up in the tag ledger, and, if
+    ``conf.koji_check_build_tags`` is enabled, the remaining ones are checked
+    with tags the builds have in Koji.
+
+    Tasks of tags found in the ledger are checked in Koji. A tag whose task
+    failed is removed from the ledger and requested again.
+
+    :param tag_requests: list of pairs of tag name and build NVR.
+    :type tag_requests: list[tuple[str, str]]
+    :return: a mapping from pairs requested already to the task IDs. Task ID
+        is None for the tag which the build has in Koji already.
+    :rtype: dict
+    """
+    requested = {}
+    ledger = get_tag_ledger()
+    if ledger is not None:
+        recorded = {}
+        for tag, nvr in tag_requests:
+            task_id = ledger.get(nvr, tag)
+            if task_id is not None:
+                recorded[(tag, nvr)] = task_id
+        failed_tasks = _find_failed_tasks(list(recorded.values()), koji_session) \
+            if recorded else set()
+        for (tag, nvr), task_id in recorded.items():
+            if task_id in failed_tasks:
+                logger.info('Task %s to tag %s in %s failed. Request it again.',
+                            task_id, nvr, tag)
+                ledger.remove(nvr, tag, task_id)
+            else:
+                logger.info('Skip tagging %s in %s, which is requested already in task %s.',
+                            nvr, tag, task_id)
+                requested[(tag, nvr)] = task_id
+
+    if conf.koji_check_build_tags:
+        remaining = [item for item in tag_requests if item not in requested]
+        build_tags = get_build_tags(
+            list(dict.fromkeys(nvr for _, nvr in remaining)), koji_session)
+        for tag, nvr in remaining:
+            if tag in build_tags.get(nvr, ()):
+                logger.info('Skip tagging %s in %s, which is tagged already.', nvr, tag)
+                requested[(tag, nvr)] = None
+    return requested
+
+
+def _record_tag_request(tag, nvr, task_id):
+    ledger = get_tag_ledger()
+    if ledger is not None and not conf.dry_run:
+        ledger.put(nvr, tag, task_id)
 
 
 def tag_build(nvr, dest_tags, koji_session):
     """Tag build with specific tags
 
     Calling Koji API to tag build might fail, however successful tagged tag will
-    be returned and to log the failed tag operation.
+    be returned and to log the failed tag operation. If Koji is unavailable as
+    its circuit breaker is open, :class:`CircuitOpenError` is raised instead,
+    so that the message is handled again later.
+
+    If tag ledger is configured, a tag requested already is not requested
+    again unless its task failed, and the task ID requested before is returned
+    with skipped set. If
+    ``conf.koji_check_build_tags`` is enabled, a tag which the build has in
+    Koji already is skipped as well, whose task ID is None.
 
     :param str nvr: build NVR.
     :param dest_tags: tag names.
     :type dest_tags: list[str]
     :return: a list of tag build result info, each of them is an object of
         ``TagBuildResult``. The first element is tag name to apply, the second
-        one is the task id return from Koji, and the last one is the error
-        message. If tag operation is requested successfully, error message is
+        one is the task id return from Koji, the third one is the error
+        message, and the last one indicates whether the tag is requested
+        already. If tag operation is requested successfully, error message is
         set to None, otherwise None is set to task id and error message has
         some content.
     :rtype: list[TagBuildResult]
     """
+    requested = _find_requested_tags([(tag, nvr) for tag in dest_tags], koji_session)
     tagged_tags = []
     for tag in dest_tags:
+        if (tag, nvr) in requested:
+            tagged_tags.append(TagBuildResult(
+                tag_name=tag, task_id=requested[(tag, nvr)], error=None, skipped=True))
+        else:
+            tagged_tags.append(_request_tag_build(koji_session, tag, nvr))
+    return tagged_tags
+
+
+def _request_tag_build(koji_session, tag, nvr):
+    try:
+        if conf.dry_run:
+            logger.info("DRY-RUN: koji_session.tagBuild('%s', '%s')", tag, nvr)
+            task_id = 1
+        else:
+            task_id = _tag_build(koji_session, tag, nvr)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.exception('Failed to tag %s in %s', nvr, tag)
+        monitor.failed_tag_build_requests_counter.inc()
+        return TagBuildResult(tag_name=tag, task_id=None, error=str(e))
+    _record_tag_request(tag, nvr, task_id)
+    return TagBuildResult(tag_name=tag, task_id=task_id, error=None)
+
+
+def _request_tag_build_in_pool(tag, nvr):
+    with koji_session_pool.session() as koji_session:
+        return _request_tag_build(koji_session, tag, nvr)
+
+
+_tag_executor_lock = threading.Lock()
+_tag_executor = None
+
+
+def get_tag_executor():
+    """Return the executor to send tagBuild requests at the same time
+
+    :return: a thread pool executor with ``conf.koji_tag_workers`` threads.
+    :rtype: concurrent.futures.ThreadPoolExecutor
+    """
+    global _tag_executor
+
+    with _tag_executor_lock:
+        if _tag_executor is None:
+            _tag_executor = ThreadPoolExecutor(max_workers=conf.koji_tag_workers,
+                                               thread_name_prefix='mts-koji-tag')
+        return _tag_executor
+
+
+def close_tag_executor():
+    """Shut down the executor after the submitted requests finish"""
+    global _tag_executor
+
+    with _tag_executor_lock:
+        executor, _tag_executor = _tag_executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def tag_builds_concurrently(tag_requests):
+    """Tag builds with specific tags by requests sent at the same time
+
+    Each tag request is sent from a thread of the executor returned by
+    :func:`get_tag_executor` with a session got from the Koji session pool.
+    Tags requested or applied already are skipped as :meth:`tag_build` does.
+
+    :param tag_requests: list of pairs of tag name and build NVR.
+    :type tag_requests: list[tuple[str, str]]
+    :return: a list of tag build results, which is in the same order of the
+        given tag requests. Refer to :meth:`tag_build` for the details of
+        result.
+    :rtype: list[TagBuildResult]
+    """
+    with make_koji_session() as koji_session:
+        requested = _find_requested_tags(tag_requests, koji_session)
+
+    executor = get_tag_executor()
+    futures = {
+        item: executor.submit(_request_tag_build_in_pool, *item)
+        for item in tag_requests if item not in requested
+    }
+
+    tagged_tags = []
+    for tag, nvr in tag_requests:
+        if (tag, nvr) in requested:
+            tagged_tags.append(TagBuildResult(
+                tag_name=tag, task_id=requested[(tag, nvr)], error=None, skipped=True))
+            continue
         try:
-            if conf.dry_run:
-                logger.info("DRY-RUN: koji_session.tagBuild('%s', '%s')", tag, nvr)
-                task_id = 1
-            else:
-                task_id = koji_session.tagBuild(tag, nvr)
+            tagged_tags.append(futures[(tag, nvr)].result())
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            # Failed to get a session from the pool
+            logger.error('Failed to tag %s in %s: %s', nvr, tag, e)
+            monitor.failed_tag_build_requests_counter.inc()
+            tagged_tags.append(TagBuildResult(tag_name=tag, task_id=None, error=str(e)))
+    return tagged_tags
+
+
+def _multicall_tag_build(koji_session, tag_requests):
+    with koji_breaker, koji_throttle, koji_session.multicall(strict=False) as m:
+        calls = [m.tagBuild(tag, nvr) for tag, nvr in tag_requests]
+    return calls
+
+
+def tag_builds(tag_requests, koji_session):
+    """Tag builds with specific tags in a single Koji multicall
+
+    All tag requests are sent to hub in one round-trip, and the result of each
+    request is checked separately as :meth:`tag_build` does. Tags requested
+    or applied already are skipped as well.
+
+    :param tag_requests: list of pairs of tag name and build NVR.
+    :type tag_requests: list[tuple[str, str]]
+    :return: a list of tag build results, which is in the same order of the
+        given tag requests. Refer to :meth:`tag_build` for the details of
+        result.
+    :rtype: list[TagBuildResult]
+    """
+    requested = _find_requested_tags(tag_requests, koji_session)
+    new_requests = [item for item in tag_requests if item not in requested]
+    results = dict(
+        ((tag, nvr), TagBuildResult(tag_name=tag, task_id=task_id, error=None, skipped=True))
+        for (tag, nvr), task_id in requested.items()
+    )
+    results.update(zip(new_requests, _tag_builds(new_requests, koji_session)))
+    return [results[item] for item in tag_requests]
+
+
+def _tag_builds(tag_requests, koji_session):
+    if not tag_requests:
+        return []
+
+    if conf.dry_run:
+        for tag, nvr in tag_requests:
+            logger.info("DRY-RUN: koji_session.tagBuild('%s', '%s')", tag, nvr)
+        return [TagBuildResult(tag_name=tag, task_id=1, error=None)
+                for tag, _ in tag_requests]
+
+    try:
+        try:
+            calls = _multicall_tag_build(koji_session, tag_requests)
+        except koji.AuthError:
+            logger.warning('Koji session is not accepted by hub. Log in again.')
+            koji_session_pool.relogin(koji_session)
+            calls = _multicall_tag_build(koji_session, tag_requests)
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        logger.exception('Failed to call tagBuild in multicall.')
+        monitor.failed_tag_build_requests_counter.inc(len(tag_requests))
+        return [TagBuildResult(tag_name=tag, task_id=None, error=str(e))
+                for tag, _ in tag_requests]
+
+    tagged_tags = []
+    for (tag, nvr), call in zip(tag_requests, calls):
+        try:
+            task_id = call.result
         except Exception as e:
-            logger.exception('Failed to tag %s in %s', nvr, tag)
+            logger.error('Failed to tag %s in %s: %s', nvr, tag, e)
             tagged_tags.append(
                 TagBuildResult(tag_name=tag, task_id=None, error=str(e)))
             monitor.failed_tag_build_requests_counter.inc()
         else:
+            _record_tag_request(tag, nvr, task_id)
             tagged_tags.append(
                 TagBuildResult(tag_name=tag, task_id=task_id, error=None))
     return tagged_tags
 
 
+def request_tag_builds(nvrs, dest_tags):
+    """Tag each of the builds with all the destination tags
+
+    Tag requests are sent in a single multicall if ``conf.koji_multicall`` is
+    enabled, or at the same time from ``conf.koji_tag_workers`` threads if it
+    is greater than 1, otherwise one by one.
+
+    :param nvrs: build NVRs.
+    :type nvrs: list[str]
+    :param dest_tags: tag names.
+    :type dest_tags: list[str]
+    :return: list of tag build results of each build, which is in the same
+        order of the given NVRs.
+    :rtype: list[list[TagBuildResult]]
+    """
+    if not conf.koji_multicall and conf.koji_tag_workers > 1:
+        results = tag_builds_concurrently(
+            [(tag, nvr) for nvr in nvrs for tag in dest_tags])
+        n = len(dest_tags)
+        return [results[i * n:(i + 1) * n] for i in range(len(nvrs))]
+
+    with make_koji_session() as koji_session:
+        if conf.koji_multicall:
+            results = tag_builds(
+                [(tag, nvr) for nvr in nvrs for tag in dest_tags], koji_session)
+            n = len(dest_tags)
+            return [results[i * n:(i + 1) * n] for i in range(len(nvrs))]
+        return [tag_build(nvr, dest_tags, koji_session) for nvr in nvrs]
+
+
+TrackedTask = namedtuple('TrackedTask', ['build', 'nvr', 'tag', 'requested_at'])
+
+
+class KojiTaskTracker(object):
+    """Track requested tagBuild tasks until they finish
+
+    Tracked tasks are checked in batches by a single getTaskInfo multicall
+    when :meth:`poll` is called. When a task finishes, message
+    ``build.tagged`` is sent if it is closed successfully, otherwise
+    ``build.tag.failed`` is sent and the tag request is removed from the tag
+    ledger, so that the tag is requested again for next message of the build.
+    The task is not tracked any more either way.
+    """
+
+    # Koji task states which mean the task is finished
+    FINISHED_STATES = ('CLOSED', 'FAILED', 'CANCELED')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tasks)
+
+    def track(self, task_id, build, nvr, tag):
+        """Track a tagBuild task
+
+        :param int task_id: the task ID.
+        :param dict build: the module build info included in sent messages.
+        :param str nvr: the build NVR to tag.
+        :param str tag: the tag name.
+        """
+        with self._lock:
+            self._tasks[task_id] = TrackedTask(build, nvr, tag, time.time())
+            monitor.koji_tracked_tasks.set(len(self._tasks))
+
+    def _untrack(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+            monitor.koji_tracked_tasks.set(len(self._tasks))
+
+    def poll(self):
+        """Check tracked tasks once
+
+        At most ``conf.koji_task_poll_batch_size`` tasks are checked, and the
+        tasks not finished yet are checked again after the others.
+
+        :return: the number of finished tasks.
+        :rtype: int
+        """
+        with self._lock:
+            batch = list(self._tasks.items())[:conf.koji_task_poll_batch_size]
+            for task_id, _ in batch:
+                self._tasks.move_to_end(task_id)
+        if not batch:
+            return 0
+
+        with make_koji_session() as koji_session:
+            calls = _multicall_get_task_info(koji_session, [task_id for task_id, _ in batch])
+
+        finished = 0
+        for (task_id, task), call in zip(batch, calls):
+            try:
+                info = call.result
+            except Exception as e:
+                logger.warning('Failed to get info of task %s: %s', task_id, e)
+                continue
+            if info is None:
+                logger.warning('Task %s does not exist. Stop tracking it.', task_id)
+                self._untrack(task_id)
+                continue
+            state = koji.TASK_STATES.get(info['state'])
+            if state in self.FINISHED_STATES:
+                self._untrack(task_id)
+                if state in FAILED_TASK_STATES:
+                    self._forget_tag_request(task_id, task)
+                self._publish_result(task_id, task, state)
+                finished += 1
+            elif time.time() - task.requested_at > conf.koji_task_track_timeout:
+                logger.warning('Task %s is not finished in %d seconds. Stop tracking it.',
+                               task_id, conf.koji_task_track_timeout)
+                self._untrack(task_id)
+        return finished
+
+    def _forget_tag_request(self, task_id, task):
+        """Remove a failed task from the tag ledger to request it again"""
+        ledger = get_tag_ledger()
+        if ledger is None:
+            return
+        try:
+            ledger.remove(task.nvr, task.tag, task_id)
+        except Exception:
+            logger.exception('Failed to remove task %s from tag ledger.', task_id)
+
+    def _publish_result(self, task_id, task, state):
+        monitor.koji_task_latency.labels(state.lower()).observe(time.time() - task.requested_at)
+        if state == 'CLOSED':
+            logger.info('Build %s is tagged with %s in task %s.', task.nvr, task.tag, task_id)
+            topic = 'build.tagged'
+        else:
+            logger.warning('Task %s to tag build %s with %s is %s.',
+                           task_id, task.nvr, task.tag, state)
+            topic = 'build.tag.failed'
+        try:
+            messaging.publish(topic, {
+                'build': task.build,
+                'nvr': task.nvr,
+                'tag': task.tag,
+                'task_id': task_id,
+                'state': state,
+            })
+        except Exception:
+            logger.exception('Failed to send message of task %s.', task_id)
+
+    def close(self):
+        with self._lock:
+            self._tasks.clear()
+            monitor.koji_tracked_tasks.set(0)
+
+
+def _create_task_tracker():
+    if conf.koji_task_poll_interval > 0:
+        return KojiTaskTracker()
+
+
+# Tracker of tagBuild tasks, which polls tracked tasks every
+# conf.koji_task_poll_interval seconds. Closing it stops polling, and tasks
+# being tracked are not tracked any more.
+_task_tracker = LazySingleton(_create_task_tracker,
+                              task_name='mts-koji-task-tracker',
+                              task=KojiTaskTracker.poll,
+                              interval='koji_task_poll_interval')
+get_task_tracker = _task_tracker.get
+close_task_tracker = _task_tracker.close
+
+
+modulemd_cache = LRUCache('modulemd',
+                          max_entries=conf.modulemd_cache_size,
+                          max_size=conf.modulemd_cache_max_bytes,
+                          ttl=conf.modulemd_cache_ttl)
+
+
+def get_modulemd(module_build_id, properties=None):
+    """Get parsed modulemd of a module build
+
+    Parsed modulemd is cached, so that subsequent messages of the same module
+    build, e.g. both ready and done state changes, do not retrieve and parse
+    the modulemd again.
+
+    :param int module_build_id: the module build ID.
+    :param properties: names of properties under ``data`` to be parsed. Others
+        are not included in the returned modulemd. If omitted, the whole
+        modulemd is parsed.
+    :type properties: frozenset[str] or None
+    :return: a mapping parsed from modulemd YAML file. Do not change it, which
+        is shared with other callers.
+    :rtype: dict
+    """
+    cached = modulemd_cache.get(module_build_id)
+    if cached is not None:
+        cached_properties, modulemd = cached
+        # A cached modulemd parsed with more properties serves as well.
+        if cached_properties is None or \
+                properties is not None and properties <= cached_properties:
+            return modulemd
+    content = retrieve_modulemd_content(module_build_id)
+    modulemd = load_modulemd(content, properties)
+    modulemd_cache.put(module_build_id, (properties, modulemd), size=len(content))
+    return modulemd
+
+
+def warm_modulemd_cache(properties=None):
+    """Load recently used modulemd from modulemd store into cache
+
+    :param properties: names of properties under ``data`` to be parsed. Refer
+        to :func:`get_modulemd`.
+    :type properties: frozenset[str] or None
+    :return: the number of loaded modulemd.
+    :rtype: int
+    """
+    store = get_modulemd_store()
+    if store is None:
+        return 0
+    recent = store.recent(conf.modulemd_cache_size)
+    # Put the most recently used one last, which is evicted last.
+    for build_id, content in reversed(recent):
+        modulemd_cache.put(build_id, (properties, load_modulemd(content, properties)),
+                           size=len(content))
+    logger.info('%d modulemd(s) are loaded into cache from store.', len(recent))
+    return len(recent)
+
+
 def log_failed_tasks(failed_tasks):
     """Log each failed tasks, each one in a single line
 
@@ -409,8 +1360,16 @@ def log_failed_tasks(failed_tasks):
         logger.warning('Tag %s. Failure reason: %s', task.tag_name, task.error)
 
 
-def handle(rule_defs, event_msg):
-    """Handle MBS build.state.change event"""
+def handle(rule_set, event_msg):
+    """Handle MBS build.state.change event
+
+    :param rule_set: the compiled rule set to match the module build. A list of
+        rule definitions is accepted as well, which is compiled on the fly.
+    :type rule_set: :class:`RuleSet` or list[dict]
+    :param dict event_msg: the MBS message.
+    """
+    if not isinstance(rule_set, RuleSet):
+        rule_set = RuleSet(rule_set)
 
     this_name = event_msg["name"]
     this_stream = event_msg["stream"]
@@ -419,41 +1378,21 @@ def handle(rule_defs, event_msg):
     nsvc = f"{this_name}-{this_stream}-{this_version}-{this_context}"
     state_name = event_msg['state_name']
 
-    # Rule definitions are grouped by build state:
-    # ready: [{...}, {...}]
-    # done: [{...}, {...}, {...}]
-    rules_by_state = {}
-    for i, rule_def in enumerate(rule_defs, 1):
-        # Rule definitions are grouped by build state in rules_by_state, so
-        # it is not necessary to keep build state in rule definition.
-        build_state = rule_def.get('rule', {}).pop('build_state', conf.build_state)
-        # Keep the original index number so that it could be shown in logs
-        rules_by_state.setdefault(build_state, []).append((i, rule_def))
-
-    if state_name not in rules_by_state:
+    if state_name not in rule_set.build_states:
         logger.info('Skip module build %s. It is in state "%s", no rule is '
                     'defined for this state.',
                     nsvc, state_name)
         return
 
-    try:
-        modulemd = yaml.safe_load(retrieve_modulemd_content(event_msg['id']))
-    except requests.exceptions.HTTPError as e:
-        raise RuntimeError(f'Failed to retrieve modulemd for {nsvc}: {str(e)}')
-
-    logger.debug('Modulemd file is downloaded and parsed.')
-
-    rule_match = None
-    for i, rule_def in rules_by_state[state_name]:
-        rd = RuleDef(rule_def)
-        logger.info('[%s] Checking rule definition: %s', i, rd.id)
-        match = rd.match(modulemd)
-        if match:
-            logger.info('[%d] Rule definition: Matched. Remaining rules ignored.', i)
-            rule_match = match
-            break
-        else:
-            logger.info('[%d] Rule definition: Not Matched.', i)
+    def _get_modulemd():
+        try:
+            modulemd = get_modulemd(event_msg['id'], rule_set.properties)
+        except requests.exceptions.HTTPError as e:
+            raise RuntimeError(f'Failed to retrieve modulemd for {nsvc}: {str(e)}') from e
+        logger.debug('Modulemd file is downloaded and parsed.')
+        return modulemd
+
+    rule_match = rule_set.match(_get_modulemd, state_name, event_msg=event_msg)
 
     if not rule_match:
         logger.info('Module build %s does not match any rule.', nsvc)
@@ -471,46 +1410,59 @@ def handle(rule_defs, event_msg):
     monitor.matched_module_builds_counter.inc()
 
     stream = this_stream.replace('-', '_')
-    with make_koji_session() as koji_session:
-        for name in (this_name, f'{this_name}-devel'):
-            nvr = f'{name}-{stream}-{this_version}.{this_context}'
-
-            dest_tags = rule_match.dest_tags
-            logger.info('Tag build %s with tag(s) %s', nvr, ', '.join(dest_tags))
-            tag_build_result = tag_build(nvr, dest_tags, koji_session)
-
-            failed_tasks = [item for item in tag_build_result if item.task_id is None]
+    dest_tags = rule_match.dest_tags
+    builds = []
+    for name in (this_name, f'{this_name}-devel'):
+        nvr = f'{name}-{stream}-{this_version}.{this_context}'
+        logger.info('Tag build %s with tag(s) %s', nvr, ', '.join(dest_tags))
+        builds.append((name, nvr))
+
+    tag_build_results = request_tag_builds([nvr for _, nvr in builds], dest_tags)
+    task_tracker = None if conf.dry_run else get_task_tracker()
+
+    for (name, nvr), tag_build_result in zip(builds, tag_build_results):
+        build = {
+            'id': event_msg['id'],
+            'name': name,
+            'stream': this_stream,
+            'version': this_version,
+            'context': this_context,
+        }
+        failed_tasks = [item for item in tag_build_result if item.error is not None]
+
+        if len(failed_tasks) == len(dest_tags):
+            logger.warning(
+                'None of tag(s) %r is applied to build %s successfully.',
+                dest_tags, nvr)
+            log_failed_tasks(failed_tasks)
+        elif len(failed_tasks) > 0:
+            logger.warning(
+                'Tag(s) %r should be applied to build %s. But failed to '
+                'apply these tags: %s',
+                dest_tags, nvr, [item.tag_name for item in failed_tasks])
+            log_failed_tasks(failed_tasks)
+
+        # Tag info for message sent later
+        # For a successful tag task, it is {"tag": "name", "task_id": 123}
+        # For a tag requested before, it is {"tag": "name", "task_id": 123, "skipped": true}
+        # For a tag applied already, it is {"tag": "name", "task_id": None, "skipped": true}
+        # For a failure tag task, it is {"tag": "name", "task_id": None, "reason": "..."}
+        destination_tags = []
+        for result in tag_build_result:
+            data = {'tag': result.tag_name, 'task_id': result.task_id}
+            if result.error is not None:
+                data['error'] = result.error
+            if result.skipped:
+                data['skipped'] = True
+            destination_tags.append(data)
+
+        messaging.publish('build.tag.requested', {
+            'build': build,
+            'nvr': nvr,
+            'destination_tags': destination_tags,
+        })
 
-            if len(failed_tasks) == len(dest_tags):
-                logger.warning(
-                    'None of tag(s) %r is applied to build %s successfully.',
-                    dest_tags, nvr)
-                log_failed_tasks(failed_tasks)
-            elif len(failed_tasks) > 0:
-                logger.warning(
-                    'Tag(s) %r should be applied to build %s. But failed to '
-                    'apply these tags: %s',
-                    dest_tags, nvr, [item.tag_name for item in failed_tasks])
-                log_failed_tasks(failed_tasks)
-
-            # Tag info for message sent later
-            # For a successful tag task, it is {"tag": "name", "task_id": 123}
-            # For a failure tag task, it is {"tag": "name", "task_id": None, "reason": "..."}
-            destination_tags = []
+        if task_tracker is not None:
             for result in tag_build_result:
-                data = {'tag': result.tag_name, 'task_id': result.task_id}
-                if result.task_id is None:
-                    data['error'] = result.error
-                destination_tags.append(data)
-
-            messaging.publish('build.tag.requested', {
-                'build': {
-                    'id': event_msg['id'],
-                    'name': name,
-                    'stream': this_stream,
-                    'version': this_version,
-                    'context': this_context,
-                },
-                'nvr': nvr,
-                'destination_tags': destination_tags,
-            })
+                if result.error is None and not result.skipped:
+                    task_tracker.track(result.task_id, build, nvr, result.tag_name)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Message tagging service is an event-driven service to tag build.
+# Copyright (C) 2019  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import logging
+
+from proton import SSLDomain
+from proton.handlers import MessagingHandler
+from proton.reactor import ApplicationEvent
+from proton.reactor import DurableSubscription
+from proton.reactor import EventInjector
+
+from message_tagging_service import conf
+
+logger = logging.getLogger(__name__)
+
+
+class UMBReceiver(MessagingHandler):
+    """Receive messages from UMB and settle each of them after it is handled
+
+    Received messages are handed over by ``submit``, which returns a future of
+    handling the message. A message is accepted only after its future is done
+    successfully or cancelled, and released to be delivered again if the
+    future fails. So, messages which are received but not handled yet are not
+    lost if the service stops.
+
+    At most ``window`` messages are received and not settled at the same time,
+    as the credit granted to broker is topped up only when a message is
+    settled.
+
+    Deliveries are settled in the container thread by injecting an event, as
+    proton objects must not be accessed from other threads.
+
+    :param callable submit: function to hand over a received message, which
+        accepts the ``proton.Message`` and returns a
+        ``concurrent.futures.Future``.
+    :param int window: max number of messages not settled.
+    """
+
+    def __init__(self, submit, window):
+        super().__init__(prefetch=0, auto_accept=False)
+        self.submit = submit
+        self.window = window
+        self._injector = EventInjector()
+        self._in_flight = 0
+        # Increased when connection is lost. Deliveries received before that
+        # cannot be settled anymore, and broker will deliver them again.
+        self._generation = 0
+
+    def on_start(self, event):
+        event.container.selectable(self._injector)
+
+        ssl_domain = SSLDomain(SSLDomain.MODE_CLIENT)
+        ssl_domain.set_credentials(
+            conf.rhmsg_certificate, conf.rhmsg_private_key, None)
+        ssl_domain.set_trusted_ca_db(conf.rhmsg_ca_cert)
+        ssl_domain.set_peer_authentication(SSLDomain.VERIFY_PEER)
+
+        options = None
+        if conf.rhmsg_subscription_name:
+            event.container.container_id = conf.rhmsg_subscription_name
+            options = DurableSubscription()
+        connection = event.container.connect(urls=conf.rhmsg_brokers, ssl_domain=ssl_domain)
+        event.container.create_receiver(
+            connection, conf.rhmsg_queue, name=conf.rhmsg_subscription_name, options=options)
+
+    def on_link_opened(self, event):
+        receiver = event.receiver
+        if receiver is not None:
+            credit = self.window - self._in_flight - receiver.credit
+            if credit > 0:
+                receiver.flow(credit)
+
+    def on_disconnected(self, event):
+        logger.warning('Disconnected from broker. Messages being handled will be '
+                       'delivered again after connecting to broker again.')
+        self._generation += 1
+        self._in_flight = 0
+
+    def on_message(self, event):
+        delivery = event.delivery
+        generation = self._generation
+        self._in_flight += 1
+        future = self.submit(event.message)
+        future.add_done_callback(
+            lambda f: self._injector.trigger(
+                ApplicationEvent('message_handled', subject=(delivery, generation, f))))
+
+    def on_message_handled(self, event):
+        delivery, generation, future = event.subject
+        if generation != self._generation:
+            return
+        self._in_flight -= 1
+        if future.cancelled() or future.exception() is None:
+            self.accept(delivery)
+        else:
+            logger.warning('Release message to be delivered again as it failed to be '
+                           'handled: %s', future.exception())
+            self.release(delivery, delivered=True)
+        delivery.link.flow(1)
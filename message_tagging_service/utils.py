@@ -19,32 +19,811 @@
 #
 # Authors: Chenxiong Qi <cqi@redhat.com>
 
+import hashlib
 import os
 import requests
+import threading
+import time
 import yaml
 import logging
 
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 from message_tagging_service import conf
+from message_tagging_service import monitor
+from message_tagging_service.modulemd_store import ModulemdStore
+from message_tagging_service.tag_ledger import TagLedger
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    # PyYAML is built without libyaml
+    from yaml import SafeLoader
 
 logger = logging.getLogger(__name__)
 
 
+_mbs_session_lock = threading.Lock()
+_mbs_session = None
+
+
+def get_mbs_session():
+    """Return the HTTP session shared to call MBS API
+
+    Connections to MBS are kept alive in a pool and reused by subsequent
+    requests. Requests failed due to connection error or server error are
+    retried with exponential backoff and random jitter.
+
+    :return: the shared session.
+    :rtype: requests.Session
+    """
+    global _mbs_session
+
+    with _mbs_session_lock:
+        if _mbs_session is None:
+            retry = Retry(
+                total=conf.mbs_retries,
+                backoff_factor=conf.mbs_retry_backoff_factor,
+                backoff_jitter=conf.mbs_retry_backoff_jitter,
+                status_forcelist=(500, 502, 503, 504),
+                allowed_methods=['GET'],
+                # Return the last response so that raise_for_status raises
+                # HTTPError as there is no retry.
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_maxsize=conf.mbs_pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _mbs_session = session
+        return _mbs_session
+
+
+def close_mbs_session():
+    """Close connections of the shared HTTP session to call MBS API"""
+    global _mbs_session
+
+    with _mbs_session_lock:
+        session, _mbs_session = _mbs_session, None
+    if session is not None:
+        session.close()
+
+
 def retrieve_modulemd_content(module_build_id):
     """Retrieve and return modulemd.txt from MBS
 
+    If modulemd store is configured, the content is read from the store first,
+    and content retrieved from MBS is saved in the store. Concurrent calls for
+    the same module build share one retrieval.
+
     :param int module_build_id: module build ID.
     :return: modulemd content.
     :rtype: str
     """
+    return _modulemd_flight.do(module_build_id, _retrieve_modulemd_content, module_build_id)
+
+
+def _retrieve_modulemd_content(module_build_id):
+    store = get_modulemd_store()
+    if store is not None:
+        content = store.get(module_build_id)
+        if content is not None:
+            return content
+        content = _request_modulemd_content(module_build_id)
+        store.put(module_build_id, content)
+        return content
+    return _request_modulemd_content(module_build_id)
+
+
+def _request_modulemd_content(module_build_id):
     api_url = conf.mbs_api_url.rstrip('/')
-    resp = requests.get(f'{api_url}/module-builds/{module_build_id}',
-                        timeout=conf.requests_timeout,
-                        params={'verbose': True}
-                        )
-    resp.raise_for_status()
+    with mbs_breaker:
+        start = time.monotonic()
+        try:
+            resp = get_mbs_session().get(
+                f'{api_url}/module-builds/{module_build_id}',
+                timeout=(conf.mbs_connect_timeout, conf.requests_timeout),
+                params={'verbose': True})
+        finally:
+            monitor.mbs_request_latency.observe(time.monotonic() - start)
+        resp.raise_for_status()
     return resp.json()['modulemd']
 
 
+class CircuitOpenError(RuntimeError):
+    """Raised when a service is not called as its circuit breaker is open"""
+
+
+class CircuitBreaker(object):
+    """Stop calling a service which keeps failing
+
+    The breaker is opened after ``failure_threshold`` consecutive calls fail,
+    and calls are rejected with :class:`CircuitOpenError` immediately rather
+    than waiting for the service to time out. After ``reset_timeout`` seconds,
+    the breaker is half-open and one call is allowed as a probe, while other
+    calls are still rejected until the probe finishes. It is closed if the
+    probe succeeds, or opened again if the probe fails.
+
+    Use the breaker as a context manager around each call::
+
+        with breaker:
+            session.get(url)
+
+    :param str name: the service name.
+    :param int failure_threshold: number of consecutive failures to open the
+        breaker. 0 means the breaker is never opened.
+    :param float reset_timeout: seconds for an open breaker to be half-open.
+    :param callable is_failure: check whether an exception raised from a call
+        means the service is unavailable. Other exceptions mean the service
+        responded, which is counted as a successful call. If omitted, any
+        exception is a failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.is_failure = is_failure or (lambda e: True)
+        self._cond = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        """Close the breaker and forget failures"""
+        with self._cond:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = 0
+            self._probing = False
+            monitor.circuit_breaker_open.labels(self.name).set(0)
+            self._cond.notify_all()
+
+    def _current_state(self):
+        if self._state == self.OPEN and \
+                time.monotonic() >= self._opened_at + self.reset_timeout:
+            logger.info('Circuit breaker of %s is half-open.', self.name)
+            self._state = self.HALF_OPEN
+        return self._state
+
+    @property
+    def state(self):
+        with self._cond:
+            return self._current_state()
+
+    def record_success(self):
+        with self._cond:
+            self._probing = False
+            if self._state != self.CLOSED:
+                logger.info('Circuit breaker of %s is closed.', self.name)
+                self._state = self.CLOSED
+                monitor.circuit_breaker_open.labels(self.name).set(0)
+                self._cond.notify_all()
+            self._failures = 0
+
+    def record_failure(self):
+        with self._cond:
+            self._probing = False
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning('Circuit breaker of %s is open after %d failure(s).',
+                                   self.name, self._failures)
+                    monitor.circuit_breaker_open.labels(self.name).set(1)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._cond.notify_all()
+
+    def _is_available(self):
+        state = self._current_state()
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._probing)
+
+    @property
+    def available(self):
+        """Whether a call is allowed now"""
+        with self._cond:
+            return self._is_available()
+
+    def wait_until_available(self):
+        """Wait while the breaker is open or a probe is being made
+
+        :return: seconds waited.
+        :rtype: float
+        """
+        start = time.monotonic()
+        with self._cond:
+            while not self._is_available():
+                if self._state == self.OPEN:
+                    self._cond.wait(self._opened_at + self.reset_timeout - time.monotonic())
+                else:
+                    self._cond.wait()
+        return time.monotonic() - start
+
+    def __enter__(self):
+        if self.failure_threshold <= 0:
+            return self
+        with self._cond:
+            if not self._is_available():
+                raise CircuitOpenError(
+                    f'{self.name} is unavailable. Circuit breaker is {self._state}.')
+            if self._state == self.HALF_OPEN:
+                self._probing = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.failure_threshold <= 0:
+            return
+        if exc_value is not None and self.is_failure(exc_value):
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+def _is_mbs_failure(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout))
+
+
+mbs_breaker = CircuitBreaker('mbs',
+                             failure_threshold=conf.mbs_breaker_failure_threshold,
+                             reset_timeout=conf.mbs_breaker_reset_timeout,
+                             is_failure=_is_mbs_failure)
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls of the same key into one call
+
+    The first caller of a key runs the function, and the callers coming while
+    it is running wait for and get the same result, or the same exception if
+    the function fails. Results are not kept after the call finishes.
+
+    :param str name: name of the call, used as the label of metrics.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Call the function, or wait for the running call of the same key
+
+        :param key: a hashable object identifying the call.
+        :param callable func: the function to call.
+        :return: what the function returns.
+        :raises: whatever the function raises.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            running = future is not None
+            if not running:
+                future = self._calls[key] = Future()
+
+        if running:
+            monitor.coalesced_requests_counter.labels(self.name).inc()
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+_modulemd_flight = SingleFlight('modulemd')
+
+
+def load_modulemd(content, properties=None):
+    """Parse modulemd YAML content
+
+    When properties are given, only those properties under ``data`` are
+    constructed into Python objects, and the others, e.g. components, API and
+    profiles, are skipped. The returned mapping has only the ``data`` key then.
+
+    :param str content: modulemd YAML content.
+    :param properties: names of properties under ``data`` to be kept. If
+        omitted, the whole document is constructed.
+    :type properties: iterable[str] or None
+    :return: a mapping parsed from modulemd YAML content.
+    :rtype: dict
+    """
+    loader = SafeLoader(content)
+    try:
+        if properties is None:
+            return loader.get_single_data()
+        root = loader.get_single_node()
+        if root is None:
+            return None
+        data_node = _get_mapping_value_node(root, 'data')
+        if data_node is None:
+            return loader.construct_document(root)
+        properties = set(properties)
+        data = {}
+        for key_node, value_node in data_node.value:
+            if isinstance(key_node, yaml.ScalarNode) and key_node.value in properties:
+                data[key_node.value] = loader.construct_object(value_node, deep=True)
+        return {'data': data}
+    finally:
+        loader.dispose()
+
+
+def _get_mapping_value_node(node, key):
+    if not isinstance(node, yaml.MappingNode):
+        return None
+    for key_node, value_node in node.value:
+        if isinstance(key_node, yaml.ScalarNode) and key_node.value == key:
+            if isinstance(value_node, yaml.MappingNode):
+                return value_node
+            return None
+    return None
+
+
+class LRUCache(object):
+    """Thread-safe cache evicting least recently used entries
+
+    The cache is bounded by both the number of entries and the total size of
+    entries. An entry expires after it is cached for ``ttl`` seconds. Hits,
+    misses and evictions are counted in metrics labeled with the cache name.
+
+    :param str name: the cache name.
+    :param int max_entries: max number of entries. Nothing is cached if it is 0.
+    :param int max_size: max total size of entries. 0 means no limit.
+    :param float ttl: seconds for an entry to expire. 0 means never expires.
+    """
+
+    def __init__(self, name, max_entries, max_size=0, ttl=0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _pop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key, default=None):
+        """Get a cached value
+
+        :param key: the key of the value.
+        :param default: returned if key is not cached or the entry expires.
+        :return: the cached value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.monotonic():
+                self._pop(key)
+                monitor.cache_evictions_counter.labels(self.name).inc()
+                entry = None
+            if entry is None:
+                monitor.cache_misses_counter.labels(self.name).inc()
+                return default
+            self._entries.move_to_end(key)
+            monitor.cache_hits_counter.labels(self.name).inc()
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        """Cache a value
+
+        Least recently used entries are evicted until the cache is within the
+        bounds again.
+
+        :param key: the key of the value.
+        :param value: the value to cache.
+        :param int size: the size of the value.
+        """
+        if self.max_entries <= 0 or (self.max_size and size > self.max_size):
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, size, expires_at)
+            self._size += size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_size and self._size > self.max_size)):
+                self._pop(next(iter(self._entries)))
+                monitor.cache_evictions_counter.labels(self.name).inc()
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class Throttle(object):
+    """Limit rate and concurrency of calls to a service
+
+    Rate is limited by a token bucket, which is refilled with ``rate`` tokens
+    per second up to ``burst`` tokens. Each call takes a token, and waits for
+    one if the bucket is empty. At most ``max_concurrency`` calls run at the
+    same time. Time spent to wait is observed in a metric labeled with the
+    throttle name.
+
+    Use the throttle as a context manager around each call::
+
+        with throttle:
+            session.tagBuild(tag, nvr)
+
+    :param str name: the throttle name.
+    :param float rate: tokens per second. 0 means no rate limit.
+    :param int burst: max number of tokens in the bucket.
+    :param int max_concurrency: max number of concurrent calls. 0 means no
+        limit.
+    """
+
+    def __init__(self, name, rate, burst, max_concurrency):
+        self.name = name
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def _take_token(self):
+        """Take a token and return seconds to wait for it to be available"""
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # The token is reserved even if it is not available yet, so that
+            # callers waiting at the same time get tokens one after another.
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def __enter__(self):
+        start = time.monotonic()
+        wait = self._take_token()
+        if wait:
+            time.sleep(wait)
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        monitor.throttle_wait_time.labels(self.name).observe(time.monotonic() - start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+
+class ExpiringSet(object):
+    """Thread-safe set of keys seen within a time window
+
+    Keys are kept for ``window`` seconds after they are added. The set is also
+    bounded by the number of keys, and the oldest keys are removed first.
+
+    :param float window: seconds to keep a key. Nothing is kept if it is 0.
+    :param int max_entries: max number of keys.
+    """
+
+    def __init__(self, window, max_entries):
+        self.window = window
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def add(self, key):
+        """Add a key unless it is added already within the window
+
+        :param key: a hashable key.
+        :return: True if the key is added, or False if it is in the set already.
+        :rtype: bool
+        """
+        if self.window <= 0 or self.max_entries <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            # Keys are ordered by the time they are added, so expired keys
+            # are always at the beginning.
+            while self._keys and next(iter(self._keys.values())) <= now:
+                self._keys.popitem(last=False)
+            if key in self._keys:
+                return False
+            self._keys[key] = now + self.window
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        """Remove a key if it is in the set
+
+        :param key: a hashable key.
+        """
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def clear(self):
+        """Remove all keys"""
+        with self._lock:
+            self._keys.clear()
+
+    close = clear
+
+
+RulesRevision = namedtuple('RulesRevision', ['content', 'revision'])
+
+
+class PeriodicTask(threading.Thread):
+    """Call a function periodically in a daemon thread until it is stopped
+
+    Any error raised from the function is logged and the function is called
+    again in next round.
+
+    :param str name: the thread name.
+    :param float interval: seconds to wait before each call.
+    :param callable func: the function to call without arguments.
+    :param bool immediate: call the function once as soon as the thread is
+        started, rather than waiting for the first interval.
+    """
+
+    def __init__(self, name, interval, func, immediate=False):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.func = func
+        self.immediate = immediate
+        self._stopped = threading.Event()
+
+    def _call(self):
+        try:
+            self.func()
+        except Exception:
+            logger.exception('Periodic task %s failed.', self.name)
+
+    def run(self):
+        if self.immediate and not self._stopped.is_set():
+            self._call()
+        while not self._stopped.wait(self.interval):
+            self._call()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+
+
+class LazySingleton(object):
+    """Object shared in the process, which is created when it is requested
+    first time and closed when the service stops
+
+    A :class:`PeriodicTask` could be started along with the object to call a
+    function with the object periodically. The task is stopped before the
+    object is closed.
+
+    :param callable create: function called without arguments to create the
+        object, which returns None if the object is not configured.
+    :param str task_name: the thread name of the periodic task.
+    :param callable task: function called with the object periodically.
+    :param str interval: name of the config option of seconds to wait before
+        each call of the task. Task is not started if the option is not set.
+    :param bool immediate: call the task as soon as the object is created.
+    """
+
+    def __init__(self, create, task_name=None, task=None, interval=None, immediate=False):
+        self.create = create
+        self.task_name = task_name
+        self.task = task
+        self.interval = interval
+        self.immediate = immediate
+        self._lock = threading.Lock()
+        self._obj = None
+        self._task = None
+
+    def get(self):
+        """Return the object, which is created if it does not exist yet
+
+        :return: the object, or None if the object is not configured.
+        """
+        with self._lock:
+            if self._obj is None:
+                self._obj = self.create()
+                if self._obj is None:
+                    return None
+                interval = getattr(conf, self.interval) if self.task else None
+                if interval and interval > 0:
+                    obj = self._obj
+                    self._task = PeriodicTask(self.task_name, interval,
+                                              lambda: self.task(obj),
+                                              immediate=self.immediate)
+                    self._task.start()
+            return self._obj
+
+    def close(self):
+        """Stop the periodic task and close the object"""
+        with self._lock:
+            task, self._task = self._task, None
+            obj, self._obj = self._obj, None
+        if task is not None:
+            task.stop()
+        if obj is not None:
+            obj.close()
+
+
+def _open_modulemd_store():
+    if conf.modulemd_store_path:
+        return ModulemdStore(conf.modulemd_store_path, conf.modulemd_store_max_bytes)
+
+
+# Persistent store of modulemd content opened from conf.modulemd_store_path,
+# which is compacted periodically.
+_modulemd_store = LazySingleton(_open_modulemd_store,
+                                task_name='mts-modulemd-store-compactor',
+                                task=ModulemdStore.compact,
+                                interval='modulemd_store_compact_interval')
+get_modulemd_store = _modulemd_store.get
+close_modulemd_store = _modulemd_store.close
+
+
+def _open_tag_ledger():
+    if conf.tag_ledger_path:
+        return TagLedger(conf.tag_ledger_path, conf.tag_ledger_retention)
+
+
+# Persistent ledger of requested tags opened from conf.tag_ledger_path, whose
+# expired records are purged periodically.
+_tag_ledger = LazySingleton(_open_tag_ledger,
+                            task_name='mts-tag-ledger-purger',
+                            task=TagLedger.purge,
+                            interval='tag_ledger_purge_interval')
+get_tag_ledger = _tag_ledger.get
+close_tag_ledger = _tag_ledger.close
+
+
+class RulesCache(object):
+    """Cache content of the configured rule file
+
+    Cached content is revalidated by a conditional GET request with the
+    ``ETag`` and ``Last-Modified`` got from last response after it is cached
+    for ``conf.rules_cache_ttl`` seconds. If the rule file cannot be read
+    again, the last successfully read content is still served.
+
+    A background thread could be started to refresh the cache periodically, so
+    that content is always available without a request to the rule file host
+    when a message is handled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresher = None
+        self.clear()
+
+    def clear(self):
+        """Remove the cached content"""
+        with self._lock:
+            self._rules = None
+            self._etag = None
+            self._last_modified = None
+            self._checked_at = 0
+
+    def _is_fresh(self):
+        return (self._rules is not None and
+                time.monotonic() - self._checked_at < conf.rules_cache_ttl)
+
+    def get(self):
+        """Return the rule file content
+
+        :return: the rule file content and its revision.
+        :rtype: RulesRevision
+        :raises requests.exceptions.RequestException: if the rule file cannot
+            be read and nothing is cached yet.
+        """
+        with self._lock:
+            if self._is_fresh():
+                return self._rules
+        return self.refresh(force=False)
+
+    def refresh(self, force=True):
+        """Revalidate the cached content with the rule file host
+
+        :param bool force: revalidate even if the cached content is fresh.
+        :return: the rule file content and its revision.
+        :rtype: RulesRevision
+        """
+        with self._refresh_lock:
+            with self._lock:
+                # Another thread could have refreshed the content already
+                # while waiting for the lock.
+                if not force and self._is_fresh():
+                    return self._rules
+                headers = {}
+                if self._etag:
+                    headers['If-None-Match'] = self._etag
+                if self._last_modified:
+                    headers['If-Modified-Since'] = self._last_modified
+
+            try:
+                r = requests.get(conf.rules_file_url,
+                                 timeout=conf.requests_timeout,
+                                 headers=headers)
+                if r.status_code != 304:
+                    r.raise_for_status()
+            except requests.exceptions.RequestException:
+                with self._lock:
+                    if self._rules is None:
+                        raise
+                    # Do not try again on every message while the host is
+                    # unreachable.
+                    self._checked_at = time.monotonic()
+                    logger.exception('Failed to refresh rules content. Continue '
+                                     'to use rules revision %s.', self._rules.revision)
+                    return self._rules
+
+            with self._lock:
+                self._checked_at = time.monotonic()
+                if r.status_code == 304 and self._rules is not None:
+                    logger.debug('Rules content is not modified.')
+                    return self._rules
+                content = r.text
+                revision = hashlib.sha256(content.encode('utf-8')).hexdigest()
+                if self._rules is None or self._rules.revision != revision:
+                    logger.info('Rules content revision %s is retrieved.', revision)
+                self._rules = RulesRevision(content=content, revision=revision)
+                self._etag = r.headers.get('ETag')
+                self._last_modified = r.headers.get('Last-Modified')
+                return self._rules
+
+    def start_refresher(self, interval):
+        """Start a background thread to refresh the cached content
+
+        The content is refreshed once immediately, so that it is cached
+        already when the first message is handled.
+
+        :param float interval: seconds between two refreshes.
+        """
+        if self._refresher is None:
+            self._refresher = PeriodicTask('mts-rules-refresher', interval, self.refresh,
+                                           immediate=True)
+            self._refresher.start()
+
+    def stop_refresher(self):
+        if self._refresher is not None:
+            self._refresher.stop()
+            self._refresher = None
+
+
+rules_cache = RulesCache()
+
+
+def read_rules_content():
+    """Read content of configured rule file
+
+    The content is returned from the rules cache, which is revalidated with
+    the rule file host when it expires.
+
+    :return: the rule file content.
+    :rtype: str
+    """
+    return rules_cache.get().content
+
+
 def read_rule_defs():
     """Read rule definiations from configured rule file
 
@@ -52,9 +831,7 @@ def read_rule_defs():
         a mapping.
     :rtype: dict
     """
-    r = requests.get(conf.rules_file_url, timeout=conf.requests_timeout)
-    r.raise_for_status()
-    return yaml.safe_load(r.text)
+    return yaml.safe_load(read_rules_content())
 
 
 def is_file_readable(filename):
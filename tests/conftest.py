@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from message_tagging_service import consumer, messaging, tagging_service, utils
+
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    """Ensure every test starts with nothing cached from other tests"""
+    utils.rules_cache.clear()
+    tagging_service.modulemd_cache.clear()
+    tagging_service.build_tags_cache.clear()
+    tagging_service.koji_breaker.reset()
+    utils.mbs_breaker.reset()
+    yield
+    tagging_service.close_tag_executor()
+    tagging_service.close_task_tracker()
+    tagging_service.koji_session_pool.close()
+    messaging.rhmsg_producer.close()
+    messaging.close_outbox()
+    utils.close_mbs_session()
+    utils.close_modulemd_store()
+    utils.close_tag_ledger()
+    consumer.close_retry_scheduler()
+    consumer.received_messages.close()
+    consumer.received_build_states.close()
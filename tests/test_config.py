@@ -19,6 +19,7 @@
 #
 # Authors: Chenxiong Qi <cqi@redhat.com>
 
+import importlib.machinery
 import os
 
 from mock import patch
@@ -27,6 +28,10 @@ from message_tagging_service import config
 test_config = os.path.join(os.path.dirname(__file__),
                            'data',
                            'config.py')
+base_config = os.path.join(os.path.dirname(__file__),
+                           '..',
+                           'conf',
+                           'config.py')
 
 
 class TestConfig(object):
@@ -94,3 +99,8 @@ class TestConfig(object):
         assert conf.test_val3 == test_val3
         conf.reset()
         assert conf.test_val1 == conf_data.TestConfiguration.test_val1
+
+    def test_defaults_are_same_as_base_configuration(self):
+        mod = importlib.machinery.SourceFileLoader('mts_base_conf', base_config).load_module()
+        for name, value in config.Config._defaults.items():
+            assert value == getattr(mod.BaseConfiguration, name), name
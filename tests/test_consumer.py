@@ -24,17 +24,29 @@ import json
 import os
 import pytest
 import requests.exceptions
+import threading
+import time
 import yaml
 
+from concurrent.futures import Future
 from mock import patch, Mock
+from textwrap import dedent
 from message_tagging_service.consumer import run
-from message_tagging_service import conf, consumer
+from message_tagging_service import conf, consumer, messaging
+from message_tagging_service.outbox import Outbox
+from message_tagging_service.retry_store import RetryStore
+from message_tagging_service.tagging_service import RuleSet
 
 try:
     import rhmsg
 except ImportError:
     rhmsg = None
 
+try:
+    import proton
+except ImportError:
+    proton = None
+
 
 test_data_dir = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -79,6 +91,28 @@ class TestConsumer(object):
     another one is coming UMB.
     """
 
+    @pytest.mark.parametrize('name,state_name', [
+        ('virt', 'init'),
+        ('python', 'ready'),
+    ])
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_skip_message_not_admitted_by_rules(self, get, handle, name, state_name):
+        get.return_value.text = dedent("""\
+            - id: Virt
+              type: module
+              rule:
+                name: ^virt$
+              destinations: virt-tag
+            """)
+        msg = Mock(body={
+            'name': name, 'stream': '8', 'version': '1', 'context': 'c1',
+            'state_name': state_name,
+        })
+        with patch.object(conf, 'build_state_msg_filter', new=['init', 'ready']):
+            consumer.consume(msg)
+        handle.assert_not_called()
+
     @pytest.mark.skipif(rhmsg is None, reason='rhmsg is not installed.')
     # Test code working with rhmsg library
     @patch.object(conf, 'messaging_backend', new='rhmsg')
@@ -117,8 +151,10 @@ class TestConsumer(object):
 
         run()
 
-        handle.assert_called_once_with(
-            yaml.safe_load(rules_content), mbs_event_msg)
+        handle.assert_called_once()
+        rule_set, event_msg = handle.call_args[0]
+        assert len(yaml.safe_load(rules_content)) == len(rule_set)
+        assert mbs_event_msg == event_msg
 
     @pytest.mark.parametrize('msg_body', [{
         'name': 'python',
@@ -143,7 +179,11 @@ class TestConsumer(object):
             run()
 
         if msg_body:
-            handle.assert_called_once_with(yaml.safe_load(rules_content), msg_body)
+            handle.assert_called_once()
+            rule_set, event_msg = handle.call_args[0]
+            assert isinstance(rule_set, RuleSet)
+            assert len(yaml.safe_load(rules_content)) == len(rule_set)
+            assert msg_body == event_msg
         else:
             # In case event message is empty, MTS stops handling the message.
             handle.assert_not_called()
@@ -166,6 +206,57 @@ class TestConsumer(object):
             with pytest.raises(ValueError, match='Unknown messaging backend: .+'):
                 run()
 
+    @patch.object(conf, 'fedora_messaging_consumer_workers', new=3)
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_handle_fedora_messaging_messages_in_workers(self, get, handle):
+        with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+            get.return_value.text = f.read()
+
+        msg_bodies = [{
+            'id': i,
+            'name': 'python',
+            'stream': '2.7',
+            'version': str(i),
+            'context': 'c1',
+            'state_name': 'ready',
+        } for i in range(6)]
+
+        def api_consume(callback):
+            for body in msg_bodies:
+                callback(fedora_messaging.api.Message(body))
+
+        with patch('fedora_messaging.api.consume', new=api_consume):
+            run()
+
+        # All messages are handled before consumer backend returns.
+        assert 6 == handle.call_count
+        assert sorted(msg_bodies, key=lambda body: body['id']) == \
+            sorted((c[0][1] for c in handle.call_args_list), key=lambda body: body['id'])
+
+    @patch.object(conf, 'fedora_messaging_consumer_workers', new=2)
+    @patch('message_tagging_service.consumer.consume')
+    def test_wait_for_free_worker_before_acking_message(self, consume):
+        release = threading.Event()
+        consume.side_effect = lambda msg: release.wait(5)
+        returned = []
+
+        def api_consume(callback):
+            for i in range(3):
+                callback(fedora_messaging.api.Message({'id': i}))
+                returned.append(i)
+
+        t = threading.Thread(target=run)
+        with patch('fedora_messaging.api.consume', new=api_consume):
+            t.start()
+            t.join(0.2)
+            # The third message is not acked while both workers are busy.
+            assert [0, 1] == returned
+            release.set()
+            t.join(5)
+        assert [0, 1, 2] == returned
+        assert 3 == consume.call_count
+
     @patch('message_tagging_service.consumer.tagging_service.handle')
     @patch('requests.get')
     def test_consume_terminates_if_fail_to_read_rules_from_remote(self, get, handle):
@@ -220,6 +311,25 @@ class TestConsumer(object):
             args, _ = logger.error.call_args_list[1]
             assert args[0].startswith('Reason:')
 
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_consume_terminates_if_rules_are_invalid(self, get, handle):
+        get.return_value.text = '- id: rule without type and destinations'
+        msg = fedora_messaging.api.Message(body={
+            'name': 'modulea',
+            'stream': '10',
+            'version': '20200107111030',
+            'context': 'c1',
+            'state_name': 'ready',
+        })
+
+        with patch.object(consumer, 'logger') as logger:
+            consumer.consume(msg)
+
+            args, _ = logger.exception.call_args
+            assert 'Failed to load rule definitions from rules content.' == args[0]
+        handle.assert_not_called()
+
     def test_ignore_scratch_build(self):
         msg = fedora_messaging.api.Message(body={'name': 'modulea', 'scratch': True})
 
@@ -236,3 +346,519 @@ class TestConsumer(object):
             consumer.consume(msg)
             args, _ = logger.warning.call_args
             assert 'The message with build_state:' in args[0]
+
+
+class TestOrderedWorkerPool(object):
+    """Test OrderedWorkerPool"""
+
+    def test_keep_order_of_tasks_with_same_key(self):
+        handled = []
+
+        def task(build_id, n):
+            time.sleep(0.001 * (5 - n))
+            handled.append((build_id, n))
+
+        pool = consumer.OrderedWorkerPool(4, 10)
+        for n in range(5):
+            for build_id in (1, 2, 3):
+                pool.submit(build_id, task, build_id, n)
+        pool.shutdown(wait=True)
+
+        for build_id in (1, 2, 3):
+            assert list(range(5)) == [n for b, n in handled if b == build_id]
+
+    def test_run_tasks_with_different_keys_in_parallel(self):
+        started = threading.Barrier(2, timeout=5)
+
+        pool = consumer.OrderedWorkerPool(2, 10)
+        # Each task waits for another one, which works only if both of them
+        # are running at the same time.
+        futures = [pool.submit(key, started.wait) for key in (0, 1)]
+        pool.shutdown(wait=True)
+
+        assert all(f.exception() is None for f in futures)
+
+    def test_return_error_from_task(self):
+        pool = consumer.OrderedWorkerPool(1, 10)
+        future = pool.submit(1, int, 'x')
+        pool.shutdown(wait=True)
+        assert isinstance(future.exception(), ValueError)
+
+    def test_coalesce_waiting_tasks(self):
+        release = threading.Event()
+        handled = []
+
+        pool = consumer.OrderedWorkerPool(1, 10)
+        # Block the worker, so that following tasks wait in the queue.
+        pool.submit(0, release.wait, 5)
+        futures = [
+            pool.submit(1, handled.append, n, coalesce_key=(1, 'ready'))
+            for n in range(3)
+        ]
+        futures.append(pool.submit(1, handled.append, 3, coalesce_key=(1, 'done')))
+        release.set()
+        pool.shutdown(wait=True)
+
+        assert [2, 3] == handled
+        assert [True, True, False, False] == [f.cancelled() for f in futures]
+        assert not pool._latest
+
+    @pytest.mark.parametrize('body,expected', [
+        ({'id': 1, 'state_name': 'ready'}, (1, 'ready')),
+        ({'id': 1, 'state_name': 'done'}, (1, 'done')),
+        ({'state_name': 'ready'}, None),
+    ])
+    def test_coalesce_by_module_build_and_state(self, body, expected):
+        assert expected == consumer._get_coalesce_key(Mock(body=body))
+
+    def test_do_not_skip_earlier_state_of_same_module_build(self):
+        release = threading.Event()
+        handled = []
+
+        pool = consumer.OrderedWorkerPool(1, 0)
+        pool.submit(0, release.wait, 5)
+        for state in ('ready', 'done'):
+            msg = Mock(body={'id': 1, 'state_name': state})
+            pool.submit(1, handled.append, state, coalesce_key=consumer._get_coalesce_key(msg))
+        release.set()
+        pool.shutdown(wait=True)
+
+        assert ['ready', 'done'] == handled
+
+
+@pytest.mark.skipif(not proton, reason='Library proton is not available.')
+class TestUMBReceiver(object):
+    """Test messages are settled after they are handled"""
+
+    def setup_method(self, test_method):
+        from message_tagging_service.umb_receiver import UMBReceiver
+
+        self.futures = []
+        self.receiver = UMBReceiver(self.submit, window=4)
+        self.receiver._injector = Mock()
+
+    def submit(self, msg):
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def _receive(self):
+        delivery = Mock()
+        self.receiver.on_message(Mock(message=proton.Message(body='{}'), delivery=delivery))
+        return delivery
+
+    def _dispatch_injected_events(self):
+        for c in self.receiver._injector.trigger.call_args_list:
+            event = c[0][0]
+            getattr(self.receiver, f'on_{event.type}')(event)
+        self.receiver._injector.trigger.reset_mock()
+
+    def test_grant_credit_when_link_is_opened(self):
+        link = Mock(credit=0)
+        self.receiver.on_link_opened(Mock(receiver=link))
+        link.flow.assert_called_once_with(4)
+
+    def test_accept_after_message_is_handled(self):
+        delivery = self._receive()
+        self._dispatch_injected_events()
+        delivery.settle.assert_not_called()
+
+        self.futures[0].set_result(None)
+        self._dispatch_injected_events()
+
+        delivery.update.assert_called_once_with(proton.Delivery.ACCEPTED)
+        delivery.settle.assert_called_once()
+        delivery.link.flow.assert_called_once_with(1)
+
+    def test_accept_superseded_message(self):
+        delivery = self._receive()
+        self.futures[0].cancel()
+        self._dispatch_injected_events()
+        delivery.update.assert_called_once_with(proton.Delivery.ACCEPTED)
+
+    def test_release_message_failed_to_be_handled(self):
+        delivery = self._receive()
+        self.futures[0].set_exception(RuntimeError('failed'))
+        self._dispatch_injected_events()
+
+        delivery.update.assert_called_once_with(proton.Delivery.MODIFIED)
+        delivery.settle.assert_called_once()
+        delivery.link.flow.assert_called_once_with(1)
+
+    def test_do_not_settle_message_received_before_disconnected(self):
+        delivery = self._receive()
+        self.receiver.on_disconnected(Mock())
+        self.futures[0].set_result(None)
+        self._dispatch_injected_events()
+
+        delivery.settle.assert_not_called()
+        # Full credit is granted again to the reattached link.
+        link = Mock(credit=0)
+        self.receiver.on_link_opened(Mock(receiver=link))
+        link.flow.assert_called_once_with(4)
+
+    @patch.object(conf, 'rhmsg_consumer_workers', new=2)
+    @patch('message_tagging_service.consumer.consume')
+    @patch('proton.reactor.Container')
+    def test_handle_umb_messages_in_workers(self, Container, consume):
+        handled = threading.Event()
+        consume.side_effect = lambda msg: handled.set()
+
+        def run():
+            receiver = Container.call_args[0][0]
+            receiver._injector = Mock()
+            receiver.on_message(Mock(message=proton.Message(body='{"id": 1}')))
+            assert handled.wait(5)
+
+        Container.return_value.run.side_effect = run
+        consumer.rhmsg_backend()
+
+        umb_msg = consume.call_args[0][0]
+        assert 1 == umb_msg.peek('id')
+
+
+class TestDeduplicateMessages(object):
+    """Test consume drops duplicate messages"""
+
+    def _make_msg(self, msg_id, build_id, state_name='ready'):
+        return Mock(id=msg_id, body={
+            'id': build_id, 'name': 'python', 'stream': '2.7', 'version': '1',
+            'context': 'c1', 'state_name': state_name,
+        })
+
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_drop_duplicate_messages(self, get, handle):
+        with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+            get.return_value.text = f.read()
+
+        for msg in [
+            self._make_msg('msg-1', 1),
+            # Redelivered
+            self._make_msg('msg-1', 1),
+            # Sent again
+            self._make_msg('msg-2', 1),
+            self._make_msg('msg-3', 1, 'done'),
+            self._make_msg('msg-4', 2),
+        ]:
+            consumer.consume(msg)
+
+        assert [(1, 'ready'), (1, 'done'), (2, 'ready')] == [
+            (c[0][1]['id'], c[0][1]['state_name']) for c in handle.call_args_list
+        ]
+
+    @patch.object(conf, 'consumer_dedup_window', new=0)
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_no_deduplication(self, get, handle):
+        with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+            get.return_value.text = f.read()
+
+        consumer.consume(self._make_msg('msg-1', 1))
+        consumer.consume(self._make_msg('msg-1', 1))
+        assert 2 == handle.call_count
+
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_handle_again_after_failure(self, get, handle):
+        with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+            get.return_value.text = f.read()
+        handle.side_effect = [IOError('Koji is unavailable.'), None, None]
+
+        for msg_id in ('msg-1', 'msg-1', 'msg-2'):
+            consumer.consume(self._make_msg(msg_id, 1))
+        assert 2 == handle.call_count
+
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('message_tagging_service.consumer.tagging_service.load_rule_set')
+    def test_handle_again_after_error_is_raised(self, load_rule_set, handle):
+        load_rule_set.side_effect = [requests.exceptions.ConnectionError('refused'), Mock()]
+
+        with pytest.raises(requests.exceptions.ConnectionError):
+            consumer.consume(self._make_msg('msg-1', 1))
+        consumer.consume(self._make_msg('msg-1', 1))
+        handle.assert_called_once()
+
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_handle_again_after_failing_to_load_rules(self, get, handle):
+        with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+            get.side_effect = [requests.exceptions.HTTPError('503'), Mock(text=f.read())]
+
+        consumer.consume(self._make_msg('msg-1', 1))
+        consumer.consume(self._make_msg('msg-1', 1))
+        handle.assert_called_once()
+
+
+@patch.object(conf, 'messaging_backend', new='fedora-messaging')
+@patch.object(conf, 'outbox_replay_interval', new=3600)
+def test_replay_outbox_left_in_last_run(tmp_path):
+    outbox_path = str(tmp_path / 'outbox.db')
+    outbox = Outbox(outbox_path)
+    outbox.put('build.tag.requested', {'nvr': 'a-1-1.c1'})
+    outbox.close()
+
+    sent = threading.Event()
+    handler = Mock(side_effect=lambda topic, msg: sent.set())
+
+    def api_consume(callback):
+        # Nothing is published or failed while consumer is running.
+        assert sent.wait(5)
+
+    with patch.object(conf, 'outbox_path', new=outbox_path), \
+            patch.dict(messaging._messaging_backends,
+                       {'fedora-messaging': {'publish': handler}}), \
+            patch('fedora_messaging.api.consume', new=api_consume):
+        run()
+        messaging.close_outbox()
+
+    handler.assert_called_once_with('build.tag.requested', {'nvr': 'a-1-1.c1'})
+    outbox = Outbox(outbox_path)
+    try:
+        assert 0 == len(outbox)
+    finally:
+        outbox.close()
+
+
+@patch('message_tagging_service.consumer.tagging_service.handle')
+@patch('requests.get')
+def test_pause_while_service_is_unavailable(get, handle):
+    with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+        get.return_value.text = f.read()
+    breaker = consumer.tagging_service.koji_breaker
+
+    with patch.object(breaker, 'reset_timeout', new=60):
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        t = threading.Thread(target=consumer.consume, args=(Mock(body={
+            'id': 1, 'name': 'python', 'stream': '2.7', 'version': '1',
+            'context': 'c1', 'state_name': 'ready',
+        }),))
+        t.start()
+        t.join(0.1)
+        assert t.is_alive()
+        handle.assert_not_called()
+
+        # Hub is back
+        breaker.record_success()
+        t.join(5)
+    handle.assert_called_once()
+
+
+@patch('message_tagging_service.consumer.tagging_service.load_rule_set')
+def test_handle_again_after_probe_when_breaker_is_half_open(load_rule_set):
+    """Messages handled while another worker probes Koji are not dropped"""
+    breaker = consumer.tagging_service.koji_breaker
+    release = threading.Event()
+    lock = threading.Lock()
+    attempts = []
+    rejected = []
+    handled = []
+
+    def handle(rule_set, mbs_msg):
+        with lock:
+            attempts.append(mbs_msg['id'])
+            probe = len(attempts) == 1
+        try:
+            with breaker:
+                if probe:
+                    assert release.wait(5)
+                handled.append(mbs_msg['id'])
+        except consumer.CircuitOpenError:
+            rejected.append(mbs_msg['id'])
+            raise
+
+    with patch.object(breaker, 'reset_timeout', new=0), \
+            patch('message_tagging_service.consumer.tagging_service.handle', new=handle):
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        assert breaker.HALF_OPEN == breaker.state
+
+        pool = consumer.OrderedWorkerPool(2, 0)
+        futures = [
+            pool.submit(build_id, consumer.consume, Mock(id=f'msg-{build_id}', body={
+                'id': build_id, 'name': 'python', 'stream': '2.7', 'version': '1',
+                'context': 'c1', 'state_name': 'ready',
+            }))
+            for build_id in (1, 2)
+        ]
+        for _ in range(500):
+            if rejected:
+                break
+            time.sleep(0.01)
+        assert 1 == len(rejected)
+
+        # Probe succeeds
+        release.set()
+        pool.shutdown(wait=True)
+
+    assert [None, None] == [f.result() for f in futures]
+    assert [1, 2] == sorted(handled)
+    assert breaker.CLOSED == breaker.state
+
+
+class TestRetryScheduler(object):
+    """Test RetryScheduler"""
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        store = RetryStore(str(tmp_path / 'retries.db'))
+        yield store
+        store.close()
+
+    def _wait_for(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        raise AssertionError('Condition is not met in time.')
+
+    @patch.object(conf, 'retry_policies', new={
+        'default': {'max_attempts': 2, 'delay': 0.01},
+        'KeyError': {'max_attempts': 0, 'delay': 0},
+    })
+    def test_retry_until_dead_letter(self, store):
+        handle = Mock(side_effect=requests.exceptions.ConnectionError('refused'))
+        scheduler = consumer.RetryScheduler(store, handle)
+        try:
+            scheduler.schedule({'id': 1}, RuntimeError('failed'))
+            scheduler.schedule({'id': 2}, KeyError('name'))
+            self._wait_for(lambda: len(store.dead_letters()) == 2)
+        finally:
+            scheduler.stop()
+
+        assert 2 == handle.call_count
+        assert 0 == len(store)
+        assert [
+            ({'id': 2}, 0, "'name'"),
+            ({'id': 1}, 2, 'refused'),
+        ] == [row[1:4] for row in store.dead_letters()]
+
+    @patch.object(conf, 'retry_policies', new={'default': {'max_attempts': 3, 'delay': 0.01}})
+    def test_retry_until_success(self, store):
+        handle = Mock(side_effect=[RuntimeError('failed'), None])
+        scheduler = consumer.RetryScheduler(store, handle)
+        try:
+            scheduler.schedule({'id': 1}, RuntimeError('failed'))
+            self._wait_for(lambda: handle.call_count == 2 and not len(store))
+        finally:
+            scheduler.stop()
+        assert [] == store.dead_letters()
+
+    def test_schedule_stored_messages(self, store):
+        store.add({'id': 1}, 0, time.time() + 3600)
+        store.add({'id': 2}, 0, time.time() - 1)
+        handle = Mock()
+        scheduler = consumer.RetryScheduler(store, handle)
+        try:
+            self._wait_for(lambda: len(store) == 1)
+        finally:
+            scheduler.stop()
+        handle.assert_called_once_with({'id': 2})
+        assert 1 == len(scheduler)
+
+    @patch.object(conf, 'retry_policies', new={
+        'default': {'max_attempts': 5, 'delay': 60},
+        'HTTPError': {'max_attempts': 10, 'delay': 1},
+        'ConnectionError': {'max_attempts': 1, 'delay': 2},
+    })
+    def test_get_retry_policy(self):
+        assert 60 == consumer.get_retry_policy(RuntimeError())['delay']
+        # By base class
+        assert 2 == consumer.get_retry_policy(ConnectionRefusedError())['delay']
+        # By cause
+        try:
+            try:
+                raise requests.exceptions.HTTPError('503')
+            except requests.exceptions.HTTPError as e:
+                raise RuntimeError('Failed to retrieve modulemd') from e
+        except RuntimeError as e:
+            assert 1 == consumer.get_retry_policy(e)['delay']
+
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('requests.get')
+    def test_schedule_failed_message(self, get, handle, tmp_path):
+        with open(os.path.join(test_data_dir, 'mts-test-rules.yaml'), 'r') as f:
+            get.return_value.text = f.read()
+        handle.side_effect = RuntimeError('MBS is down')
+        mbs_msg = {
+            'id': 1, 'name': 'python', 'stream': '2.7', 'version': '1',
+            'context': 'c1', 'state_name': 'ready',
+        }
+
+        with patch.object(conf, 'retry_store_path', new=str(tmp_path / 'retries.db')):
+            consumer.consume(Mock(body=mbs_msg))
+            scheduler = consumer.get_retry_scheduler()
+            assert 1 == len(scheduler)
+            retry_id = scheduler.store.pending()[0][1]
+            assert (mbs_msg, 0) == scheduler.store.get(retry_id)
+
+
+class TestUMBMessage(object):
+    """Test UMBMessage"""
+
+    def _make_msg(self, body):
+        return consumer.UMBMessage(Mock(body=body, id='msg-id-01', address='topic://event'))
+
+    @pytest.mark.parametrize('body', [
+        '{"id": 1, "state_name": "ready", "scratch": false, "name": "a\\"b"}',
+        b'{"id": 1, "state_name": "ready", "scratch": false, "name": "a\\"b"}',
+    ])
+    def test_peek_without_decoding(self, body):
+        msg = self._make_msg(body)
+        assert 1 == msg.peek('id')
+        assert 'ready' == msg.peek('state_name')
+        assert msg.peek('scratch') is False
+        assert 'a"b' == msg.peek('name')
+        assert msg._body is None
+
+        assert {'id': 1, 'state_name': 'ready', 'scratch': False, 'name': 'a"b'} == msg.body
+
+    @pytest.mark.parametrize('body,expected', [
+        # Appear more than once
+        ('{"state_trace": [{"state_name": "init"}], "state_name": "ready"}', 'ready'),
+        # Only in nested object
+        ('{"tasks": {"state_name": "init"}}', None),
+        ('{"tasks": [{"x": 1}, {"state_name": "init"}]}', None),
+        # Only in nested object after a string with bracket
+        ('{"reason": "}", "x": {"state_name": "init"}, "name": "a"}', None),
+        # Not a scalar value
+        ('{"state_name": ["ready"]}', ['ready']),
+        ('{"id": 1}', None),
+    ])
+    def test_peek_by_decoding(self, body, expected):
+        msg = self._make_msg(body)
+        assert expected == msg.peek('state_name')
+        assert json.loads(body) == msg._body
+
+    def test_peek_skips_brackets_in_strings(self):
+        body = '{"reason": "}", "x": {"scratch": true}, "name": "a"}'
+        msg = self._make_msg(body)
+        assert msg.peek('scratch') is None
+        assert 'a' == msg.peek('name')
+
+        msg = self._make_msg('{"reason": "[{", "state_name": "ready"}')
+        assert 'ready' == msg.peek('state_name')
+        assert msg._body is None
+
+    def test_peek_invalid_body(self):
+        msg = self._make_msg('{"state_trace": [{"state_name": "init"}], "state_name": ')
+        with pytest.raises(json.JSONDecodeError):
+            msg.peek('state_name')
+
+    @patch('message_tagging_service.consumer.tagging_service.handle')
+    @patch('message_tagging_service.consumer.tagging_service.load_rule_set')
+    def test_consume_invalid_body(self, load_rule_set, handle):
+        msg = self._make_msg('{"state_name": "ready", "name": "a", ')
+        consumer.consume(msg)
+        handle.assert_not_called()
+
+    @patch('message_tagging_service.consumer.tagging_service.load_rule_set')
+    def test_drop_without_decoding(self, load_rule_set):
+        msg = self._make_msg(json.dumps({
+            'id': 1, 'name': 'a', 'state_name': 'init', 'scratch': False,
+            'component_builds': list(range(10)),
+        }))
+        consumer.consume(msg)
+        load_rule_set.assert_not_called()
+        assert msg._body is None
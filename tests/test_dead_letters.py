@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mock import patch
+
+from message_tagging_service import conf
+from message_tagging_service import dead_letters
+from message_tagging_service.retry_store import RetryStore
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    path = str(tmp_path / 'retries.db')
+    store = RetryStore(path)
+    store.bury({
+        'id': 1, 'name': 'ant', 'stream': '1', 'version': '1', 'context': 'c1',
+        'state_name': 'ready',
+    }, 5, 'MBS is down')
+    store.bury({'id': 2}, 0, "'name'")
+    store.close()
+    with patch.object(conf, 'retry_store_path', new=path):
+        yield path
+
+
+def test_list_dead_letters(store_path, capsys):
+    assert 0 == dead_letters.main(['list'])
+    lines = capsys.readouterr().out.splitlines()
+    assert 2 == len(lines)
+    assert lines[0].startswith('1\t')
+    assert '\tready\tant:1:1:c1\tretried 5 time(s)\tMBS is down' in lines[0]
+    assert '\tNone\t?:?:?:?\tretried 0 time(s)' in lines[1]
+
+
+@patch('message_tagging_service.dead_letters.handle_again')
+def test_replay_dead_letters(handle_again, store_path, capsys):
+    assert 0 == dead_letters.main(['replay', '1'])
+    handle_again.assert_called_once()
+    assert '1 of 1 message(s) are handled.' in capsys.readouterr().out
+
+    handle_again.side_effect = KeyError('name')
+    assert 1 == dead_letters.main(['replay'])
+
+    store = RetryStore(store_path)
+    try:
+        assert [2] == [row[0] for row in store.dead_letters()]
+    finally:
+        store.close()
+
+
+def test_retry_store_is_not_configured():
+    with pytest.raises(SystemExit):
+        dead_letters.main(['list'])
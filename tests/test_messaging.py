@@ -22,13 +22,15 @@
 import json
 import pytest
 
+from concurrent.futures import Future
+
 from message_tagging_service import messaging
-from mock import patch
+from mock import call, patch, Mock
 
 try:
-    import rhmsg
+    import proton
 except ImportError:
-    rhmsg = None
+    proton = None
 
 
 class TestMessaging(object):
@@ -44,33 +46,206 @@ class TestMessaging(object):
         outgoing_msg = Message.return_value
         publish.assert_called_once_with(outgoing_msg)
 
-    @pytest.mark.skipif(not rhmsg, reason='Library rhmsg is not available.')
+    @pytest.mark.skipif(not proton, reason='Library proton is not available.')
+    @patch.object(messaging.conf, 'dry_run', new=False)
     @patch.object(messaging.conf, 'messaging_backend', new='rhmsg')
     @patch.object(messaging.conf, 'rhmsg_brokers', new=['amqps://broker1/', 'amqps://broker2/'])
     @patch.object(messaging.conf, 'rhmsg_certificate', new='/path/to/certificate')
     @patch.object(messaging.conf, 'rhmsg_private_key', new='/path/to/private_key')
     @patch.object(messaging.conf, 'rhmsg_ca_cert', new='/path/to/ca_cert')
     @patch.object(messaging.conf, 'rhmsg_topic_prefix', new='VirtualTopic.eng.mts.')
-    @patch('proton.Message')
-    @patch('rhmsg.activemq.producer.AMQProducer')
-    def test_send_via_rhmsg(self, AMQProducer, Message):
+    @patch('proton.SSLDomain')
+    @patch('proton.utils.BlockingConnection')
+    def test_send_via_rhmsg(self, BlockingConnection, SSLDomain):
         msg = {'koji_tag': 'module-a-1-1-c1'}
         messaging.publish('build.tagged', msg)
+        messaging.publish('build.tagged', msg)
+
+        ssl_domain = SSLDomain.return_value
+        ssl_domain.set_credentials.assert_called_once_with(
+            '/path/to/certificate', '/path/to/private_key', None)
+        ssl_domain.set_trusted_ca_db.assert_called_once_with('/path/to/ca_cert')
+
+        # Connection and sender are reused by the subsequent messages
+        BlockingConnection.assert_called_once_with(
+            'amqps://broker1/', ssl_domain=ssl_domain, timeout=60)
+        connection = BlockingConnection.return_value
+        connection.create_sender.assert_called_once_with(
+            'topic://VirtualTopic.eng.mts.build.tagged')
+
+        sender = connection.create_sender.return_value
+        assert 2 == sender.link.send.call_count
+        outgoing_msg = sender.link.send.call_args[0][0]
+        assert json.dumps(msg) == outgoing_msg.body
+
+    @pytest.mark.skipif(not proton, reason='Library proton is not available.')
+    @patch.object(messaging.conf, 'rhmsg_brokers', new=['amqps://broker1/', 'amqps://broker2/'])
+    @patch('proton.SSLDomain')
+    @patch('proton.utils.BlockingConnection')
+    def test_rhmsg_producer_connects_again_if_fail_to_send(
+            self, BlockingConnection, SSLDomain):
+        broken_connection = Mock()
+        broken_connection.create_sender.return_value.link.send.side_effect = \
+            proton.ConnectionException('connection aborted')
+        connection = Mock()
+        # The first broker is not available when connect again.
+        BlockingConnection.side_effect = [
+            broken_connection, proton.ConnectionException('refused'), connection,
+        ]
+
+        producer = messaging.RhmsgProducer()
+        producer.send('topic://VirtualTopic.eng.mts.build.tagged', 'msg')
+
+        broken_connection.close.assert_called_once()
+        assert [
+            call('amqps://broker1/', ssl_domain=SSLDomain.return_value, timeout=60),
+            call('amqps://broker1/', ssl_domain=SSLDomain.return_value, timeout=60),
+            call('amqps://broker2/', ssl_domain=SSLDomain.return_value, timeout=60),
+        ] == BlockingConnection.call_args_list
+        connection.create_sender.return_value.link.send.assert_called_once_with('msg')
 
-        config = {
-            'urls': ['amqps://broker1/', 'amqps://broker2/'],
-            'certificate': '/path/to/certificate',
-            'private_key': '/path/to/private_key',
-            'trusted_certificates': '/path/to/ca_cert',
-        }
-        AMQProducer.assert_called_once_with(**config)
-        producer = AMQProducer.return_value.__enter__.return_value
-        producer.through_topic.assert_called_once_with('VirtualTopic.eng.mts.build.tagged')
+        producer.close()
+        connection.close.assert_called_once()
 
-        Message.return_value.body = json.dumps(msg)
-        producer.send.assert_called_once_with(Message.return_value)
+    @pytest.mark.skipif(not proton, reason='Library proton is not available.')
+    @patch.object(messaging.conf, 'rhmsg_brokers', new=['amqps://broker1/'])
+    @patch('proton.SSLDomain')
+    @patch('proton.utils.BlockingConnection')
+    def test_rhmsg_producer_sends_messages_together(self, BlockingConnection, SSLDomain):
+        connection = BlockingConnection.return_value
+        link = connection.create_sender.return_value.link
+        deliveries = [Mock(settled=False), Mock(settled=False)]
+        link.send.side_effect = deliveries
+
+        def wait(condition, **kwargs):
+            # Both messages are sent before waiting for them to be settled.
+            assert 2 == link.send.call_count
+            assert not condition()
+            for dlv in deliveries:
+                dlv.settled = True
+            assert condition()
+
+        connection.wait.side_effect = wait
+
+        producer = messaging.RhmsgProducer()
+        producer.send('topic://VirtualTopic.eng.mts.build.tagged', 'msg1', 'msg2')
+        producer.close()
+
+        connection.wait.assert_called_once()
+
+    @pytest.mark.skipif(not proton, reason='Library proton is not available.')
+    @patch.object(messaging.conf, 'rhmsg_brokers', new=['amqps://broker1/'])
+    @patch('proton.SSLDomain')
+    @patch('proton.utils.BlockingConnection')
+    def test_rhmsg_producer_raises_error_if_message_is_rejected(
+            self, BlockingConnection, SSLDomain):
+        from proton.utils import SendException
+
+        link = BlockingConnection.return_value.create_sender.return_value.link
+        link.send.return_value = Mock(settled=True, remote_state=proton.Delivery.REJECTED)
+
+        producer = messaging.RhmsgProducer()
+        with pytest.raises(SendException):
+            producer.send('topic://VirtualTopic.eng.mts.build.tagged', 'msg')
+        producer.close()
 
     @patch.object(messaging.conf, 'messaging_backend', new='anothercool')
     def test_no_backend_handler_is_found(self):
         with pytest.raises(KeyError):
             messaging.publish('topic', {})
+
+
+@patch.object(messaging.conf, 'messaging_async_publish', new=True)
+@patch.object(messaging.conf, 'messaging_backend', new='fake')
+class TestPublishQueue(object):
+    """Test messages are published from the publish queue"""
+
+    def setup_method(self, test_method):
+        self.sent = []
+        self.p_backends = patch.dict(messaging._messaging_backends, {
+            'fake': {'publish': self.fake_publish},
+        })
+        self.p_backends.start()
+
+    def teardown_method(self, test_method):
+        messaging.publish_queue.stop()
+        self.p_backends.stop()
+
+    def fake_publish(self, topic, msg):
+        if msg.get('fail'):
+            raise IOError('broker is down')
+        self.sent.append((topic, msg))
+        return len(self.sent)
+
+    def test_publish_returns_future(self):
+        future = messaging.publish('build.tagged', {'build_id': 1})
+        assert 1 == future.result(timeout=5)
+        assert [('build.tagged', {'build_id': 1})] == self.sent
+
+    def test_failed_message_does_not_stop_the_queue(self):
+        futures = [
+            messaging.publish('build.tagged', {'build_id': 1, 'fail': True}),
+            messaging.publish('build.tagged', {'build_id': 2}),
+        ]
+        with pytest.raises(IOError, match='broker is down'):
+            futures[0].result(timeout=5)
+        assert 1 == futures[1].result(timeout=5)
+
+    def test_send_messages_of_same_topic_in_batch(self):
+        batches = []
+
+        def fake_publish_batch(topic, msgs):
+            if any(msg.get('fail') for msg in msgs):
+                raise IOError('broker is down')
+            batches.append((topic, msgs))
+
+        items = [
+            ('build.tag.requested', {'build_id': 1}, Future()),
+            ('build.tagged', {'build_id': 1, 'fail': True}, Future()),
+            ('build.tag.requested', {'build_id': 2}, Future()),
+        ]
+        with patch.dict(messaging._messaging_backends['fake'],
+                        {'publish_batch': fake_publish_batch}):
+            messaging.PublishQueue()._flush(items)
+
+        assert [
+            ('build.tag.requested', [{'build_id': 1}, {'build_id': 2}]),
+        ] == batches
+        assert [] == self.sent
+        assert [None, None] == [items[0][2].result(), items[2][2].result()]
+        assert isinstance(items[1][2].exception(), IOError)
+
+    def test_send_queued_messages_when_stop(self):
+        futures = [messaging.publish('build.tagged', {'build_id': i}) for i in range(10)]
+        messaging.publish_queue.stop()
+
+        assert all(f.done() for f in futures)
+        assert [('build.tagged', {'build_id': i}) for i in range(10)] == self.sent
+
+
+@patch.object(messaging.conf, 'messaging_backend', new='fake')
+@patch.object(messaging.conf, 'outbox_replay_interval', new=0)
+class TestOutboxPublish(object):
+    """Test failed messages are saved in outbox and replayed"""
+
+    def test_save_failed_message_and_replay(self, tmp_path):
+        handler = Mock(side_effect=IOError('broker is down'))
+        backends = {'fake': {'publish': handler}}
+        with patch.dict(messaging._messaging_backends, backends), \
+                patch.object(messaging.conf, 'outbox_path', new=str(tmp_path / 'outbox.db')):
+            messaging.publish('build.tag.requested', {'nvr': 'a-1-1.c1'})
+            assert 1 == len(messaging.get_outbox())
+
+            # Broker is still down
+            assert 0 == messaging.replay_outbox()
+
+            handler.side_effect = None
+            assert 1 == messaging.replay_outbox()
+            assert 0 == len(messaging.get_outbox())
+            handler.assert_called_with('build.tag.requested', {'nvr': 'a-1-1.c1'})
+
+    def test_message_is_lost_without_outbox(self):
+        handler = Mock(side_effect=IOError('broker is down'))
+        with patch.dict(messaging._messaging_backends, {'fake': {'publish': handler}}):
+            assert messaging.publish('build.tag.requested', {}) is None
+        assert messaging.get_outbox() is None
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mock import patch
+
+from message_tagging_service.modulemd_store import ModulemdStore
+
+
+class TestModulemdStore(object):
+    """Test ModulemdStore"""
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        store = ModulemdStore(str(tmp_path / 'modulemd.db'), max_size=10)
+        yield store
+        store.close()
+
+    def test_get_content(self, store):
+        store.put(1, 'data: {}')
+        assert 'data: {}' == store.get(1)
+        assert store.get(2) is None
+
+    @patch('time.time')
+    def test_recent(self, time, store):
+        for i, build_id in enumerate((1, 2, 3)):
+            time.return_value = i
+            store.put(build_id, f'{build_id}')
+        time.return_value = 10
+        store.get(1)
+
+        assert [(1, '1'), (3, '3')] == store.recent(2)
+
+    @patch('time.time')
+    def test_compact_removes_least_recently_used(self, time, store):
+        for i, build_id in enumerate((1, 2, 3)):
+            time.return_value = i
+            store.put(build_id, 'x' * 4)
+        time.return_value = 10
+        store.get(1)
+
+        assert 1 == store.compact()
+        assert 8 == store.size
+        assert store.get(2) is None
+        assert 0 == store.compact()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mock import Mock, call
+
+from message_tagging_service.outbox import Outbox
+
+
+class TestOutbox(object):
+    """Test Outbox"""
+
+    @pytest.fixture
+    def outbox(self, tmp_path):
+        outbox = Outbox(str(tmp_path / 'outbox.db'))
+        yield outbox
+        outbox.close()
+
+    def test_replay_in_order(self, outbox):
+        for i in range(5):
+            outbox.put('build.tag.requested', {'id': i})
+
+        send = Mock()
+        assert 5 == outbox.replay(send, batch_size=2)
+        assert [call('build.tag.requested', {'id': i}) for i in range(5)] == \
+            send.call_args_list
+        assert 0 == len(outbox)
+
+    def test_stop_replay_at_first_failure(self, outbox):
+        for i in range(3):
+            outbox.put('build.tag.requested', {'id': i})
+
+        send = Mock(side_effect=[None, IOError('broker is down')])
+        assert 1 == outbox.replay(send)
+        assert 2 == len(outbox)
+
+        send = Mock()
+        assert 2 == outbox.replay(send)
+        assert [call('build.tag.requested', {'id': i}) for i in (1, 2)] == \
+            send.call_args_list
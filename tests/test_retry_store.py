@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mock import Mock
+
+from message_tagging_service.retry_store import RetryStore
+
+
+class TestRetryStore(object):
+    """Test RetryStore"""
+
+    @pytest.fixture
+    def store(self, tmp_path):
+        store = RetryStore(str(tmp_path / 'retries.db'))
+        yield store
+        store.close()
+
+    def test_update_and_remove(self, store):
+        retry_id = store.add({'id': 1}, 0, 100, 'error')
+        store.update(retry_id, 1, 200, 'another error')
+        assert [(200, retry_id)] == store.pending()
+        assert ({'id': 1}, 1) == store.get(retry_id)
+
+        store.remove(retry_id)
+        assert store.get(retry_id) is None
+        assert 0 == len(store)
+
+    def test_bury(self, store):
+        retry_id = store.add({'id': 1}, 0, 100)
+        store.bury({'id': 1}, 3, 'error', retry_id=retry_id)
+        store.bury({'id': 2}, 0, 'invalid message')
+
+        assert 0 == len(store)
+        assert [
+            (1, {'id': 1}, 3, 'error'),
+            (2, {'id': 2}, 0, 'invalid message'),
+        ] == [row[:4] for row in store.dead_letters()]
+
+    def test_replay_dead_letters(self, store):
+        for build_id in (1, 2, 3):
+            store.bury({'id': build_id}, 5, 'error')
+        handle = Mock(side_effect=[None, ValueError('still failing')])
+
+        assert 1 == store.replay_dead_letters(handle, ids=[1, 2])
+
+        assert [
+            (2, {'id': 2}, 5, 'still failing'),
+            (3, {'id': 3}, 5, 'error'),
+        ] == [row[:4] for row in store.dead_letters()]
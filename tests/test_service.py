@@ -4,7 +4,9 @@ import contextlib
 import koji
 import os
 import pytest
+import threading
 
+from mock import MagicMock
 from mock import Mock
 from mock import call
 from mock import patch
@@ -36,6 +38,19 @@ def mock_get_rule_file(rule_file):
         yield
 
 
+class MultiCallResult(object):
+    """Fake result of a call inside Koji multicall"""
+
+    def __init__(self, value):
+        self.value = value
+
+    @property
+    def result(self):
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
 class TestRuleDefinitionCheck(object):
     """Test rule_matches_module_build"""
 
@@ -151,6 +166,234 @@ class TestRuleDefinitionCheck(object):
         assert ['f28-modular-ursamajor'] == match.dest_tags
 
 
+class TestRuleSet(object):
+    """Test RuleSet"""
+
+    rule_defs = [
+        {
+            'id': 'Match by platform',
+            'type': 'module',
+            'rule': {
+                'dependencies': {
+                    'requires': {'platform': r'^(?P<platform>f\d+)$'}
+                },
+            },
+            'destinations': r'\g<platform>-modular-updates',
+        },
+        {
+            'id': 'Gating',
+            'type': 'module',
+            'rule': {'build_state': 'done'},
+            'destinations': 'modular-gating',
+        },
+    ]
+
+    def test_group_rules_by_build_state(self):
+        rule_set = tagging_service.RuleSet(self.rule_defs, revision='1')
+
+        assert 2 == len(rule_set)
+        assert {'ready', 'done'} == rule_set.build_states
+        assert ['Match by platform'] == [r.id for _, r in rule_set.rules_for('ready')]
+        assert [(2, 'Gating')] == [(i, r.id) for i, r in rule_set.rules_for('done')]
+        assert () == rule_set.rules_for('build')
+        # build_state is not a match criteria and rule definition passed in is
+        # not changed.
+        assert {} == rule_set.rules_for('done')[0][1].rule
+        assert {'build_state': 'done'} == self.rule_defs[1]['rule']
+
+    def test_reuse_rule_set_to_match(self):
+        rule_set = tagging_service.RuleSet(self.rule_defs)
+
+        for platform in ('f29', 'f30'):
+            modulemd = {'data': {
+                'dependencies': [{'requires': {'platform': [platform]}}]
+            }}
+            match = rule_set.match(modulemd, 'ready')
+            assert [f'{platform}-modular-updates'] == match.dest_tags
+
+        modulemd = {'data': {
+            'dependencies': [{'requires': {'platform': ['el8']}}]
+        }}
+        assert not rule_set.match(modulemd, 'ready')
+        assert ['modular-gating'] == rule_set.match(modulemd, 'done').dest_tags
+
+    @pytest.mark.parametrize('rule_defs,error', [
+        [{'id': 'rule'}, 'should contain a list'],
+        [[{'id': 'rule', 'type': 'module'}], 'does not have property destinations'],
+        [[{'id': 'rule', 'type': 'module', 'rule': {'name': '(a'},
+           'destinations': 'tag'}],
+         'invalid regular expression'],
+    ])
+    def test_raise_error_if_rule_definition_is_invalid(self, rule_defs, error):
+        with pytest.raises(ValueError, match=error):
+            tagging_service.RuleSet(rule_defs)
+
+    def test_match_event_without_modulemd(self):
+        rule_set = tagging_service.RuleSet([
+            {
+                'id': 'Match by name',
+                'type': 'module',
+                'rule': {'name': ['^ant$'], 'stream': r'^(?P<stream>\d+)$', 'scratch': False},
+                'destinations': r'ant-\g<stream>',
+            },
+        ] + self.rule_defs)
+        get_modulemd = Mock()
+        event_msg = {'name': 'ant', 'stream': '1', 'version': '1', 'context': 'c1'}
+
+        match = rule_set.match(get_modulemd, 'ready', event_msg=event_msg)
+
+        assert ['ant-1'] == match.dest_tags
+        get_modulemd.assert_not_called()
+
+    def test_retrieve_modulemd_if_rule_requires_it(self):
+        rule_set = tagging_service.RuleSet(self.rule_defs + [
+            {
+                'id': 'Match by name',
+                'type': 'module',
+                'rule': {'name': 'ant'},
+                'destinations': 'ant',
+            },
+        ])
+        modulemd = {'data': {
+            'name': 'ant',
+            'dependencies': [{'requires': {'platform': ['f29']}}],
+        }}
+        get_modulemd = Mock(return_value=modulemd)
+        event_msg = {'name': 'ant', 'stream': '1', 'version': '1', 'context': 'c1'}
+
+        # The first rule checks dependencies, which has to be matched first.
+        match = rule_set.match(get_modulemd, 'ready', event_msg=event_msg)
+
+        assert ['f29-modular-updates'] == match.dest_tags
+        get_modulemd.assert_called_once_with()
+
+    @pytest.mark.parametrize('rule', [
+        {'development': True},
+        {'version': 1},
+        {'name': 'ant', 'dependencies': {'requires': {'platform': 'f29'}}},
+    ])
+    def test_rule_cannot_match_with_event_properties(self, rule):
+        rule_def = tagging_service.RuleDef({
+            'id': 'rule', 'type': 'module', 'rule': rule, 'destinations': 'tag',
+        })
+        assert not rule_def.can_match_with({'name', 'stream', 'version', 'context'})
+
+    def test_empty_rule_set(self):
+        rule_set = tagging_service.RuleSet(None)
+        assert not rule_set
+        assert frozenset() == rule_set.build_states
+
+    @pytest.mark.parametrize('name,literal_names', [
+        ('^ant$', {'ant'}),
+        (r'^python\-ant$', {'python-ant'}),
+        (['^ant$', '^maven$'], {'ant', 'maven'}),
+        (['^ant$', '-ursamajor$'], None),
+        ('ant', None),
+        (r'^ant\d$', None),
+        ('^(ant|maven)$', None),
+        (None, None),
+    ])
+    def test_rule_literal_names(self, name, literal_names):
+        rule = {'stream': '1'} if name is None else {'name': name}
+        rule_def = tagging_service.RuleDef({
+            'id': 'rule', 'type': 'module', 'rule': rule, 'destinations': 'tag',
+        })
+        expected = None if literal_names is None else frozenset(literal_names)
+        assert expected == rule_def.literal_names
+
+    def test_rule_set_admits(self):
+        rule_set = tagging_service.RuleSet([
+            {'id': 'a', 'type': 'module', 'destinations': 'tag',
+             'rule': {'name': '^ant$'}},
+            {'id': 'b', 'type': 'module', 'destinations': 'tag',
+             'rule': {'name': ['^maven$'], 'stream': '^3$'}},
+            {'id': 'c', 'type': 'module', 'destinations': 'tag',
+             'rule': {'build_state': 'done', 'stream': '^3$'}},
+        ])
+        assert rule_set.admits('ready', 'ant')
+        assert rule_set.admits('ready', 'maven')
+        assert rule_set.admits('ready')
+        assert not rule_set.admits('ready', 'javapackages-tools')
+        assert rule_set.admits('done', 'javapackages-tools')
+        assert not rule_set.admits('failed', 'ant')
+
+    def test_rule_set_properties(self):
+        rule_set = tagging_service.RuleSet([
+            {'id': 'a', 'type': 'module', 'destinations': 'tag',
+             'rule': {'name': 'ant', 'scratch': False}},
+            {'id': 'b', 'type': 'module', 'destinations': 'tag', 'build_state': 'done',
+             'rule': {'dependencies': {'requires': {'platform': 'f29'}}}},
+        ])
+        assert frozenset(['name', 'dependencies']) == rule_set.properties
+
+    @mock_get_rule_file(os.path.join(test_data_dir, 'mts-test-rules.yaml'))
+    def test_load_rule_set_once_per_revision(self):
+        rule_set = tagging_service.load_rule_set()
+        assert rule_set is tagging_service.load_rule_set()
+
+        # Rules file is changed and the cached content expires.
+        with patch('requests.get') as get:
+            get.return_value.text = dedent("""\
+                - id: Fallback
+                  type: module
+                  destinations: modular-fallback-tag
+                """)
+            with patch.object(tagging_service.conf, 'rules_cache_ttl', new=0):
+                new_rule_set = tagging_service.load_rule_set()
+
+        assert new_rule_set is not rule_set
+        assert 1 == len(new_rule_set)
+
+
+class TestGetModulemd(object):
+    """Test get_modulemd"""
+
+    @patch('message_tagging_service.tagging_service.retrieve_modulemd_content')
+    def test_retrieve_modulemd_once(self, retrieve_modulemd_content):
+        retrieve_modulemd_content.return_value = dedent('''\
+            ---
+            document: modulemd
+            version: 2
+            data:
+              name: ant
+            ''')
+
+        modulemd = tagging_service.get_modulemd(1)
+        assert {'name': 'ant'} == modulemd['data']
+        assert modulemd is tagging_service.get_modulemd(1)
+        retrieve_modulemd_content.assert_called_once_with(1)
+
+        tagging_service.get_modulemd(2)
+        assert 2 == retrieve_modulemd_content.call_count
+
+    @patch('message_tagging_service.tagging_service.retrieve_modulemd_content')
+    def test_reparse_for_more_properties(self, retrieve_modulemd_content):
+        retrieve_modulemd_content.return_value = dedent('''\
+            ---
+            document: modulemd
+            version: 2
+            data:
+              name: ant
+              stream: "1"
+              components:
+                rpms:
+                  ant: {rationale: main}
+            ''')
+
+        modulemd = tagging_service.get_modulemd(1, frozenset(['name']))
+        assert {'data': {'name': 'ant'}} == modulemd
+        assert modulemd is tagging_service.get_modulemd(1, frozenset())
+
+        modulemd = tagging_service.get_modulemd(1, frozenset(['name', 'stream']))
+        assert {'data': {'name': 'ant', 'stream': '1'}} == modulemd
+        assert 2 == retrieve_modulemd_content.call_count
+
+        modulemd = tagging_service.get_modulemd(1)
+        assert 'components' in modulemd['data']
+        assert modulemd is tagging_service.get_modulemd(1, frozenset(['name']))
+        assert 3 == retrieve_modulemd_content.call_count
+
+
 class TestMatchRuleDefinitions(object):
 
     def setup_method(self, test_method):
@@ -430,6 +673,116 @@ class TestMatchRuleDefinitions(object):
             }),
         ], any_order=True)
 
+    @patch.object(tagging_service.conf, 'koji_multicall', new=True)
+    @mock_get_rule_file(os.path.join(test_data_dir, 'mts-test-rules.yaml'))
+    def test_tag_builds_in_multicall(self):
+        self.mock_retrieve_modulemd_content.return_value = dedent('''\
+            ---
+            document: modulemd
+            version: 2
+            data:
+              name: javapackages-tools
+              stream: 1
+              version: 1
+              context: c1
+              dependencies:
+              - buildrequires:
+                  platform: [f29]
+                requires:
+                  platform: [f29, f28]
+            ''')
+
+        session = self.mock_ClientSession.return_value
+        multicall = session.multicall.return_value.__enter__.return_value
+        multicall.tagBuild.side_effect = [
+            MultiCallResult(1),
+            MultiCallResult(koji.TagError('failed to tag build')),
+            MultiCallResult(3),
+            MultiCallResult(4),
+        ]
+
+        tagging_service.handle(read_rule_defs(), {
+            'id': 1,
+            'name': 'javapackages-tools',
+            'stream': '1',
+            'version': '1',
+            'context': 'c1',
+            'state_name': 'ready',
+        })
+
+        nvr = 'javapackages-tools-1-1.c1'
+        nvr_devel = 'javapackages-tools-devel-1-1.c1'
+        session.multicall.assert_called_once_with(strict=False)
+        assert [
+            call('f29-modular-ursamajor', nvr),
+            call('f28-modular-ursamajor', nvr),
+            call('f29-modular-ursamajor', nvr_devel),
+            call('f28-modular-ursamajor', nvr_devel),
+        ] == multicall.tagBuild.call_args_list
+        session.tagBuild.assert_not_called()
+
+        self.mock_publish.assert_has_calls([
+            call('build.tag.requested', {
+                'build': {
+                    'id': 1, 'name': 'javapackages-tools',
+                    'stream': '1', 'version': '1', 'context': 'c1',
+                },
+                'nvr': nvr,
+                'destination_tags': [
+                    {'tag': 'f29-modular-ursamajor', 'task_id': 1},
+                    {
+                        'tag': 'f28-modular-ursamajor',
+                        'task_id': None,
+                        'error': 'failed to tag build',
+                    },
+                ],
+            }),
+            call('build.tag.requested', {
+                'build': {
+                    'id': 1, 'name': 'javapackages-tools-devel',
+                    'stream': '1', 'version': '1', 'context': 'c1',
+                },
+                'nvr': nvr_devel,
+                'destination_tags': [
+                    {'tag': 'f29-modular-ursamajor', 'task_id': 3},
+                    {'tag': 'f28-modular-ursamajor', 'task_id': 4},
+                ],
+            }),
+        ])
+
+    def test_all_tag_builds_fail_if_multicall_fails(self):
+        session = Mock()
+        session.multicall.return_value.__enter__ = Mock(
+            side_effect=koji.GenericError('hub is down'))
+        session.multicall.return_value.__exit__ = Mock()
+
+        with patch.object(tagging_service.conf, 'dry_run', new=False):
+            result = tagging_service.tag_builds(
+                [('f29-modular', 'a-1-1.c1'), ('f29-modular', 'a-devel-1-1.c1')],
+                session)
+
+        assert [
+            tagging_service.TagBuildResult('f29-modular', None, 'hub is down'),
+            tagging_service.TagBuildResult('f29-modular', None, 'hub is down'),
+        ] == result
+
+    @pytest.mark.parametrize('multicall', [True, False])
+    def test_raise_error_if_koji_is_unavailable(self, multicall):
+        breaker = tagging_service.koji_breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        session = MagicMock()
+
+        with patch.object(tagging_service.conf, 'dry_run', new=False):
+            with pytest.raises(tagging_service.CircuitOpenError):
+                if multicall:
+                    tagging_service.tag_builds([('f29-modular', 'a-1-1.c1')], session)
+                else:
+                    tagging_service.tag_build('a-1-1.c1', ['f29-modular'], session)
+
+        session.tagBuild.assert_not_called()
+        session.multicall.return_value.__enter__.return_value.tagBuild.assert_not_called()
+
     @mock_get_rule_file(os.path.join(test_data_dir, 'mts-test-rules.yaml'))
     def test_tag_build_with_complex_destination(self):
         self.mock_retrieve_modulemd_content.return_value = dedent('''\
@@ -579,3 +932,498 @@ class TestLoginKoji(object):
                 'serverca': '',
                 'debug': False,
             })
+
+
+class KojiSessionStub(object):
+    """Fake koji.ClientSession counting how many times it is logged in"""
+
+    logins = 0
+
+    def __init__(self, server, opts=None):
+        self.logged_in = False
+        self.expired = False
+
+    def gssapi_login(self, **kwargs):
+        KojiSessionStub.logins += 1
+        self.logged_in = True
+        self.expired = False
+
+    def getAPIVersion(self):
+        return 1
+
+    def setSession(self, sinfo):
+        self.logged_in = sinfo is not None
+
+    def logout(self):
+        self.logged_in = False
+
+    def tagBuild(self, tag, nvr):
+        if self.expired:
+            raise koji.AuthError('could not find session')
+        return 1
+
+
+@patch('koji.read_config', return_value=koji_config_krb_auth)
+@patch('koji.ClientSession', new=KojiSessionStub)
+class TestKojiSessionPool(object):
+    """Test KojiSessionPool"""
+
+    def setup_method(self, test_method):
+        KojiSessionStub.logins = 0
+        self.pool = tagging_service.KojiSessionPool()
+
+    def teardown_method(self, test_method):
+        self.pool.close()
+
+    def test_reuse_logged_in_session(self, read_config):
+        for i in range(3):
+            with self.pool.session() as session:
+                assert session.logged_in
+
+        assert 1 == KojiSessionStub.logins
+        read_config.assert_called_once()
+
+    @patch.object(tagging_service.conf, 'koji_max_sessions', new=1)
+    def test_limit_number_of_sessions(self, read_config):
+        session = self.pool.acquire()
+        with pytest.raises(RuntimeError, match='No Koji session is available'):
+            self.pool.acquire(timeout=0.01)
+
+        self.pool.release(session)
+        assert session is self.pool.acquire(timeout=0.01)
+
+    @patch.object(tagging_service.conf, 'koji_max_sessions', new=1)
+    def test_release_session_after_pool_is_closed(self, read_config):
+        session = self.pool.acquire()
+        self.pool.close()
+
+        self.pool.release(session)
+        assert not session.logged_in
+        # Pool is usable again with a new session.
+        new_session = self.pool.acquire(timeout=0.01)
+        assert new_session is not session
+        self.pool.release(new_session)
+
+    def test_login_again_if_session_is_logged_out(self, read_config):
+        with self.pool.session() as session:
+            session.logout()
+        with self.pool.session() as session:
+            assert session.logged_in
+        assert 2 == KojiSessionStub.logins
+
+    def test_discard_session_on_auth_error(self, read_config):
+        with pytest.raises(koji.AuthError):
+            with self.pool.session() as session:
+                raise koji.AuthError('could not find session')
+        with self.pool.session() as new_session:
+            assert new_session is not session
+
+    def test_tag_build_logs_in_again_if_session_expires(self, read_config):
+        with patch.object(tagging_service, 'koji_session_pool', new=self.pool):
+            with self.pool.session() as session:
+                session.expired = True
+                result = tagging_service.tag_build(
+                    'javapackages-tools-1-1.c1', ['f29-modular-ursamajor'], session)
+
+        assert [tagging_service.TagBuildResult(
+            tag_name='f29-modular-ursamajor', task_id=1, error=None)] == result
+        assert 2 == KojiSessionStub.logins
+
+    @patch.object(tagging_service.conf, 'dry_run', new=False)
+    @patch('message_tagging_service.messaging.publish')
+    @patch('message_tagging_service.tagging_service.retrieve_modulemd_content')
+    def test_log_in_once_to_handle_messages(
+            self, retrieve_modulemd_content, publish, read_config):
+        retrieve_modulemd_content.return_value = dedent('''\
+            ---
+            document: modulemd
+            version: 2
+            data:
+              name: javapackages-tools
+              dependencies:
+              - requires:
+                  platform: [f29]
+            ''')
+        rule_set = tagging_service.RuleSet([{
+            'id': 'Fallback', 'type': 'module', 'destinations': 'modular-fallback-tag',
+        }])
+
+        with patch.object(tagging_service, 'koji_session_pool', new=self.pool):
+            for i in range(3):
+                tagging_service.handle(rule_set, {
+                    'id': i,
+                    'name': 'javapackages-tools',
+                    'stream': '1',
+                    'version': str(i),
+                    'context': 'c1',
+                    'state_name': 'ready',
+                })
+
+        assert 6 == publish.call_count
+        assert 1 == KojiSessionStub.logins
+
+
+@patch.object(tagging_service.conf, 'modulemd_store_compact_interval', new=0)
+def test_warm_modulemd_cache_from_store(tmp_path):
+    with patch.object(tagging_service.conf, 'modulemd_store_path',
+                      new=str(tmp_path / 'modulemd.db')):
+        tagging_service.get_modulemd_store().put(1, 'data: {name: ant}')
+        assert 1 == tagging_service.warm_modulemd_cache()
+
+    with patch('message_tagging_service.tagging_service.retrieve_modulemd_content') as r:
+        assert {'data': {'name': 'ant'}} == tagging_service.get_modulemd(1)
+        r.assert_not_called()
+
+
+class ConcurrentKojiSessionStub(KojiSessionStub):
+    """Fake koji.ClientSession whose tagBuild waits for all the others"""
+
+    barrier = None
+
+    def tagBuild(self, tag, nvr):
+        self.barrier.wait()
+        if tag == 'f28-modular':
+            raise koji.TagError(f'failed to tag {nvr}')
+        return f'{tag}/{nvr}'
+
+
+@patch('koji.read_config', return_value=koji_config_krb_auth)
+@patch('koji.ClientSession', new=ConcurrentKojiSessionStub)
+@patch.object(tagging_service.conf, 'dry_run', new=False)
+@patch.object(tagging_service.conf, 'koji_tag_workers', new=4)
+@patch.object(tagging_service.conf, 'koji_max_sessions', new=4)
+def test_request_tag_builds_concurrently(read_config):
+    # All of the 4 requests have to be sent at the same time to pass the barrier.
+    ConcurrentKojiSessionStub.barrier = threading.Barrier(4, timeout=5)
+    pool = tagging_service.KojiSessionPool()
+    try:
+        with patch.object(tagging_service, 'koji_session_pool', new=pool):
+            results = tagging_service.request_tag_builds(
+                ['ant-1-1.c1', 'ant-devel-1-1.c1'], ['f29-modular', 'f28-modular'])
+    finally:
+        pool.close()
+
+    TagBuildResult = tagging_service.TagBuildResult
+    assert [
+        [
+            TagBuildResult('f29-modular', 'f29-modular/ant-1-1.c1', None),
+            TagBuildResult('f28-modular', None, 'failed to tag ant-1-1.c1'),
+        ],
+        [
+            TagBuildResult('f29-modular', 'f29-modular/ant-devel-1-1.c1', None),
+            TagBuildResult('f28-modular', None, 'failed to tag ant-devel-1-1.c1'),
+        ],
+    ] == results
+
+
+class TestTagLedgerUsage(object):
+    """Test tags requested already are not requested again"""
+
+    @pytest.fixture(autouse=True)
+    def ledger(self, tmp_path):
+        with patch.object(tagging_service.conf, 'tag_ledger_path',
+                          new=str(tmp_path / 'tag_ledger.db')), \
+                patch.object(tagging_service.conf, 'dry_run', new=False):
+            yield tagging_service.get_tag_ledger()
+
+    def _set_task_states(self, session, *states):
+        multicall = session.multicall.return_value.__enter__.return_value
+        multicall.getTaskInfo.side_effect = [
+            MultiCallResult({'state': koji.TASK_STATES[state]}) for state in states
+        ]
+        return multicall
+
+    def test_skip_requested_tags(self, ledger):
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        session = MagicMock()
+        multicall = self._set_task_states(session, 'OPEN')
+        session.tagBuild.side_effect = [2, koji.TagError('failed')]
+
+        result = tagging_service.tag_build(
+            'ant-1-1.c1', ['f29-modular', 'f28-modular', 'f30-modular'], session)
+
+        assert [
+            tagging_service.TagBuildResult('f29-modular', 1, None, True),
+            tagging_service.TagBuildResult('f28-modular', 2, None),
+            tagging_service.TagBuildResult('f30-modular', None, 'failed'),
+        ] == result
+        assert [
+            call('f28-modular', 'ant-1-1.c1'),
+            call('f30-modular', 'ant-1-1.c1'),
+        ] == session.tagBuild.call_args_list
+        multicall.getTaskInfo.assert_called_once_with(1)
+        assert 2 == ledger.get('ant-1-1.c1', 'f28-modular')
+        assert ledger.get('ant-1-1.c1', 'f30-modular') is None
+
+    @pytest.mark.parametrize('task_info', [
+        MultiCallResult({'state': koji.TASK_STATES['FAILED']}),
+        MultiCallResult({'state': koji.TASK_STATES['CANCELED']}),
+        # Task does not exist
+        MultiCallResult(None),
+    ])
+    def test_request_again_if_task_failed(self, task_info, ledger):
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        session = MagicMock()
+        multicall = session.multicall.return_value.__enter__.return_value
+        multicall.getTaskInfo.side_effect = [task_info]
+        session.tagBuild.side_effect = [2]
+
+        result = tagging_service.tag_build('ant-1-1.c1', ['f29-modular'], session)
+
+        assert [tagging_service.TagBuildResult('f29-modular', 2, None)] == result
+        assert 2 == ledger.get('ant-1-1.c1', 'f29-modular')
+
+    def test_skip_if_task_state_is_unknown(self, ledger):
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        session = MagicMock()
+        multicall = session.multicall.return_value.__enter__.return_value
+        multicall.getTaskInfo.side_effect = [MultiCallResult(koji.GenericError('error'))]
+
+        result = tagging_service.tag_build('ant-1-1.c1', ['f29-modular'], session)
+
+        assert [tagging_service.TagBuildResult('f29-modular', 1, None, True)] == result
+        session.tagBuild.assert_not_called()
+
+    def test_skip_requested_tags_in_multicall(self, ledger):
+        ledger.put('ant-devel-1-1.c1', 'f29-modular', 1)
+        session = MagicMock()
+        multicall = self._set_task_states(session, 'OPEN', 'CLOSED')
+        multicall.tagBuild.side_effect = [MultiCallResult(2)]
+
+        result = tagging_service.tag_builds(
+            [('f29-modular', 'ant-1-1.c1'), ('f29-modular', 'ant-devel-1-1.c1')], session)
+
+        assert [
+            tagging_service.TagBuildResult('f29-modular', 2, None),
+            tagging_service.TagBuildResult('f29-modular', 1, None, True),
+        ] == result
+        multicall.tagBuild.assert_called_once_with('f29-modular', 'ant-1-1.c1')
+
+        # Nothing is requested if all of tags are requested already.
+        multicall.tagBuild.reset_mock()
+        result = tagging_service.tag_builds([('f29-modular', 'ant-1-1.c1')], session)
+        assert [tagging_service.TagBuildResult('f29-modular', 2, None, True)] == result
+        multicall.tagBuild.assert_not_called()
+
+    @patch('message_tagging_service.messaging.publish')
+    @patch('message_tagging_service.tagging_service.make_koji_session')
+    def test_report_skipped_tags(self, make_koji_session, publish, ledger):
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        ledger.put('ant-devel-1-1.c1', 'f29-modular', 2)
+        session = make_koji_session.return_value.__enter__.return_value
+        self._set_task_states(session, 'CLOSED', 'OPEN')
+
+        tagging_service.handle([{
+            'id': 'ant', 'type': 'module', 'destinations': 'f29-modular',
+            'rule': {'name': '^ant$'},
+        }], {
+            'id': 1, 'name': 'ant', 'stream': '1', 'version': '1', 'context': 'c1',
+            'state_name': 'ready',
+        })
+
+        session.tagBuild.assert_not_called()
+        publish.assert_has_calls([
+            call('build.tag.requested', {
+                'build': {
+                    'id': 1, 'name': 'ant',
+                    'stream': '1', 'version': '1', 'context': 'c1',
+                },
+                'nvr': 'ant-1-1.c1',
+                'destination_tags': [
+                    {'tag': 'f29-modular', 'task_id': 1, 'skipped': True},
+                ],
+            }),
+            call('build.tag.requested', {
+                'build': {
+                    'id': 1, 'name': 'ant-devel',
+                    'stream': '1', 'version': '1', 'context': 'c1',
+                },
+                'nvr': 'ant-devel-1-1.c1',
+                'destination_tags': [
+                    {'tag': 'f29-modular', 'task_id': 2, 'skipped': True},
+                ],
+            }),
+        ])
+
+
+class TestCheckBuildTags(object):
+    """Test tags which builds have in Koji already are not requested again"""
+
+    def _make_session(self, *list_tags_results):
+        session = MagicMock()
+        multicall = session.multicall.return_value.__enter__.return_value
+        multicall.listTags.side_effect = [
+            MultiCallResult(result) for result in list_tags_results
+        ]
+        return session, multicall
+
+    def test_get_build_tags_in_multicall(self):
+        session, multicall = self._make_session(
+            [{'name': 'f29-modular'}, {'name': 'f28-modular'}],
+            koji.GenericError('No such build'),
+        )
+
+        build_tags = tagging_service.get_build_tags(['ant-1-1.c1', 'ant-2-1.c1'], session)
+
+        assert {'ant-1-1.c1': frozenset(['f29-modular', 'f28-modular'])} == build_tags
+        assert [
+            call(build='ant-1-1.c1'), call(build='ant-2-1.c1'),
+        ] == multicall.listTags.call_args_list
+
+        # Tags of ant-1-1.c1 are cached.
+        session.reset_mock()
+        multicall.listTags.side_effect = [MultiCallResult([])]
+        build_tags = tagging_service.get_build_tags(['ant-1-1.c1', 'ant-2-1.c1'], session)
+        assert {
+            'ant-1-1.c1': frozenset(['f29-modular', 'f28-modular']),
+            'ant-2-1.c1': frozenset(),
+        } == build_tags
+        multicall.listTags.assert_called_once_with(build='ant-2-1.c1')
+
+    @patch.object(tagging_service.conf, 'koji_check_build_tags', new=True)
+    @patch.object(tagging_service.conf, 'dry_run', new=False)
+    def test_skip_tags_applied_already(self):
+        session, _ = self._make_session([{'name': 'f29-modular'}])
+        session.tagBuild.return_value = 2
+
+        result = tagging_service.tag_build('ant-1-1.c1', ['f29-modular', 'f28-modular'], session)
+
+        assert [
+            tagging_service.TagBuildResult('f29-modular', None, None, True),
+            tagging_service.TagBuildResult('f28-modular', 2, None),
+        ] == result
+        session.tagBuild.assert_called_once_with('f28-modular', 'ant-1-1.c1')
+
+    @patch.object(tagging_service.conf, 'koji_check_build_tags', new=True)
+    @patch.object(tagging_service.conf, 'dry_run', new=False)
+    def test_request_tags_if_failed_to_list_tags(self):
+        session = MagicMock()
+        session.multicall.return_value.__enter__.side_effect = koji.GenericError('hub is down')
+        session.tagBuild.return_value = 2
+
+        result = tagging_service.tag_build('ant-1-1.c1', ['f29-modular'], session)
+
+        assert [tagging_service.TagBuildResult('f29-modular', 2, None)] == result
+
+
+class TestKojiTaskTracker(object):
+    """Test tracking tagBuild tasks until they finish"""
+
+    build = {'id': 1, 'name': 'ant', 'stream': '1', 'version': '1', 'context': 'c1'}
+
+    @pytest.fixture
+    def session(self):
+        with patch('message_tagging_service.tagging_service.make_koji_session') as make:
+            yield make.return_value.__enter__.return_value
+
+    def _set_task_infos(self, session, *infos):
+        multicall = session.multicall.return_value.__enter__.return_value
+        multicall.getTaskInfo.side_effect = [MultiCallResult(info) for info in infos]
+        return multicall
+
+    @patch('message_tagging_service.messaging.publish')
+    def test_publish_finished_tasks(self, publish, session):
+        tracker = tagging_service.KojiTaskTracker()
+        tracker.track(1, self.build, 'ant-1-1.c1', 'f29-modular')
+        tracker.track(2, self.build, 'ant-1-1.c1', 'f28-modular')
+        tracker.track(3, self.build, 'ant-1-1.c1', 'f30-modular')
+        multicall = self._set_task_infos(
+            session,
+            {'state': koji.TASK_STATES['CLOSED']},
+            {'state': koji.TASK_STATES['FAILED']},
+            {'state': koji.TASK_STATES['OPEN']},
+        )
+
+        assert 2 == tracker.poll()
+
+        assert [call(1), call(2), call(3)] == multicall.getTaskInfo.call_args_list
+        assert [
+            call('build.tagged', {
+                'build': self.build, 'nvr': 'ant-1-1.c1', 'tag': 'f29-modular',
+                'task_id': 1, 'state': 'CLOSED',
+            }),
+            call('build.tag.failed', {
+                'build': self.build, 'nvr': 'ant-1-1.c1', 'tag': 'f28-modular',
+                'task_id': 2, 'state': 'FAILED',
+            }),
+        ] == publish.call_args_list
+        assert 1 == len(tracker)
+
+    @patch('message_tagging_service.messaging.publish')
+    def test_remove_failed_tasks_from_ledger(self, publish, session, tmp_path):
+        with patch.object(tagging_service.conf, 'tag_ledger_path',
+                          new=str(tmp_path / 'tag_ledger.db')):
+            ledger = tagging_service.get_tag_ledger()
+            tracker = tagging_service.KojiTaskTracker()
+            for task_id, tag in enumerate(['f29-modular', 'f28-modular', 'f30-modular'], 1):
+                ledger.put('ant-1-1.c1', tag, task_id)
+                tracker.track(task_id, self.build, 'ant-1-1.c1', tag)
+            self._set_task_infos(
+                session,
+                {'state': koji.TASK_STATES['CLOSED']},
+                {'state': koji.TASK_STATES['FAILED']},
+                {'state': koji.TASK_STATES['CANCELED']},
+            )
+
+            assert 3 == tracker.poll()
+
+            assert 1 == ledger.get('ant-1-1.c1', 'f29-modular')
+            assert ledger.get('ant-1-1.c1', 'f28-modular') is None
+            assert ledger.get('ant-1-1.c1', 'f30-modular') is None
+
+    @patch('message_tagging_service.messaging.publish')
+    @patch.object(tagging_service.conf, 'koji_task_poll_batch_size', new=2)
+    def test_poll_tasks_in_batches(self, publish, session):
+        tracker = tagging_service.KojiTaskTracker()
+        for task_id in (1, 2, 3):
+            tracker.track(task_id, self.build, 'ant-1-1.c1', 'f29-modular')
+        open_state = {'state': koji.TASK_STATES['OPEN']}
+        multicall = self._set_task_infos(session, open_state, open_state, open_state, None)
+
+        assert 0 == tracker.poll()
+        assert 0 == tracker.poll()
+
+        # Tasks not finished yet are checked after the others.
+        assert [call(1), call(2), call(3), call(1)] == multicall.getTaskInfo.call_args_list
+        # Task 1 does not exist.
+        assert 2 == len(tracker)
+        publish.assert_not_called()
+
+    @patch('message_tagging_service.messaging.publish')
+    @patch.object(tagging_service.conf, 'koji_task_track_timeout', new=60)
+    def test_stop_tracking_tasks_after_timeout(self, publish, session):
+        tracker = tagging_service.KojiTaskTracker()
+        with patch('time.time', return_value=1000):
+            tracker.track(1, self.build, 'ant-1-1.c1', 'f29-modular')
+        self._set_task_infos(session, {'state': koji.TASK_STATES['OPEN']})
+
+        with patch('time.time', return_value=1061):
+            assert 0 == tracker.poll()
+
+        assert 0 == len(tracker)
+        publish.assert_not_called()
+
+    @patch('message_tagging_service.messaging.publish')
+    @patch('message_tagging_service.tagging_service.make_koji_session')
+    @patch.object(tagging_service.conf, 'koji_task_poll_interval', new=3600)
+    @patch.object(tagging_service.conf, 'dry_run', new=False)
+    def test_track_requested_tasks(self, make_koji_session, publish):
+        session = make_koji_session.return_value.__enter__.return_value
+        session.tagBuild.side_effect = [1, koji.TagError('failed')]
+
+        tagging_service.handle([{
+            'id': 'ant', 'type': 'module', 'destinations': 'f29-modular',
+            'rule': {'name': '^ant'},
+        }], {
+            'id': 1, 'name': 'ant', 'stream': '1', 'version': '1', 'context': 'c1',
+            'state_name': 'ready',
+        })
+
+        tracker = tagging_service.get_task_tracker()
+        assert 1 == len(tracker)
+        assert (1, 'ant-1-1.c1', 'f29-modular') == next(
+            (task_id, task.nvr, task.tag) for task_id, task in tracker._tasks.items())
+
+    @patch.object(tagging_service.conf, 'koji_task_poll_interval', new=0)
+    def test_tracking_is_disabled(self):
+        assert tagging_service.get_task_tracker() is None
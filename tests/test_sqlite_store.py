@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from message_tagging_service.modulemd_store import ModulemdStore
+from message_tagging_service.outbox import Outbox
+from message_tagging_service.retry_store import RetryStore
+from message_tagging_service.tag_ledger import TagLedger
+
+
+class TestSqliteStore(object):
+    """Test stores based on SqliteStore"""
+
+    @pytest.mark.parametrize('open_store,add', [
+        (Outbox,
+         lambda store: store.put('build.tag.requested', {'nvr': 'a-1-1.c1'})),
+        (lambda path: ModulemdStore(path, max_size=10),
+         lambda store: store.put(1, 'data: {}')),
+        (lambda path: TagLedger(path, retention=60),
+         lambda store: store.put('ant-1-1.c1', 'f29-modular', 1)),
+        (RetryStore,
+         lambda store: store.add({'id': 1}, 0, 100, 'error')),
+    ])
+    def test_records_are_kept_across_restarts(self, tmp_path, open_store, add):
+        path = str(tmp_path / 'store.db')
+        store = open_store(path)
+        try:
+            assert 0 == len(store)
+            add(store)
+            assert 1 == len(store)
+        finally:
+            store.close()
+
+        reopened = open_store(path)
+        try:
+            assert 1 == len(reopened)
+        finally:
+            reopened.close()
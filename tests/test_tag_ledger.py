@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from mock import patch
+
+from message_tagging_service.tag_ledger import TagLedger
+
+
+class TestTagLedger(object):
+    """Test TagLedger"""
+
+    @pytest.fixture
+    def ledger(self, tmp_path):
+        ledger = TagLedger(str(tmp_path / 'tag_ledger.db'), retention=60)
+        yield ledger
+        ledger.close()
+
+    def test_get_record(self, ledger):
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        assert 1 == ledger.get('ant-1-1.c1', 'f29-modular')
+        assert ledger.get('ant-1-1.c1', 'f28-modular') is None
+        assert ledger.get('ant-devel-1-1.c1', 'f29-modular') is None
+
+    def test_remove_record(self, ledger):
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        ledger.put('ant-1-1.c1', 'f28-modular', 2)
+
+        # Requested again in another task
+        ledger.remove('ant-1-1.c1', 'f29-modular', 3)
+        assert 1 == ledger.get('ant-1-1.c1', 'f29-modular')
+
+        ledger.remove('ant-1-1.c1', 'f29-modular', 1)
+        assert ledger.get('ant-1-1.c1', 'f29-modular') is None
+        ledger.remove('ant-1-1.c1', 'f28-modular')
+        assert 0 == len(ledger)
+
+    @patch('time.time')
+    def test_records_expire(self, time, ledger):
+        time.return_value = 100
+        ledger.put('ant-1-1.c1', 'f29-modular', 1)
+        time.return_value = 150
+        ledger.put('ant-1-1.c1', 'f28-modular', 2)
+
+        time.return_value = 170
+        assert ledger.get('ant-1-1.c1', 'f29-modular') is None
+        assert 2 == ledger.get('ant-1-1.c1', 'f28-modular')
+
+        assert 1 == ledger.purge()
+        assert 1 == len(ledger)
+        assert 0 == ledger.purge()
@@ -19,18 +19,24 @@
 #
 # Authors: Chenxiong Qi <cqi@redhat.com>
 
+import io
 import pytest
+import threading
+import time
+import urllib3
 
-from mock import patch, Mock
+from mock import call, patch, Mock
+from message_tagging_service import monitor
 from message_tagging_service import utils
-from requests.exceptions import HTTPError
+from requests.exceptions import ConnectionError, HTTPError
+from textwrap import dedent
 
 
 class TestRetrieveModulemdContent(object):
     """Test utils.retrieve_modulemd_content"""
 
     @patch.object(utils.conf, 'mbs_api_url', new='https://mbs.local/')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_retrieve_the_content(self, get):
         get.return_value = Mock(status_code=200)
         fake_modulemd = 'modulemd conent'
@@ -43,11 +49,510 @@ class TestRetrieveModulemdContent(object):
         assert fake_modulemd == modulemd
         get.assert_called_once_with(
             'https://mbs.local/module-builds/1',
-            timeout=60,
+            timeout=(10, 60),
             params={'verbose': True})
 
     @patch.object(utils.conf, 'mbs_api_url', new='https://mbs.local/')
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_raise_error_if_failed_to_get_module(self, get):
         get.return_value.raise_for_status.side_effect = HTTPError('error')
         pytest.raises(HTTPError, utils.retrieve_modulemd_content, 1)
+
+
+class TestSingleFlight(object):
+    """Test utils.SingleFlight"""
+
+    def _wait_coalesced(self, flight, count):
+        counter = monitor.coalesced_requests_counter.labels(flight.name)
+        while counter._value.get() < count:
+            time.sleep(0.01)
+
+    def _run_concurrently(self, flight, func, callers):
+        results = []
+
+        def _call():
+            try:
+                results.append(flight.do(1, func))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=_call) for _ in range(callers)]
+        for t in threads:
+            t.start()
+        return threads, results
+
+    def test_coalesce_concurrent_calls(self):
+        started = threading.Event()
+        release = threading.Event()
+        func = Mock(side_effect=lambda: started.set() or release.wait() and 'content')
+        flight = utils.SingleFlight('test-coalesce')
+
+        threads, results = self._run_concurrently(flight, func, 3)
+        started.wait(5)
+        # Wait for the other callers to wait for the running call.
+        self._wait_coalesced(flight, 2)
+        release.set()
+        for t in threads:
+            t.join(5)
+
+        func.assert_called_once_with()
+        assert ['content'] * 3 == results
+
+        # The next call is not coalesced with the finished one.
+        assert 'content' == flight.do(1, func)
+        assert 2 == func.call_count
+
+    def test_pass_error_to_all_callers(self):
+        started = threading.Event()
+        release = threading.Event()
+        error = HTTPError('error')
+
+        def func():
+            started.set()
+            release.wait()
+            raise error
+
+        flight = utils.SingleFlight('test-error')
+        threads, results = self._run_concurrently(flight, func, 3)
+        started.wait(5)
+        self._wait_coalesced(flight, 2)
+        release.set()
+        for t in threads:
+            t.join(5)
+
+        assert [error] * 3 == results
+        assert not flight._calls
+
+
+class TestLoadModulemd(object):
+    """Test load_modulemd"""
+
+    content = dedent('''\
+        ---
+        document: modulemd
+        version: 2
+        data:
+          name: ant
+          stream: "1.10"
+          dependencies:
+          - requires:
+              platform: [f29]
+          components:
+            rpms:
+              ant: {rationale: main}
+        ''')
+
+    def test_load_whole_document(self):
+        modulemd = utils.load_modulemd(self.content)
+        assert 'modulemd' == modulemd['document']
+        assert {'ant': {'rationale': 'main'}} == modulemd['data']['components']['rpms']
+
+    def test_load_only_properties(self):
+        modulemd = utils.load_modulemd(self.content, ['stream', 'dependencies', 'version'])
+        assert {
+            'data': {
+                'stream': '1.10',
+                'dependencies': [{'requires': {'platform': ['f29']}}],
+            }
+        } == modulemd
+
+    def test_load_without_data(self):
+        assert {'document': 'modulemd'} == utils.load_modulemd(
+            'document: modulemd', ['name'])
+        assert utils.load_modulemd('', ['name']) is None
+
+
+class TestMBSSession(object):
+    """Test utils.get_mbs_session"""
+
+    @patch.object(utils.conf, 'mbs_retries', new=5)
+    @patch.object(utils.conf, 'mbs_pool_size', new=3)
+    def test_session_is_shared(self):
+        session = utils.get_mbs_session()
+        assert session is utils.get_mbs_session()
+
+        adapter = session.get_adapter('https://mbs.local/')
+        assert 3 == adapter._pool_maxsize
+        assert 5 == adapter.max_retries.total
+        assert 0.5 == adapter.max_retries.backoff_jitter
+        assert 503 in adapter.max_retries.status_forcelist
+
+        utils.close_mbs_session()
+        assert session is not utils.get_mbs_session()
+
+    @patch.object(utils.conf, 'mbs_api_url', new='https://mbs.local/')
+    @patch('urllib3.connectionpool.HTTPConnectionPool._make_request')
+    @patch('urllib3.util.retry.Retry.sleep')
+    def test_retry_on_server_error(self, sleep, _make_request):
+        responses = []
+        for status, body in ((503, b'{}'), (200, b'{"modulemd": "content"}')):
+            response = urllib3.HTTPResponse(
+                body=io.BytesIO(body), status=status, preload_content=False,
+                headers={'Content-Type': 'application/json'})
+            responses.append(response)
+        _make_request.side_effect = responses
+
+        assert 'content' == utils.retrieve_modulemd_content(1)
+        assert 2 == _make_request.call_count
+        sleep.assert_called_once()
+
+
+class TestRulesCache(object):
+    """Test utils.RulesCache"""
+
+    def setup_method(self, test_method):
+        self.cache = utils.RulesCache()
+
+    @patch.object(utils.conf, 'rules_file_url', new='https://rules.local/rules.yaml')
+    @patch('requests.get')
+    def test_serve_cached_content_until_expired(self, get):
+        get.return_value = Mock(status_code=200, text='- id: rule',
+                                headers={'ETag': '"v1"'})
+
+        rules = self.cache.get()
+        assert '- id: rule' == rules.content
+        assert rules is self.cache.get()
+        get.assert_called_once_with('https://rules.local/rules.yaml',
+                                    timeout=60, headers={})
+
+    @patch('requests.get')
+    def test_revalidate_with_conditional_request(self, get):
+        get.return_value = Mock(status_code=200, text='- id: rule', headers={
+            'ETag': '"v1"',
+            'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        })
+        rules = self.cache.get()
+
+        get.return_value = Mock(status_code=304, text='', headers={})
+        with patch.object(utils.conf, 'rules_cache_ttl', new=0):
+            assert rules is self.cache.get()
+
+        _, kwargs = get.call_args
+        assert {
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        } == kwargs['headers']
+
+    @patch('requests.get')
+    def test_new_revision_is_retrieved(self, get):
+        get.return_value = Mock(status_code=200, text='- id: rule', headers={})
+        rules = self.cache.get()
+
+        get.return_value = Mock(status_code=200, text='- id: new rule', headers={})
+        new_rules = self.cache.refresh()
+
+        assert '- id: new rule' == new_rules.content
+        assert rules.revision != new_rules.revision
+
+    @patch('requests.get')
+    def test_serve_last_content_if_host_is_unreachable(self, get):
+        get.return_value = Mock(status_code=200, text='- id: rule', headers={})
+        rules = self.cache.get()
+
+        get.side_effect = ConnectionError('unreachable')
+        assert rules is self.cache.refresh()
+
+    @patch('requests.get')
+    def test_raise_error_if_nothing_is_cached(self, get):
+        get.return_value.raise_for_status.side_effect = HTTPError('error')
+        pytest.raises(HTTPError, self.cache.get)
+
+    @patch('requests.get')
+    def test_refresher_caches_content_immediately(self, get):
+        get.return_value = Mock(status_code=200, text='- id: rule', headers={})
+        refreshed = threading.Event()
+        get.side_effect = lambda *args, **kwargs: refreshed.set() or get.return_value
+
+        self.cache.start_refresher(3600)
+        try:
+            assert refreshed.wait(5)
+        finally:
+            self.cache.stop_refresher()
+
+        assert '- id: rule' == self.cache.get().content
+        get.assert_called_once()
+
+
+class TestLRUCache(object):
+    """Test utils.LRUCache"""
+
+    def test_evict_least_recently_used_entry(self):
+        cache = utils.LRUCache('test', max_entries=2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        assert 'a' == cache.get(1)
+        cache.put(3, 'c')
+
+        assert 2 == len(cache)
+        assert cache.get(2) is None
+        assert 'a' == cache.get(1)
+        assert 'c' == cache.get(3)
+
+    def test_bounded_by_size(self):
+        cache = utils.LRUCache('test', max_entries=10, max_size=10)
+        cache.put(1, 'a', size=4)
+        cache.put(2, 'b', size=4)
+        cache.put(3, 'c', size=4)
+        # Too large to be cached
+        cache.put(4, 'd', size=11)
+
+        assert [None, 'b', 'c', None] == [cache.get(key) for key in (1, 2, 3, 4)]
+
+    @patch('time.monotonic')
+    def test_entry_expires(self, monotonic):
+        cache = utils.LRUCache('test', max_entries=10, ttl=60)
+        monotonic.return_value = 100
+        cache.put(1, 'a')
+
+        monotonic.return_value = 159
+        assert 'a' == cache.get(1)
+        monotonic.return_value = 160
+        assert cache.get(1) is None
+        assert 0 == len(cache)
+
+    def test_disabled(self):
+        cache = utils.LRUCache('test', max_entries=0)
+        cache.put(1, 'a')
+        assert cache.get(1) is None
+
+    def test_count_in_metrics(self):
+        def value(counter):
+            return counter.labels('metrics-test')._value.get()
+
+        cache = utils.LRUCache('metrics-test', max_entries=1)
+        cache.put(1, 'a')
+        cache.get(1)
+        cache.get(2)
+        cache.put(2, 'b')
+
+        assert 1 == value(utils.monitor.cache_hits_counter)
+        assert 1 == value(utils.monitor.cache_misses_counter)
+        assert 1 == value(utils.monitor.cache_evictions_counter)
+
+
+class TestThrottle(object):
+    """Test utils.Throttle"""
+
+    @patch('time.sleep')
+    @patch('time.monotonic')
+    def test_limit_rate(self, monotonic, sleep):
+        monotonic.return_value = 100
+        throttle = utils.Throttle('test', rate=2, burst=2, max_concurrency=0)
+
+        for _ in range(4):
+            with throttle:
+                pass
+        # The first two calls take the tokens in bucket, and the others wait
+        # for the tokens refilled one by one.
+        assert [call(0.5), call(1.0)] == sleep.call_args_list
+
+        # Bucket is refilled.
+        sleep.reset_mock()
+        monotonic.return_value = 110
+        with throttle:
+            pass
+        sleep.assert_not_called()
+
+    @patch('time.sleep')
+    def test_no_rate_limit(self, sleep):
+        throttle = utils.Throttle('test', rate=0, burst=1, max_concurrency=0)
+        for _ in range(10):
+            with throttle:
+                pass
+        sleep.assert_not_called()
+
+    def test_limit_concurrency(self):
+        throttle = utils.Throttle('test', rate=0, burst=1, max_concurrency=1)
+        entered = threading.Event()
+
+        def _call():
+            with throttle:
+                entered.set()
+
+        with throttle:
+            t = threading.Thread(target=_call)
+            t.start()
+            assert not entered.wait(0.1)
+        t.join(5)
+        assert entered.is_set()
+
+
+class TestCircuitBreaker(object):
+    """Test utils.CircuitBreaker"""
+
+    def _call(self, breaker, error=None):
+        with breaker:
+            if error is not None:
+                raise error
+
+    @patch('time.monotonic')
+    def test_open_and_close(self, monotonic):
+        monotonic.return_value = 100
+        breaker = utils.CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                self._call(breaker, ConnectionError())
+        assert breaker.OPEN == breaker.state
+        with pytest.raises(utils.CircuitOpenError):
+            self._call(breaker)
+
+        # Probe fails
+        monotonic.return_value = 130
+        assert breaker.HALF_OPEN == breaker.state
+        with pytest.raises(ConnectionError):
+            self._call(breaker, ConnectionError())
+        assert breaker.OPEN == breaker.state
+
+        # Probe succeeds
+        monotonic.return_value = 160
+        self._call(breaker)
+        assert breaker.CLOSED == breaker.state
+
+    @patch('time.monotonic')
+    def test_allow_one_probe_when_half_open(self, monotonic):
+        monotonic.return_value = 100
+        breaker = utils.CircuitBreaker('test', failure_threshold=1, reset_timeout=30)
+        breaker.record_failure()
+
+        monotonic.return_value = 130
+        assert breaker.available
+        with breaker:
+            # Other calls are rejected while the probe is being made.
+            assert not breaker.available
+            with pytest.raises(utils.CircuitOpenError):
+                self._call(breaker)
+        assert breaker.CLOSED == breaker.state
+        self._call(breaker)
+
+    def test_wait_for_probe(self):
+        breaker = utils.CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.__enter__()
+        assert not breaker.available
+
+        t = threading.Timer(0.05, breaker.__exit__, (None, None, None))
+        t.start()
+        assert breaker.wait_until_available() >= 0.04
+        assert breaker.CLOSED == breaker.state
+        t.join()
+
+    def test_count_consecutive_failures_only(self):
+        breaker = utils.CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+        for error in (ConnectionError(), None, ConnectionError(), None):
+            try:
+                self._call(breaker, error)
+            except ConnectionError:
+                pass
+        assert breaker.CLOSED == breaker.state
+
+    def test_ignore_errors_not_failures(self):
+        breaker = utils.CircuitBreaker(
+            'test', failure_threshold=1, reset_timeout=30,
+            is_failure=lambda e: isinstance(e, ConnectionError))
+        with pytest.raises(ValueError):
+            self._call(breaker, ValueError())
+        assert breaker.CLOSED == breaker.state
+
+    def test_disabled(self):
+        breaker = utils.CircuitBreaker('test', failure_threshold=0, reset_timeout=30)
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                self._call(breaker, ConnectionError())
+        assert breaker.CLOSED == breaker.state
+
+    def test_wait_until_available(self):
+        breaker = utils.CircuitBreaker('test', failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        assert breaker.OPEN == breaker.state
+        assert breaker.wait_until_available() >= 0.04
+        assert breaker.HALF_OPEN == breaker.state
+
+    @patch.object(utils.conf, 'mbs_api_url', new='https://mbs.local/')
+    @patch('requests.Session.get')
+    def test_mbs_breaker(self, get):
+        get.side_effect = ConnectionError('refused')
+        with patch.object(utils.mbs_breaker, 'failure_threshold', new=2):
+            for _ in range(2):
+                pytest.raises(ConnectionError, utils.retrieve_modulemd_content, 1)
+            pytest.raises(utils.CircuitOpenError, utils.retrieve_modulemd_content, 1)
+        assert 2 == get.call_count
+
+
+class TestExpiringSet(object):
+    """Test utils.ExpiringSet"""
+
+    @patch('time.monotonic')
+    def test_key_expires(self, monotonic):
+        keys = utils.ExpiringSet(window=60, max_entries=10)
+        monotonic.return_value = 100
+        assert keys.add('a')
+        assert not keys.add('a')
+
+        monotonic.return_value = 150
+        assert keys.add('b')
+        assert not keys.add('a')
+
+        monotonic.return_value = 160
+        assert keys.add('a')
+        assert not keys.add('b')
+        assert 2 == len(keys)
+
+    def test_bounded_by_number_of_keys(self):
+        keys = utils.ExpiringSet(window=60, max_entries=2)
+        assert keys.add('a')
+        assert keys.add('b')
+        assert keys.add('c')
+        assert 2 == len(keys)
+        assert keys.add('a')
+        assert not keys.add('c')
+
+    def test_disabled(self):
+        keys = utils.ExpiringSet(window=0, max_entries=10)
+        assert keys.add('a')
+        assert keys.add('a')
+
+
+class TestLazySingleton(object):
+    """Test utils.LazySingleton"""
+
+    def test_not_configured(self):
+        create = Mock(return_value=None)
+        singleton = utils.LazySingleton(create)
+        assert singleton.get() is None
+        assert singleton.get() is None
+        assert 2 == create.call_count
+        singleton.close()
+
+    @patch.object(utils.conf, 'outbox_replay_interval', new=60)
+    def test_create_once_and_run_task(self):
+        obj = Mock()
+        called = threading.Event()
+        task = Mock(side_effect=lambda _: called.set())
+        singleton = utils.LazySingleton(Mock(return_value=obj), task_name='test-task',
+                                        task=task, interval='outbox_replay_interval',
+                                        immediate=True)
+        assert obj is singleton.get()
+        assert obj is singleton.get()
+        assert called.wait(5)
+        task.assert_called_once_with(obj)
+
+        singleton.close()
+        obj.close.assert_called_once_with()
+
+
+class TestModulemdStoreUsage(object):
+    """Test modulemd store is used to retrieve modulemd content"""
+
+    @patch.object(utils.conf, 'modulemd_store_compact_interval', new=0)
+    @patch('message_tagging_service.utils._request_modulemd_content')
+    def test_retrieve_from_store(self, _request_modulemd_content, tmp_path):
+        _request_modulemd_content.return_value = 'data: {}'
+
+        with patch.object(utils.conf, 'modulemd_store_path', new=str(tmp_path / 'm.db')):
+            assert 'data: {}' == utils.retrieve_modulemd_content(1)
+            # Simulate restarting service
+            utils.close_modulemd_store()
+            assert 'data: {}' == utils.retrieve_modulemd_content(1)
+
+        _request_modulemd_content.assert_called_once_with(1)